@@ -0,0 +1,99 @@
+'''
+Compiled tables and caches kept on disk.  A compiled table is a binary
+header followed by arrays, built from some source files on first use and
+written beside them, or failing that in the temporary directory, to be
+memory mapped by later processes until the sources change.  Files are
+written atomically so concurrent processes never see a partial one.
+'''
+import array, hashlib, os, struct, tempfile
+
+
+def array_at(buf, offset, typecode, count):
+    '''Return count items of typecode at offset in buf, as a view of buf
+       where possible.'''
+    size = array.array(typecode).itemsize * count
+    try:
+        return memoryview(buf)[offset:offset + size].cast(typecode)
+    except (AttributeError, TypeError):
+        # Python 2 can't view a buffer as an array, so copy it into one.
+        res = array.array(typecode)
+        res.fromstring(bytes(buf[offset:offset + size]))
+        return res
+
+
+def tobytes(a):
+    return a.tobytes() if hasattr(a, 'tobytes') else a.tostring()
+
+
+def atomic_write(path, data, mode=None, replace=False):
+    '''Write data to path under a temporary name in the same directory and
+       rename it into place, so concurrent processes never see a partial
+       file.  mode sets its permissions, rather than the private ones of a
+       temporary file.  If the rename fails, as it does on Windows when path
+       exists, the file is dropped and False returned, unless replace is
+       set, when path is removed first and any error raised.'''
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    renamed = False
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        if mode is not None:
+            os.chmod(tmp_path, mode)
+        if replace and os.name == 'nt' and os.path.exists(path):
+            os.unlink(path)
+        try:
+            os.rename(tmp_path, path)
+            renamed = True
+        except OSError:
+            if replace:
+                raise
+    finally:
+        if not renamed:
+            os.unlink(tmp_path)
+    return renamed
+
+
+def compiled_paths(sources, ext):
+    '''Places to keep a table compiled from the source files: beside the
+       first of them, or failing that in the temporary directory.'''
+    base = os.path.splitext(os.path.basename(sources[0]))[0]
+    h = hashlib.sha1("\0".join(sources).encode('utf-8')).hexdigest()[:16]
+    if len(sources) > 1:
+        base += "-" + h[:8]
+    yield os.path.join(os.path.dirname(sources[0]), base + os.extsep + ext)
+    yield os.path.join(tempfile.gettempdir(), 'palaso-{0}-{1}.{2}'.format(base, h, ext))
+
+
+def open_table(path, table, valid):
+    '''Return table() of the memory mapped file at path, or None if it can't
+       be read or valid() rejects it.'''
+    import mmap
+    try:
+        with open(path, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        res = table(buf)
+    except (IOError, OSError, ValueError, struct.error):
+        return None
+    return res if valid(res) else None
+
+
+def load_table(paths, table, valid, compile):
+    '''Return table() of the first of paths holding a table that valid()
+       accepts.  Failing that, compile() returns the data of one, which is
+       written to the first of paths it can be and memory mapped from there,
+       or used from memory if it can't be written anywhere.'''
+    paths = list(paths)
+    for p in paths:
+        res = open_table(p, table, valid)
+        if res is not None:
+            return res
+    data = compile()
+    for p in paths:
+        try:
+            atomic_write(p, data, mode=0o644)
+        except (IOError, OSError):
+            continue
+        res = open_table(p, table, valid)
+        if res is not None:
+            return res
+    return table(data)
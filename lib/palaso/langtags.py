@@ -25,8 +25,15 @@
 
 from xml.etree import ElementTree as et
 from xml.etree import ElementPath as ep
-import os, re, csv
+import array, csv, hashlib, itertools, os, re, struct, sys, zlib
+from collections import OrderedDict
 from six import with_metaclass
+from palaso.compiled import array_at, compiled_paths, load_table, tobytes
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
 
 class Singleton(type):
     _instances = {}
@@ -246,24 +253,314 @@ class LangTag(object) :
         return self
 
 
+# A compiled langtags database is a header followed by arrays of native
+# unsigned ints:
+#   offsets   nstrings+1  start of each interned string in the string data
+#   slots     nslots      key number + 1 of each slot of a hash table of the
+#                         tag strings, open addressed by crc32, 0 if empty
+#   keys      nkeys       string of each tag, in the order they were added
+#   tagsets   nkeys       record of the tag set each tag belongs to
+#   records   nrecords*6  strings of the lang, script, region, variants,
+#                         extensions and descriptions of each tag set
+# then nrecords bytes of flags and the UTF-8 string data. String 0 is empty
+# and stands for None.
+_magic = b'LTAG'
+_version = 1
+_header = struct.Struct('=4sBBH20sIIII')
+
+_HIDESCRIPT, _HIDEREGION, _HIDEBOTH, _SKIP, _DEPRECATED, _DESC = (1 << i for i in range(6))
+
+
+def _encode(s):
+    return s if isinstance(s, bytes) else s.encode('utf-8')
+
+
+def _decode(b):
+    return b if str is bytes else b.decode('utf-8')
+
+
+def compileLangTags(langtags, stamp=b''):
+    """Return the compiled binary form of a dict of tag strings to LangTag,
+    as built by LangTags. Tags sharing a LangTag share a record. stamp
+    identifies the sources it was built from."""
+    strings = {b'': 0}
+    data = [b'']
+    offsets = array.array('I', [0, 0])
+    def intern(s):
+        if s is None:
+            return 0
+        s = _encode(s)
+        res = strings.get(s)
+        if res is None:
+            res = strings[s] = len(data)
+            data.append(s)
+            offsets.append(offsets[-1] + len(s))
+        return res
+
+    records = {}
+    keys = array.array('I')
+    tagsets = array.array('I')
+    fields = array.array('I')
+    flags = array.array('B')
+    for k, t in langtags.items():
+        r = records.get(id(t))
+        if r is None:
+            r = records[id(t)] = len(flags)
+            exts = None
+            if t.extensions is not None:
+                exts = []
+                for ns in sorted(t.extensions.keys()):
+                    exts.append(ns)
+                    exts.extend(t.extensions[ns])
+            fields.extend([intern(t.lang), intern(t.script), intern(t.region),
+                           intern("-".join(t.variants) if t.variants else None),
+                           intern("-".join(exts) if exts else None),
+                           intern("\n".join(t.desc) if hasattr(t, 'desc') else None)])
+            flags.append((_HIDESCRIPT if t.hidescript else 0) | (_HIDEREGION if t.hideregion else 0)
+                         | (_HIDEBOTH if t.hideboth else 0) | (_SKIP if t.skip else 0)
+                         | (_DEPRECATED if getattr(t, 'deprecated', False) else 0)
+                         | (_DESC if hasattr(t, 'desc') else 0))
+        keys.append(intern(k))
+        tagsets.append(r)
+
+    nslots = 1
+    while nslots < 2 * len(keys):
+        nslots <<= 1
+    slots = array.array('I', [0]) * nslots
+    for i, k in enumerate(keys):
+        j = zlib.crc32(data[k]) & (nslots - 1)
+        while slots[j]:
+            j = (j + 1) & (nslots - 1)
+        slots[j] = i + 1
+
+    header = _header.pack(_magic, _version, len(sys.byteorder), 0, stamp,
+                          len(data), nslots, len(keys), len(flags))
+    return b''.join([header] + [tobytes(a) for a in (offsets, slots, keys, tagsets, fields, flags)]
+                    + data)
+
+
+class LangTagsTable(Mapping):
+    """Read only dict of tag strings to LangTag, read directly from a compiled
+    langtags database. Each LangTag is only made when it is first looked up,
+    and is then shared by all the tags in its tag set."""
+
+    def __init__(self, buf):
+        (magic, version, order, _, self.stamp, nstrings, nslots, nkeys, nrecords) \
+                = _header.unpack_from(buf, 0)
+        if magic != _magic or version != _version or order != len(sys.byteorder):
+            raise ValueError("Not a compiled langtags database")
+        self._buf = buf
+        offset = _header.size
+        self._offsets = array_at(buf, offset, 'I', nstrings + 1)
+        offset += 4 * (nstrings + 1)
+        self._slots = array_at(buf, offset, 'I', nslots)
+        offset += 4 * nslots
+        self._keys = array_at(buf, offset, 'I', nkeys)
+        offset += 4 * nkeys
+        self._tagsets = array_at(buf, offset, 'I', nkeys)
+        offset += 4 * nkeys
+        self._fields = array_at(buf, offset, 'I', 6 * nrecords)
+        offset += 24 * nrecords
+        self._flags = array_at(buf, offset, 'B', nrecords)
+        self._data = offset + nrecords
+        self._mask = nslots - 1
+        self._cache = {}
+        self._tags = {}
+
+    def _bytes(self, i):
+        return self._buf[self._data + self._offsets[i]:self._data + self._offsets[i + 1]]
+
+    def _string(self, i):
+        return _decode(self._bytes(i)) if i else None
+
+    def record(self, key):
+        """Return the number of the tag set of a tag string, or -1 if none."""
+        try:
+            k = _encode(key)
+        except AttributeError:
+            return -1
+        j = zlib.crc32(k) & self._mask
+        while True:
+            s = self._slots[j]
+            if not s:
+                return -1
+            if self._bytes(self._keys[s - 1]) == k:
+                return self._tagsets[s - 1]
+            j = (j + 1) & self._mask
+
+    def langtag(self, record):
+        """Return the LangTag of a tag set."""
+        res = self._tags.get(record)
+        if res is not None:
+            return res
+        (lang, script, region, variants, extensions, desc) = \
+                [self._string(i) for i in self._fields[6 * record:6 * record + 6]]
+        if variants is not None:
+            variants = variants.split("-")
+        if extensions is not None:
+            exts = {}
+            for s in extensions.split("-"):
+                if len(s) == 1:
+                    ns = exts[s] = []
+                else:
+                    ns.append(s)
+            extensions = exts
+        res = LangTag(lang=lang, script=script, region=region, variants=variants, extensions=extensions)
+        f = self._flags[record]
+        res.hidescript = bool(f & _HIDESCRIPT)
+        res.hideregion = bool(f & _HIDEREGION)
+        res.hideboth = bool(f & _HIDEBOTH)
+        res.skip = bool(f & _SKIP)
+        if f & _DEPRECATED:
+            res.deprecated = True
+        if f & _DESC:
+            res.desc = (desc or "").split("\n")
+        self._tags[record] = res
+        return res
+
+    def __getitem__(self, key):
+        try:
+            return self._cache[key]
+        except (KeyError, TypeError):
+            pass
+        r = self.record(key)
+        if r < 0:
+            raise KeyError(key)
+        res = self._cache[key] = self.langtag(r)
+        return res
+
+    def __contains__(self, key):
+        try:
+            if key in self._cache:
+                return True
+        except TypeError:
+            return False
+        return self.record(key) >= 0
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __iter__(self):
+        for k in self._keys:
+            yield self._string(k)
+
+
+_tables = {}
+def loadLangTags(sources, build):
+    """Return a LangTagsTable of the tags built from the given source files,
+    shared by everything that loads them. If there is no up to date compiled
+    database, build() is called to return a dict of tag strings to LangTag,
+    which is compiled and kept on disk, to be memory mapped by later
+    processes until any of the sources change."""
+    sources = tuple(os.path.abspath(s) for s in sources)
+    if sources in _tables:
+        return _tables[sources]
+    h = hashlib.sha1()
+    for s in sources:
+        st = os.stat(s)
+        h.update(u"{0}\0{1}\0{2!r}\0".format(s, st.st_size, float(st.st_mtime)).encode('utf-8'))
+    stamp = h.digest()
+    res = load_table(compiled_paths(sources, 'ltdb'), LangTagsTable,
+                     lambda t: t.stamp == stamp, lambda: compileLangTags(build(), stamp))
+    _tables[sources] = res
+    return res
+
+
 class LangTags(with_metaclass(Singleton, dict)):
 
+    cachesize = 1 << 16
+
     def __init__(self, extrasfile=None, noalltags=False, alltags=None):
         super(LangTags, self).__init__()
-        if noalltags or not self.readAlltags(alltags):
-            self.readIana()
-            self.readLikelySubtags()
-            if extrasfile is not None :
-                self.readExtras(extrasfile)
-            self.readSupplementalData()
+        self._table = None
+        self._args = (extrasfile, noalltags, alltags)
+        self._canonical = OrderedDict()
+        if not noalltags:
+            if alltags is None:
+                alltags = self._findAlltags()
+            if alltags is not None:
+                self._load([alltags], lambda: self.readAlltags(alltags))
+                return
+        sources = [os.path.join(os.path.dirname(__file__), 'sldr', f) for f in
+                    ("language-subtag-registry.txt", 'likelySubtags.xml', 'supplementalData.xml')]
+        if extrasfile is not None :
+            sources.append(extrasfile)
+        self._load(sources, lambda: self._readSources(extrasfile))
+
+    def _readSources(self, extrasfile=None):
+        self.readIana()
+        self.readLikelySubtags()
+        if extrasfile is not None :
+            self.readExtras(extrasfile)
+        self.readSupplementalData()
+
+    def _load(self, sources, build):
+        """Look tags up in a compiled database of the tags that build() reads
+        from the sources, building it if need be."""
+        def built():
+            build()
+            return dict(self)
+        self._table = loadLangTags(sources, built)
+        self.clear()
+
+    def _materialise(self):
+        """Copy every tag out of the compiled database, for going through them all."""
+        if self._table is None:
+            return
+        table, self._table = self._table, None
+        added = dict(self)
+        self.clear()
+        for k, v in table.items():
+            self[k] = added.pop(k, v)
+        self.update(added)
+
+    def __missing__(self, key):
+        if self._table is None:
+            raise KeyError(key)
+        return self._table[key]
+
+    def __contains__(self, key):
+        return super(LangTags, self).__contains__(key) or (self._table is not None and key in self._table)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __len__(self):
+        res = super(LangTags, self).__len__()
+        if self._table is not None:
+            res += len(self._table) - sum(1 for k in super(LangTags, self).keys() if k in self._table)
+        return res
+
+    def __iter__(self):
+        self._materialise()
+        return super(LangTags, self).__iter__()
+
+    def keys(self):
+        self._materialise()
+        return super(LangTags, self).keys()
+
+    def values(self):
+        self._materialise()
+        return super(LangTags, self).values()
+
+    def items(self):
+        self._materialise()
+        return super(LangTags, self).items()
+
+    def _findAlltags(self):
+        for p in [os.path.dirname(__file__)]:
+            fname = os.path.join(p, 'sldr', 'alltags.txt')
+            if os.path.exists(fname):
+                return fname
+        return None
 
     def readAlltags(self, fname=None):
         if fname is None:
-            for p in [os.path.dirname(__file__)]:
-                fname = os.path.join(p, 'sldr', 'alltags.txt')
-                if os.path.exists(fname):
-                    break
-            else:
+            fname = self._findAlltags()
+            if fname is None:
                 return False
         with open(fname) as fh:
             for l in fh.readlines():
@@ -397,6 +694,43 @@ class LangTags(with_metaclass(Singleton, dict)):
                 diff.update(merge)
         for a in diff:
             self[a] = tag
+        self._canonical.clear()
+
+    def canonicalise(self, tag):
+        """Return the canonical form of a tag string, as given by str() of the
+        LangTag that it, with - for _, analyses to. The most recently used
+        cachesize results are kept."""
+        key = tag.replace('_', '-')
+        cache = self._canonical
+        try:
+            res = cache.pop(key)
+        except KeyError:
+            res = str(LangTag(key).analyse(self))
+            if len(cache) >= self.cachesize:
+                cache.popitem(last=False)
+        cache[key] = res
+        return res
+
+    def canonicalise_many(self, tags, workers=0, chunksize=1 << 12):
+        """Yield the canonical form of each of an iterable of tag strings, as
+        canonicalise() gives. If workers is not 0, chunks of chunksize tags are
+        canonicalised across a pool of that many worker processes, or one per
+        CPU if it is None, and their results yielded in order."""
+        if workers == 0:
+            for t in tags:
+                yield self.canonicalise(t)
+            return
+        import multiprocessing
+        tags = iter(tags)
+        chunks = iter(lambda: list(itertools.islice(tags, chunksize)), [])
+        pool = multiprocessing.Pool(workers, _init_canonicalise, (self._args, dict(dict.items(self))))
+        try:
+            for res in pool.imap(_canonicalise_chunk, chunks):
+                for r in res:
+                    yield r
+        finally:
+            pool.terminate()
+            pool.join()
 
     def generate_alltags(self) :
         res = []
@@ -407,6 +741,19 @@ class LangTags(with_metaclass(Singleton, dict)):
             res.append(outs)
         return res
 
+
+_canonicalise_tags = None
+
+
+def _init_canonicalise(args, added):
+    global _canonicalise_tags
+    _canonicalise_tags = LangTags(*args)
+    _canonicalise_tags.update(added)
+
+
+def _canonicalise_chunk(tags):
+    return [_canonicalise_tags.canonicalise(t) for t in tags]
+
 if __name__ == '__main__' :
     import sys
 
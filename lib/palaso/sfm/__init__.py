@@ -27,8 +27,9 @@ __history__ = '''
 		use the unique field types set object to improve performance.
 '''
 import collections, codecs, functools, operator, re, warnings, os, sys
-from itertools import chain, groupby
-from functools import partial
+from bisect import bisect_right
+from itertools import chain
+from functools import partial, reduce
 
 try:
     from itertools import imap, ifilter
@@ -53,7 +54,35 @@ class position(collections.namedtuple('position', ['line', 'col'])):
         return 'line {0.line},{0.col}'.format(self)
 
 
-class element(list):
+class _positioned(object):
+    '''
+    Position storage shared by text and element nodes.  Nodes made by the
+    parser hold an integer character offset into their document's table of
+    line start offsets (_lines) and only build a position when asked for
+    one.  Nodes given an explicit position keep it with _lines set to None.
+    '''
+    __slots__ = ()
+
+    @property
+    def pos(self):
+        lines = self._lines
+        if lines is None: return self._pos
+        l = bisect_right(lines, self._pos) - 1
+        return position(l+1, self._pos - lines[l] + 1)
+
+    @pos.setter
+    def pos(self, pos):
+        self._pos = pos
+        self._lines = None
+
+    def _offset_pos(self, n):
+        '''Return the (_pos, _lines) pair for n characters further on.'''
+        if self._lines is None:
+            return position(self._pos.line, self._pos.col + n) if n else self._pos, None
+        return self._pos + n, self._lines
+
+
+class element(list, _positioned):
     """
     A sequence type that for holding the a marker and it's child nodes
     >>> element('marker')
@@ -89,17 +118,28 @@ class element(list):
     >>> element('marker') == element('different')
     False
     """
-    __slots__ = ('pos', 'name', 'args', 'parent', 'meta', 'annotations')
-    
+    __slots__ = ('_pos', '_lines', 'name', 'args', 'parent', 'meta', '_annotations')
+
     def __init__(self, name, pos=position(1,1), args=[], parent=None, meta={}, content=[]):
         super(element,self).__init__(content)
         self.name = unicode(name) if name else None
-        self.pos = pos
+        self._pos = pos
+        self._lines = None
         self.args = args
         self.parent = parent
         self.meta = meta
-        self.annotations = {}
-    
+        self._annotations = None
+
+    @property
+    def annotations(self):
+        '''Created on first use, most elements never carry any.'''
+        if self._annotations is None: self._annotations = {}
+        return self._annotations
+
+    @annotations.setter
+    def annotations(self, annotations):
+        self._annotations = annotations
+
     def __repr__(self):
         args = [repr(self.name)] \
             + (self.args and [u'args=' + repr(self.args)]) \
@@ -112,8 +152,8 @@ class element(list):
         return self.name == rhs.name \
            and self.args == rhs.args \
            and (not self.meta or not rhs.meta or self.meta == rhs.meta) \
-           and (not self.annotations or not rhs.annotations 
-                                     or self.meta == rhs.meta) \
+           and (not self._annotations or not rhs._annotations 
+                                      or self.meta == rhs.meta) \
            and super(element,self).__eq__(rhs)
     
     def __str__(self):
@@ -129,12 +169,12 @@ class element(list):
                 sep = u' '
         elif self.meta.get('StyleType') == 'Character' :
             body = ' '
-        if endmarker and 'implicit-closed' not in self.annotations:
+        if endmarker and 'implicit-closed' not in (self._annotations or ()):
             body += u'\\' + endmarker
         return sep.join([marker, body])
 
 
-class text(unicode):
+class text(unicode, _positioned):
     '''
     >>> from pprint import pprint
 
@@ -182,18 +222,27 @@ class text(unicode):
     >>> t, t.pos
     (text(u'a few short words'), position(line=1, col=1))
     '''
+    __slots__ = ('_pos', '_lines', 'parent')
+    
     def __new__(cls, content, pos=position(1,1), parent=None):
         return super(text,cls).__new__(cls, content)
     
     def __init__(self, content, pos=position(1,1), parent=None):
-        self.pos = pos
+        self._pos = pos
+        self._lines = None
         self.parent = parent
     
+    def _derive(self, content, n=0):
+        t = unicode.__new__(text, content)
+        t._pos, t._lines = self._offset_pos(n)
+        t.parent = self.parent
+        return t
+    
     @staticmethod
     def concat(iterable):
         i = iter(iterable)
         h = next(i)
-        return text(u''.join(chain([h],i)), h.pos, h.parent)
+        return h._derive(u''.join(chain([h],i)))
     
     def split(self, sep, maxsplit=-1):
         tail = self
@@ -202,7 +251,7 @@ class text(unicode):
             e = tail.find(sep)
             if e == -1:
                 result.append(tail)
-                tail=text(u'',position(self.pos.line, self.pos.col+len(tail)), self.parent)
+                tail=self._derive(u'', len(self))
                 break
             result.append(tail[:e])
             tail = tail[e+len(sep):]
@@ -213,11 +262,11 @@ class text(unicode):
     def lstrip(self,*args,**kwds):
         l = len(self)
         s_ = super(text,self).lstrip(*args,**kwds)
-        return text(s_, position(self.pos.line, self.pos.col + l-len(s_)), self.parent)
+        return self._derive(s_, l-len(s_))
     
     def rstrip(self,*args,**kwds):
         s_ = super(text,self).rstrip(*args, **kwds)
-        return text(s_, self.pos, self.parent)
+        return self._derive(s_)
     
     def strip(self,*args,**kwds):
         return self.lstrip(*args, **kwds).rstrip(*args, **kwds)
@@ -226,15 +275,21 @@ class text(unicode):
         return u'text({0!s})'.format(super(text,self).__repr__())
     
     def __add__(self, rhs):
-        return text(super(text,self).__add__(rhs), self.pos,self.parent)
+        return self._derive(super(text,self).__add__(rhs))
     
     def __getslice__(self, i, j): return self.__getitem__(slice(i, j))
     
     def __getitem__(self,i):
-        return text(super(text,self).__getitem__(i), 
-                    position(self.pos.line, self.pos.col \
-                                            + (i.start or 0 if isinstance(i, slice) else i)),
-                    self.parent)
+        return self._derive(super(text,self).__getitem__(i), 
+                            i.start or 0 if isinstance(i, slice) else i)
+
+
+def _token(content, offset, lines):
+    t = unicode.__new__(text, content)
+    t._pos = offset
+    t._lines = lines
+    t.parent = None
+    return t
 
 
 class _put_back_iter(collections.Iterator):
@@ -282,6 +337,61 @@ class _put_back_iter(collections.Iterator):
         return self.__pbq[-1]
 
 
+_span = operator.methodcaller('span')
+
+
+def _split_at(buf, starts):
+    return (buf[s:e] for s,e in zip(starts, starts[1:] + [len(buf)]))
+
+
+def _line_blocks(source, size):
+    '''
+    Yield (buffer, line start offsets, whole) tuples covering source.
+    whole is True when every line in the buffer ends with a newline, the
+    last line of the source excepted, so the buffer can be tokenised in
+    one pass; otherwise each line must be tokenised alone.
+    A string source is treated as a single buffer split at its newlines.
+    
+    >>> list(_line_blocks(u'a\\nbc\\n\\nd', 4))
+    [(u'a\\nbc\\n\\nd', [0, 2, 5, 6], True)]
+    >>> list(_line_blocks([u'a\\n', u'bc\\n', u'\\n', u'd'], 4))
+    [(u'a\\nbc\\n', [0, 2], True), (u'\\nd', [0, 1], True)]
+    >>> list(_line_blocks([u'a', u'bc'], 4))
+    [(u'abc', [0, 1], False)]
+    '''
+    if isinstance(source, (str, unicode)):
+        starts = [0]
+        i = source.find(u'\n')
+        while i != -1 and i+1 < len(source):
+            starts.append(i+1)
+            i = source.find(u'\n', i+1)
+        yield (source, starts, True)
+        return
+    
+    lines, n = [], 0
+    for l in source:
+        lines.append(l)
+        n += len(l)
+        if n >= size:
+            yield _block(lines)
+            lines, n = [], 0
+    if lines:
+        yield _block(lines)
+
+
+def _block(lines):
+    buf = u''.join(lines)
+    starts = [0]*len(lines)
+    o = 0
+    for i, l in enumerate(lines):
+        starts[i] = o
+        o += len(l)
+    nls = len(lines) - (not lines[-1].endswith(u'\n'))
+    whole = buf.count(u'\n') == nls \
+        and all(l.endswith(u'\n') for l in lines[:-1])
+    return (buf, starts, whole)
+
+
 _default_meta = {'TextType':'default', 'OccursUnder':set([None]), 'Endmarker':None, 'StyleType':None}
 
 class level:
@@ -410,7 +520,16 @@ class parser(collections.Iterable):
     
     default_meta = _default_meta
     _eos = text("end-of-file")
+    _stream = False
     __tokeniser = re.compile(r'(?<!\\)\\[^\s\\]+|(?:\\\\|[^\\])+',re.DOTALL | re.UNICODE)
+    # The same token grammar applied to a whole block of lines at once: text
+    # runs continue across line ends, except that a run starting with an
+    # escaped backslash is a separate token ending at its line end.
+    __block_tokeniser = re.compile(r'(?<!\\)\\[^\s\\]+'
+                                   r'|\\\\(?:[^\\\n]|\\\\)*\n?'
+                                   r'|(?:[^\\\n]+|\\\\|\n(?!\\\\))+\n?|\n',
+                                   re.UNICODE)
+    _block_size = 1 << 16
     
     @classmethod
     def extend_stylesheet(cls, stylesheet, *names):
@@ -471,20 +590,81 @@ class parser(collections.Iterable):
         return self._default_(None)
     
     
+    def events(self):
+        '''
+        Return an iterator of (event, node) pairs in document order without
+        building an element tree.  event is one of 'start', 'text' or 'end'.
+        Elements passed with 'start' and 'end' events carry their name, args,
+        meta, annotations and parent but are never populated with children,
+        so memory use is bounded by the nesting depth, not the document size.
+        
+        >>> import warnings
+        >>> with warnings.catch_warnings():
+        ...     warnings.simplefilter("ignore")
+        ...     for ev, n in parser([r"\\sfm text", r"\\more more text"]).events():
+        ...         print ev, repr(n.name if ev != 'text' else n)
+        start u'sfm'
+        text text(u'text')
+        end u'sfm'
+        start u'more'
+        text text(u'more text')
+        end u'more'
+        '''
+        self._stream = True
+        return self._default_(None)
+    
+    
     @staticmethod
     def _pp_marker_list(tags):
         return ', '.join('\\'+c if c else 'toplevel' for c in sorted(tags))
     
     
     @staticmethod
-    def __lexer(lines):
+    def __lexer(lines, offset=0, table=None):
         """ Return an iterator that returns tokens in a sequence:
             marker, text, marker, text, ...
+            Lines are gathered into blocks which are tokenised in a single
+            pass. Tokens record their character offset into a document wide
+            table of line start offsets rather than a position, so only one
+            text object is created per token.  When lines is a fragment of
+            a document already tabled, offset is where it starts and table
+            is that document's table.
         """
-        lmss = enumerate(imap(parser.__tokeniser.finditer, lines))
-        fs = (text(m.group(), position(l+1,m.start()+1)) for l,ms in lmss for m in ms)
-        gs = groupby(fs, operator.methodcaller('startswith','\\'))
-        return chain.from_iterable(g if istag else (text.concat(g),) for istag,g in gs)
+        block_tokens = parser.__block_tokeniser.finditer
+        line_tokens = parser.__tokeniser.finditer
+        extend = table is None
+        if extend: 
+            table = []      # Start offset of every line in the document.
+        pending = None      # Offset of the text run being accumulated.
+        o = offset          # Offset of the current block.
+        
+        for buf, starts, whole in _line_blocks(lines, parser._block_size):
+            if extend: table.extend(o+s for s in starts)
+            if whole:
+                spans = imap(_span, block_tokens(buf))
+            else:
+                spans = ((l_+m.start(), l_+m.end()) 
+                            for l_,l in zip(starts, _split_at(buf, starts)) 
+                                for m in line_tokens(l))
+            for s, e in spans:
+                if buf[s] == u'\\':
+                    if pending is not None:
+                        yield _token(u''.join(pieces + [pbuf[ps:pe]]) if pieces else pbuf[ps:pe], pending, table)
+                        pending = None
+                    yield _token(buf[s:e], o+s, table)
+                elif pending is None:
+                    pending = o+s
+                    pbuf, ps, pe, pieces = buf, s, e, None
+                elif pbuf is buf and pe == s:
+                    pe = e
+                else:
+                    # Text runs separated by skipped characters or spanning
+                    # blocks are coalesced by concatenation.
+                    pieces = (pieces or []) + [pbuf[ps:pe]]
+                    pbuf, ps, pe = buf, s, e
+            o += len(buf)
+        if pending is not None:
+            yield _token(u''.join(pieces + [pbuf[ps:pe]]) if pieces else pbuf[ps:pe], pending, table)
     
     
     def __extract_tag(self, parent, tok):
@@ -508,8 +688,37 @@ class parser(collections.Iterable):
         return tok
     
     
+    def _fragment(self, lines, offset, table):
+        '''
+        Take tokens from lines, a run of text lifted from a document at
+        character offset offset, instead of the source.  The tokens share
+        table, the line start table of the document's existing nodes, and
+        are parsed by calling _default_ with the element they belong under.
+        '''
+        self._tokens = _put_back_iter(self.__lexer(lines, offset, table))
+    
+    
+    def _exhausted(self):
+        try:
+            self._tokens.peek()
+            return False
+        except StopIteration:
+            return True
+    
+    
+    def _stream_element(self, e, content):
+        yield ('start', e)
+        # Emit any content a sub-parser attached directly to the element.
+        for n in e:
+            for ev in _tree_events(n): yield ev
+        for ev in content: yield ev
+        yield ('end', e)
+    
+    
     def _default_(self, parent):
         get_meta = self.__get_style
+        stream = self._stream
+        emitted = False
         for tok in self._tokens:
             if tok[0] == u'\\':  # Parse markers.
                 tok  = self.__extract_tag(parent, tok)
@@ -519,11 +728,17 @@ class parser(collections.Iterable):
                     sub_parse = meta['TextType']
                     if not sub_parse: return
                     
-                    # Spawn a sub-node
-                    e = element(tag, tok.pos, parent=parent, meta=meta)
+                    # Spawn a sub-node sharing the marker's position
+                    e = element(tag, parent=parent, meta=meta)
+                    e._pos, e._lines = tok._pos, tok._lines
                     # and recurse
-                    e.extend(getattr(self,'_'+sub_parse+'_',self._default_) (e))
-                    yield e
+                    content = getattr(self,'_'+sub_parse+'_',self._default_) (e)
+                    if stream:
+                        for ev in self._stream_element(e, content): yield ev
+                        emitted = True
+                    else:
+                        e.extend(content)
+                        yield e
                 elif parent is None:
                     # We've failed to find a home for marker tag, poor thing.
                     if not meta['TextType']:
@@ -547,12 +762,16 @@ class parser(collections.Iterable):
                     return
             else:   # Pass non marker data through with a litte fix-up
                 if parent is not None \
-                        and len(parent) == 0 \
+                        and not (emitted or len(parent)) \
                         and not tok.startswith(('\r\n','\n')):
                     tok = tok[1:]
                 if tok:
                     tok.parent = parent
-                    yield tok
+                    if stream:
+                        yield ('text', tok)
+                        emitted = True
+                    else:
+                        yield tok
         if parent is not None:
             if parent.meta['Endmarker']:
                 self._force_close(parent, self._eos)
@@ -573,9 +792,20 @@ class parser(collections.Iterable):
             parent.meta['Endmarker'])
          
 
+def _tree_events(e):
+    if isinstance(e, element):
+        yield ('start', e)
+        for c in e:
+            for ev in _tree_events(c): yield ev
+        yield ('end', e)
+    else:
+        yield ('text', e)
+
+
+
 def sreduce(elementf, textf, trees, initial=None):
     def _g(a, e):
-        if isinstance(e, basestring): return textf(e,a)
+        if isinstance(e, (str, unicode)): return textf(e,a)
         return elementf(e, a, reduce(_g, e, initial))
     return reduce(_g, trees, initial)
 
@@ -0,0 +1,251 @@
+'''
+Word concordances of USFM documents.  Text is split into words with a
+translation table built lazily from the Unicode character categories, and
+the words are indexed by the references they occur at in a compact form:
+each word maps to an array of integer reference ids.
+'''
+import palaso.sfm as sfm
+import palaso.unicsv as csv
+import unicodedata
+from array import array
+
+try:
+    unicode
+except NameError:
+    unicode = str
+
+try:
+    unichr
+except NameError:
+    unichr = chr
+
+__all__ = ('word_cat', 'nonword_cat', 'word_classes', 'postings', 'book',
+           'merge')
+
+
+word_cat = frozenset(['Lu','Ll','Lt','Lm','Lo','Mn','Mc','Me','Pd','Cs','Co','Cn'])
+'''Define a word character as being one of:
+     Letter
+     Mark
+     Punctuation,Dash
+     Other,{Surrogate,Private Use,Not Assigned}'''
+
+
+nonword_cat = frozenset(['Nd','Nl','No','Pc','Ps','Pe','Pi','Pf','Po','Sm','Sc','Sk','So','Zs','Zl','Zp','Cc','Cf'])
+'''Define a word character as not being any of:
+         Number
+         Punctuation (all except Dash)
+         Symbol
+         Separator
+         Other,{Control,Format}'''
+
+
+class word_classes(dict):
+    '''
+    A translation table mapping word forming characters to themselves and
+    all others to a separator, so that unicode.translate followed by a
+    split breaks text into words.  Characters in word are considered to be
+    Letter,Other and those in nonword Punctuation,Other, otherwise a
+    character's Unicode category decides.  Each code point's class is looked
+    up the first time it is met and kept in the table.
+
+    >>> wc = word_classes(nonword=u"'")
+    >>> wc.words(u"Don't stop-gap (1 word)")
+    [u'Don', u't', u'stop-gap', u'word']
+    '''
+    def __init__(self, word=u'', nonword=u''):
+        super(word_classes, self).__init__()
+        self.word = frozenset(word)
+        self.nonword = frozenset(nonword)
+        if self.word & self.nonword:
+            raise ValueError('overlapping word/non-word characters: {0!r}'.format(
+                                u''.join(sorted(self.word & self.nonword))))
+        self.sep = next(c for c in u' \n\t\r' if c not in self.word)
+        self.__sep = ord(self.sep)
+
+
+    def __missing__(self, cp):
+        char = unichr(cp)
+        cat = (char in self.word and 'Lo'
+            or char in self.nonword and 'Po'
+            or unicodedata.category(char))
+        v = self[cp] = cp if cat in word_cat else self.__sep
+        return v
+
+
+    def words(self, text):
+        '''Split text into words, runs of word forming characters.'''
+        return [w for w in unicode.translate(text, self).split(self.sep) if w]
+
+
+class postings(object):
+    '''
+    A concordance mapping words to the set of references they occur at.
+    Words and reference strings are each stored once and given integer ids,
+    and each word's references are kept in a packed array of reference ids.
+
+    >>> c = postings()
+    >>> c.add([u'in', u'the', u'beginning'], u'GEN 1:1')
+    >>> c.add([u'the', u'earth'], u'GEN 1:2')
+    >>> c.references(u'the')
+    [u'GEN 1:1', u'GEN 1:2']
+    >>> d = postings()
+    >>> d.add([u'the'], u'EXO 1:1')
+    >>> c.update(d)
+    >>> c.references(u'the')
+    [u'EXO 1:1', u'GEN 1:1', u'GEN 1:2']
+    >>> len(c), u'earth' in c
+    (4, True)
+    '''
+    typecode = 'i'
+
+    def __init__(self):
+        self.words = []         # Word id to word.
+        self.refs = []          # Reference id to reference string.
+        self.__word_ids = {}
+        self.__ref_ids = {}
+        self.__postings = []    # Word id to array of reference ids.
+
+
+    def __getstate__(self):
+        return (self.words, self.refs, self.__postings)
+
+
+    def __setstate__(self, state):
+        self.words, self.refs, self.__postings = state
+        self.__word_ids = dict((w,i) for i,w in enumerate(self.words))
+        self.__ref_ids = dict((r,i) for i,r in enumerate(self.refs))
+
+
+    def __len__(self):           return len(self.words)
+    def __contains__(self, word): return word in self.__word_ids
+    def __iter__(self):          return iter(self.words)
+
+
+    def ref_id(self, ref):
+        i = self.__ref_ids.get(ref)
+        if i is None:
+            i = self.__ref_ids[ref] = len(self.refs)
+            self.refs.append(ref)
+        return i
+
+
+    def _postings(self, word):
+        i = self.__word_ids.get(word)
+        if i is None:
+            i = self.__word_ids[word] = len(self.words)
+            self.words.append(word)
+            self.__postings.append(array(self.typecode))
+        return self.__postings[i]
+
+
+    def add(self, words, ref):
+        '''Record that each of words occurs at reference ref.'''
+        r = self.ref_id(ref)
+        ids, postings = self.__word_ids, self.__postings
+        for w in words:
+            i = ids.get(w)
+            p = self._postings(w) if i is None else postings[i]
+            # Words repeated in a verse land on the same reference.
+            if not p or p[-1] != r: p.append(r)
+
+
+    def update(self, other):
+        '''Merge the references of another concordance into this one.'''
+        refs = [self.ref_id(r) for r in other.refs]
+        for w, p in zip(other.words, other.__postings):
+            self._postings(w).extend(refs[r] for r in p)
+
+
+    def references(self, word):
+        '''Return the sorted list of reference strings word occurs at.'''
+        refs = self.refs
+        return sorted(set(refs[r] for r in self.__postings[self.__word_ids[word]]))
+
+
+    def items(self):
+        '''Iterate (word, sorted references) pairs in order of first sight.'''
+        for w in self.words:
+            yield w, self.references(w)
+
+
+    def count(self):
+        '''Return the total number of distinct word references.'''
+        return sum(len(set(p)) for p in self.__postings)
+
+
+
+def _publishable(e, props=frozenset(['publishable','vernacular'])):
+    return e is not None and props.issubset(e.meta.get('TextProperties',()))
+
+
+def book(doc, classes=None, include=_publishable, refs=None):
+    '''
+    Return the postings for a parsed USFM document, referencing each word by
+    book, chapter and verse, adding to refs if it is given.  Only text
+    directly under elements satisfying include is indexed, by default those
+    with the publishable and vernacular text properties.
+    '''
+    classes = word_classes() if classes is None else classes
+    words = classes.words
+    refs = postings() if refs is None else refs
+    add = refs.add
+    ref = [None, None, None]
+    key = None
+    stack = [iter(doc)]
+    while stack:
+        for e in stack[-1]:
+            if isinstance(e, sfm.element):
+                if   e.name == 'id': ref[0], key = unicode(e[0]).split()[0], None
+                elif e.name == 'c':  ref[1], key = e.args[0], None
+                elif e.name == 'v':  ref[2], key = e.args[0], None
+                stack.append(iter(e))
+                break
+            elif include(e.parent):
+                if key is None: key = u'{0} {1}:{2}'.format(*ref)
+                add(words(e), key)
+        else:
+            stack.pop()
+    return refs
+
+
+
+def merge(master, out, concordance, unused=None):
+    '''
+    Stream the master concordance CSV file master to out, adding any new
+    references from concordance to the words already in it and appending
+    the words that are not.  unused, if given, is called with the word and
+    row number for each master file word not in the concordance.  Returns
+    the number of words appended and of their references.  Raises
+    ValueError on a word repeated in the master file.
+    '''
+    reader = csv.DictReader(master)
+    fieldnames = reader.fieldnames or ('Word','References')
+    writer = csv.DictWriter(out, fieldnames)
+    # write out the header row
+    writer.writerow(dict(zip(fieldnames,fieldnames)))
+
+    seen = {}
+    for ln, row in enumerate(reader):
+        word = row['Word']
+        if word in seen:
+            raise ValueError('duplicates: Word "{0}" at row {1} is repeated at row {2} of master file'.format(word.encode('utf-8'),seen[word]+2,ln+2))
+        seen[word] = ln
+        if word in concordance:
+            newrefs = set(concordance.references(word))
+            oldrefs = set(r.strip() for r in row['References'].split(',') if r.strip())
+            if newrefs - oldrefs:
+                row['References'] = u', '.join(sorted(oldrefs | newrefs))
+        elif unused:
+            unused(word, ln+2)
+        writer.writerow(row)
+    # write out any new words
+    new_words = new_refs = 0
+    for w in concordance:
+        if w in seen: continue
+        r = concordance.references(w)
+        writer.writerow({'Word':w,'References':u', '.join(r)})
+        new_words += 1
+        new_refs += len(r)
+    out.flush()
+    return new_words, new_refs
@@ -0,0 +1,492 @@
+'''
+Convert the publishable vernacular text of USFM documents, as done by the
+usfmtec script: text runs are passed through an encoding converter such as
+a TECkit Converter, then through dictionary, phrase and morph replacements
+and finally sentence and title capitalisation.  All regular expressions are
+compiled once, when the transducer is made, and the replacements are looked
+up in tries built when the dictionary is loaded.
+'''
+import palaso.sfm as sfm
+from palaso.sfm import concordance
+from palaso.sfm.concordance import word_classes
+from palaso.compiled import atomic_write
+import hashlib, marshal, os, re, sys, unicodedata
+
+try:
+    unicode
+except NameError:
+    unicode = str
+
+__all__ = ('tokenizer', 'lexicon', 'notec', 'paragraph_cache', 'transducer',
+           'sfmmap')
+
+
+class tokenizer(object):
+    '''
+    Split text into alternating word and non-word runs, always starting with
+    a word, which is empty if the text starts with non-word characters.
+    Word characters are decided as for concordance.word_classes.
+
+    >>> tokenizer().tokens(u"(Don't) stop")
+    [u'', u'(', u'Don', u"'", u't', u') ', u'stop']
+    >>> tokenizer(letters=u"'").tokens(u"(Don't) stop")
+    [u'', u'(', u"Don't", u') ', u'stop']
+    '''
+    _word = re.compile(u'(w+)')
+
+    def __init__(self, letters=u'', nonletters=u''):
+        classes = word_classes(letters, nonletters)
+        sep = ord(classes.sep)
+        class mask(dict):
+            def __missing__(self, cp):
+                v = self[cp] = u'w' if classes[cp] == cp != sep else u' '
+                return v
+        self._mask = mask()
+
+
+    def isword(self, char):
+        return self._mask[ord(char)] == u'w'
+
+
+    def tokens(self, text):
+        runs = self._word.split(unicode.translate(text, self._mask))
+        res = []
+        i = 0
+        for r in runs:
+            res.append(text[i:i+len(r)])
+            i += len(r)
+        if res[0]: res.insert(0, u'')
+        else:      del res[0]
+        if len(res) > 1 and not res[-1]: del res[-1]
+        return res
+
+
+
+class _node(dict):
+    '''A trie node, mapping the next token or character to the next node.'''
+    __slots__ = ('entry',)
+
+    def __init__(self):
+        self.entry = None
+
+
+
+class lexicon(object):
+    '''
+    Dictionary, phrase and morph replacements.  Keys containing the morph
+    marker are morphs: a marker at the end makes a prefix, at the start a
+    suffix, and at both ends an infix.  Keys containing non-word characters
+    are phrases and all others are whole word dictionary entries.  An entry
+    may be limited to the text of a set of markers.
+
+    Words and phrases are kept in a trie of word and non-word tokens, so
+    the longest phrase starting at a word is found in one walk along the
+    following tokens.  Morphs are kept in a trie of case folded characters
+    and are matched from left to right, preferring the longest key, as the
+    regular expression alternation used previously would.
+
+    >>> lex = lexicon(tokenizer())
+    >>> lex.add(u'cat', u'dog')
+    >>> lex.add(u'big cat', u'lion', ['p'])
+    >>> lex.add(u'un!', u'non')
+    >>> t = tokenizer().tokens(u'a big cat undone')
+    >>> lex.replace(t, 'p'), lex.replace(t, 'q')
+    (u'a lion nondone', u'a big dog nondone')
+    '''
+    def __init__(self, tokenizer, morphid=u'!'):
+        self.tokenizer = tokenizer
+        self.morphid = morphid
+        self._words = _node()
+        self._morphs = _node()
+        self._count = self._morph_count = 0
+
+
+    def __len__(self):
+        return self._count
+
+
+    def add(self, key, value, tags=None):
+        '''Add a replacement of key by value, limited to the markers in tags
+           if given.'''
+        tags = frozenset(tags) if tags else None
+        mid = self.morphid
+        if mid in key:
+            start, end = key[0] != mid, key[-1] != mid
+            stem = key[0 if start else 1:len(key) if end else -1]
+            node = self._morphs
+            for c in stem.lower():
+                node = node.setdefault(c, _node())
+            # Entries for the same stem differ in anchoring.  Longer keys,
+            #  counting anchors, and then earlier ones win, as the order of
+            #  the alternatives in a regular expression would decide.
+            entries = node.entry = node.entry or {}
+            old = entries.get((start, end))
+            prio = old[0] if old else (-(len(stem) + start + end), self._count)
+            entries[(start, end)] = (prio, start, end, value, tags or (old and old[4]))
+        else:
+            node = self._words
+            for t in self.tokenizer.tokens(key):
+                node = node.setdefault(t, _node())
+            old = node.entry
+            node.entry = (value, tags or (old and old[1]))
+        if not old:
+            self._count += 1
+            self._morph_count += mid in key
+
+
+    def load(self, rows, incol=0, outcol=1, tagcol=None, convert=None):
+        '''Add the entries from rows of a CSV file, skipping short rows and
+           those starting with #.  Keys are passed through convert if given.'''
+        maxcol = max(incol, outcol, tagcol)
+        for e in rows:
+            if len(e) <= maxcol or (len(e[0]) and e[0][0] == '#'): continue
+            k = (convert(e[incol]) if convert else e[incol]).strip()
+            self.add(k, e[outcol].strip(),
+                     e[tagcol].split() if tagcol is not None and e[tagcol] else None)
+
+
+    def _morph(self, word, marker):
+        folded = word.lower()
+        if len(folded) != len(word): folded = word
+        morphs = self._morphs
+        res = []
+        i, n = 0, len(word)
+        last = 0
+        while i < n:
+            node, best, j = morphs, None, i
+            while j < n:
+                node = node.get(folded[j])
+                j += 1
+                if node is None: break
+                for e in (node.entry or {}).values():
+                    if ((not e[1] or i == 0) and (not e[2] or j == n)
+                          and (best is None or e[0] < best[1][0])):
+                        best = (j, e)
+            if best is None:
+                i += 1
+                continue
+            j, e = best
+            res.append(word[last:i])
+            res.append(e[3] if e[4] is None or marker in e[4] else word[i:j])
+            i = last = j
+        if not res: return word
+        res.append(word[last:])
+        return u''.join(res)
+
+
+    def replace(self, tokens, marker=None):
+        '''Apply the replacements to a list of tokens, as produced by the
+           tokenizer, returning the text.  Entries limited to a set of
+           markers only apply if marker is one of them.'''
+        words, morphs = self._words, self._morph_count
+        res = []
+        i, n = 0, len(tokens)
+        while i < n:
+            wd = tokens[i]
+            i += 1
+            if wd:
+                case = wd[0].isupper()
+                wd = wd[0].lower() + wd[1:]
+                found = []
+                node, j = words.get(wd), i
+                while node is not None:
+                    if node.entry: found.append((j, node.entry))
+                    if j == n: break
+                    node = node.get(tokens[j])
+                    j += 1
+                for j, (value, tags) in reversed(found):
+                    if tags is None or marker in tags:
+                        wd, i = value, j
+                        break
+                else:
+                    if morphs: wd = self._morph(wd, marker)
+                if case:
+                    wd = wd[:1].upper() + wd[1:]
+            res.append(wd)
+            if i < n:
+                res.append(tokens[i])
+                i += 1
+        return u''.join(res)
+
+
+
+class notec(object):
+    '''A converter that leaves text as it is.'''
+    def convert(self, txt, **kw): return txt
+
+
+
+def _code_digest():
+    '''Return a digest of the source of the code that converts paragraphs.'''
+    h = hashlib.sha1()
+    for m in (concordance, sys.modules[__name__]):
+        path = os.path.splitext(m.__file__)[0] + os.extsep + 'py'
+        with open(path if os.path.exists(path) else m.__file__, 'rb') as f:
+            h.update(f.read())
+    return h.digest()
+
+
+class paragraph_cache(object):
+    '''
+    A persistent cache of converted paragraphs, so reconverting a book after
+    a small change only converts the paragraphs that changed.  Entries are
+    keyed by a hash of the context, the paragraph's content and the
+    capitalisation state it starts in.  The context is a sequence of byte
+    strings for everything else the conversion depends on, such as the
+    mapping, dictionary and stylesheet file contents and the options used.
+
+    The source of this module and of palaso.sfm.concordance is hashed into
+    the context as well, so any change to the conversion code misses every
+    entry made before it.
+
+    The cache is read from path when made and written back by save, which
+    drops the least recently used entries once the text held exceeds size
+    characters.  hits and misses count lookups since the cache was read.
+    '''
+    version = 1
+
+    def __init__(self, path, context=(), size=1<<24):
+        self.path = path
+        self.size = size
+        self.hits = self.misses = 0
+        ctx = hashlib.sha1(str(self.version).encode('ascii'))
+        ctx.update(_code_digest())
+        for c in context:
+            ctx.update(hashlib.sha1(c).digest())
+        self._context = ctx.digest()
+        self._tick = 0
+        self._entries = {}
+        try:
+            with open(path, 'rb') as f:
+                version, self._tick, self._entries = marshal.loads(f.read())
+            if version != self.version: raise ValueError
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            self._tick, self._entries = 0, {}
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    @staticmethod
+    def _content(e, parts):
+        parts.append(u'\\{0} {1}\x00'.format(e.name, u' '.join(e.args)))
+        for c in e:
+            if isinstance(c, sfm.element): paragraph_cache._content(c, parts)
+            else:                          parts.append(c)
+        parts.append(u'\x00')
+        return parts
+
+
+    def key(self, element, caps):
+        '''Return the key for element converted starting in the
+           capitalisation state caps.'''
+        h = hashlib.sha1(self._context)
+        h.update(b'1' if caps else b'0')
+        h.update(u''.join(self._content(element, [])).encode('utf_8'))
+        return h.digest()
+
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._tick += 1
+        self._entries[key] = (self._tick,) + entry[1:]
+        return entry[1:]
+
+
+    def __setitem__(self, key, value):
+        self._tick += 1
+        self._entries[key] = (self._tick,) + tuple(value)
+
+
+    def save(self):
+        '''Write the cache back to its file, evicting the least recently
+           used entries beyond the size limit.'''
+        entries = sorted(self._entries.items(), key=lambda kv: kv[1][0], reverse=True)
+        held = 0
+        for n, (_, e) in enumerate(entries):
+            held += sum(len(t) for t in e[2]) + 32
+            if held > self.size:
+                self._entries = dict(entries[:n])
+                break
+        path = os.path.abspath(self.path)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        atomic_write(path, marshal.dumps((self.version, self._tick, self._entries)),
+                     replace=True)
+
+
+
+class transducer(object):
+    '''
+    Convert and capitalise the text of a parsed USFM document.  converter
+    is an object with a TECkit Converter like convert method and lexicon
+    the replacements applied to the converted words.  The quote and
+    punctuation sets are inserted into regular expression character
+    classes as given.  If a paragraph_cache is given, paragraphs found in
+    it are not converted again.
+    '''
+    def __init__(self, converter=notec(), lexicon=None, case=None,
+                 openquotes=u'\'"\u2018\u201c\\[{(<\u00ab',
+                 closequotes=u'\'"\u2019\u201d\\]})>\u00bb',
+                 sentencepunc=u'.!?', capitalopenquotes=None,
+                 capitaltags=(), capitalalltags=(), normalize=None,
+                 binary=False, letters=u'', cache=None):
+        self.caps = [1]
+        self.cache = cache
+        self.enc = converter
+        self.lexicon = lexicon
+        self.tokenizer = lexicon.tokenizer if lexicon else tokenizer(letters)
+        self.ctags = frozenset(capitaltags)
+        self.calltags = frozenset(capitalalltags)
+        self.normal = 'NF' + normalize.upper() if normalize else None
+        self.binary = binary
+        self.tnode = None
+
+        oq, cq, punc = openquotes, closequotes, sentencepunc
+        capquotes = capitalopenquotes if capitalopenquotes else oq
+        self._runs = re.compile(u'[^\x00-\x1f]+')
+        self._initial = re.compile(u'^([\\s' + oq + u']*)(.)')
+        self._sentence_end = re.compile(u'[{1}][{0}]*\\s*$'.format(cq, punc))
+        self._quote_end = re.compile(u'[{0}]+\\s*$'.format(cq))
+        self._nonspace = re.compile(u'^\\s*\\S')
+        self._sentence_start = re.compile(u'([{0}][{1}\\s]*[{2}\\s]*)(.)'.format(punc, cq, oq))
+        self._title_word = capquotes and re.compile(u'(^\\s*|\\s)([' + capquotes + u']*)(.)')
+        self._quote_start = capquotes and re.compile(u'(?<=[' + capquotes + u'])([' + oq + u']*)(.)')
+        self._case = case and re.compile(case)
+
+
+    def reset(self):
+        '''Forget the capitalisation state, ready for a new document.'''
+        self.caps = [1]
+        self.tnode = None
+
+
+    def element_start(self, node):
+        try:
+            if node.meta.get('StyleType') == 'Note':
+                self.caps.append(1)
+        except KeyError as e:
+            e.args = ("Element: %s at %r" % (node.name, node.pos), )
+            raise e
+        return node
+
+
+    def element_end(self, node):
+        try:
+            if node.meta.get('StyleType') == 'Note':
+                self.caps.pop()
+        except KeyError as e:
+            e.args = ("Element: %s at %r" % (node.name, node.pos), )
+            raise e
+
+
+    def convert_node(self, tnode):
+        parent = tnode.parent
+        if parent and not (set(parent.meta['TextProperties']) & set(('publishable', 'vernacular'))):
+            return tnode
+        if parent and ((parent.meta.get('StyleType') == 'Paragraph' and tnode is parent[0])
+                       or parent.name in self.ctags):
+            self.caps[-1] = 1
+        self.tnode = tnode
+        # Work on a plain string, slices of a text node are text nodes too.
+        res = self._runs.sub(self.convert, unicode(tnode))
+        if self.normal: res = unicodedata.normalize(self.normal, res)
+        return res
+
+
+    def convert(self, match):
+        input = match.group(0)
+        if self.binary: input = input.encode('latin_1')
+        res = self.enc.convert(input, finished=True)
+        if res.strip() == '': return res
+        if self.caps[-1]:
+            res = self._initial.sub(lambda m: m.group(1) + m.group(2).upper(), res, 1)
+        if self._sentence_end.search(res):
+            self.caps[-1] = 1
+        elif self._quote_end.search(res):
+            pass
+        elif self._nonspace.match(res):
+            self.caps[-1] = 0
+
+        parent = self.tnode.parent
+        marker = parent and parent.name
+        if self.lexicon:
+            res = self.lexicon.replace(self.tokenizer.tokens(res), marker)
+
+        isword = self.tokenizer.isword
+        res = self._sentence_start.sub(lambda m: m.group(1) + (m.group(2).upper() if isword(m.group(2)[0]) else m.group(2)), res)
+        if parent and (parent.meta['TextType'] == 'Title' or marker in self.calltags) and self._title_word:
+            res = self._title_word.sub(lambda m: m.group(1) + m.group(2) + (m.group(3).upper() if isword(m.group(3)[0]) else m.group(3)), res)
+        elif self._quote_start:
+            res = self._quote_start.sub(lambda m: m.group(1) + m.group(2).upper() if isword(m.group(2)[0]) else m.group(1) + m.group(2), res)
+
+        if self._case:
+            res = self._case.sub(lambda m: m.group(0)[0].upper() + m.group(0)[1:], res)
+        return res
+
+
+    def __call__(self, doc):
+        '''Convert a parsed document, returning its rebuilt tree.'''
+        return [self._map(e) for e in doc]
+
+
+    def _map(self, e):
+        if not isinstance(e, sfm.element):
+            return sfm.text(self.convert_node(e), e.pos, e)
+        key = self.cache is not None and _paragraph(e) \
+                and self.cache.key(e, self.caps[-1])
+        hit = key and self.cache.get(key)
+        e = self.element_start(e)
+        if hit:
+            self.caps[-1], texts = hit
+            _replace_text(e, iter(texts))
+        else:
+            e[0:] = [self._map(c) for c in e]
+        self.element_end(e)
+        if key and not hit:
+            self.cache[key] = (self.caps[-1], [unicode(t) for t in _text(e)])
+        return e
+
+
+
+def _paragraph(e):
+    # Paragraph level elements, but not the chapters that contain them.
+    return e.meta.get('StyleType') == 'Paragraph' and not any(
+                isinstance(c, sfm.element) and c.meta.get('StyleType') == 'Paragraph'
+                for c in e)
+
+
+def _text(e):
+    for c in e:
+        if isinstance(c, sfm.element):
+            for t in _text(c): yield t
+        else:
+            yield c
+
+
+def _replace_text(e, texts):
+    for i, c in enumerate(e):
+        if isinstance(c, sfm.element): _replace_text(c, texts)
+        else:                          e[i] = sfm.text(next(texts), c.pos, c)
+
+
+
+def sfmmap(elements, elemente, textf, doc):
+    '''Rebuild a document tree, passing each element through elements
+       before and elemente after its children are mapped, and each text
+       node through textf.'''
+    def _g(e):
+        if isinstance(e, sfm.element):
+            e = elements(e)
+            e[0:] = list(map(_g, e))
+            elemente(e)
+            return e
+        else:
+            e_ = textf(e)
+            return sfm.text(e_, e.pos, e)
+    return list(map(_g, doc))
@@ -74,6 +74,27 @@ def parse(parser,handler,source):
 
 
 
+def stream(parser, handler, source):
+    '''
+    Drive handler's start, text and end callbacks directly from the parser's
+    event stream without building a document tree first.
+    '''
+    with warnings.catch_warnings():
+        warnings.showwarning = handler.error
+        warnings.resetwarnings()
+        warnings.simplefilter("always", SyntaxWarning)
+        
+        for ev, e in parser(source).events():
+            ctag = e.parent.name if e.parent is not None else None
+            if ev == 'text':
+                handler.text(e.pos, ctag, e)
+            elif ev == 'start':
+                handler.start(e.pos, ctag, e.name, e.args)
+            else:
+                handler.end(e.pos, ctag, e.name)
+
+
+
 if __name__ == '__main__':
     import palaso.sfm.usfm as usfm
     import sys, codecs
@@ -20,13 +20,14 @@ __history__ = '''
 	20101109 - tse - Ensure cached usfm.sty is upto date after package code 
 		changes.
 '''
-import bz2, contextlib, operator, os, re, site
-import pickle
+import codecs, collections, hashlib, marshal, operator, os, re, site, sys, warnings, zlib
 import palaso.sfm.style as style
 import palaso.sfm as sfm
 from palaso.sfm import level
+from palaso.compiled import atomic_write
+from bisect import bisect_right
 from itertools import chain
-from functools import partial, reduce
+from functools import reduce
 
 try:
     from itertools import ifilter, imap
@@ -51,55 +52,92 @@ def _check_paths(pred, paths):
 def _newer(cache, benchmark):
     return os.path.getmtime(benchmark) <= os.path.getmtime(cache)
 
-def _is_fresh(cached_path, benchmarks):
-    return reduce(operator.and_, 
-                  imap(partial(_newer, cached_path), benchmarks))
+def _source_of(module):
+    path = os.path.splitext(module.__file__)[0] + os.extsep + 'py'
+    return path if os.path.exists(path) else module.__file__
 
 def _cached_stylesheet(path):
+    '''
+    Return the paths of the stylesheet source and of its cache.  The cache is
+    named for a hash of the source, the code that parses it and the marshal
+    format, so a cache that exists is up to date.
+    '''
     package_dir = os.path.dirname(__file__)
     source_path = _check_paths(os.path.exists, 
         [ os.path.join(_PALASO_DATA, path),
           os.path.join(package_dir, path)])
     
-    cached_path = os.path.normpath(os.path.join(
-                        _PALASO_DATA,
-                        path+os.extsep+'cz'))
-    if os.path.exists(cached_path):
-        import glob
-        if _is_fresh(cached_path, [source_path] 
-                + glob.glob(os.path.join(package_dir, '*.py'))):
-            return cached_path
-    else:
-        path = os.path.dirname(cached_path)
-        if not os.path.exists(path):
-            os.makedirs(path)
-    
-    import pickletools
-    with contextlib.closing(bz2.BZ2File(cached_path, 'wb')) as zf:
-        zf.write(pickletools.optimize(
-            pickle.dumps(style.parse(open(source_path,'r'), error_level=sfm.level.Marker))))
-    return cached_path
+    data = '{0} {1}.{2}'.format(marshal.version, *sys.version_info).encode('ascii')
+    for p in (source_path, _source_of(style), _source_of(style.records)):
+        with open(p, 'rb') as f:
+            data += f.read()
+    key = '{0:08x}{1:08x}'.format(zlib.crc32(data) & 0xffffffff, 
+                                  zlib.adler32(data) & 0xffffffff)
+    cached_path = os.path.normpath(os.path.join(_PALASO_DATA,
+                        os.extsep.join([path, key, 'marshal'])))
+    return source_path, cached_path
 
 
+def _write_cache(cached_path, sheet):
+    cache_dir = os.path.dirname(cached_path)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    # Write atomically, then drop caches for older versions of the source
+    # and the old compressed pickle cache.
+    atomic_write(cached_path, marshal.dumps(sheet))
+    prefix = os.path.basename(cached_path).rsplit(os.extsep, 2)[0] + os.extsep
+    for stale in os.listdir(cache_dir):
+        if stale.startswith(prefix) and stale != os.path.basename(cached_path) \
+                and (stale.endswith(os.extsep+'marshal') or stale == prefix+'cz'):
+            try:    os.unlink(os.path.join(cache_dir, stale))
+            except OSError: pass
+
 
 def _load_cached_stylesheet(path):
-    cached_path = _cached_stylesheet(path)
+    source_path, cached_path = _cached_stylesheet(path)
     try:
-        try:
-            with contextlib.closing(bz2.BZ2File(cached_path,'rb')) as sf:
-                return pickle.load(sf)
-        except:
-            os.unlink(cached_path)
-            cached_path = _cached_stylesheet(path)
-            with contextlib.closing(bz2.BZ2File(cached_path,'rb')) as sf:
-                return pickle.load(sf)
-    except:
-        os.unlink(cached_path)
-        raise
+        with open(cached_path, 'rb') as cf:
+            return marshal.loads(cf.read())
+    except (IOError, EOFError, ValueError, TypeError):
+        pass
+    sheet = style.parse(open(source_path,'r'), error_level=sfm.level.Marker)
+    try:
+        _write_cache(cached_path, sheet)
+    except (IOError, OSError):
+        pass
+    return sheet
+
+
+
+class _lazy_stylesheet(collections.Mapping):
+    '''
+    A stylesheet read from the cache the first time it is used, normally by
+    the first parser constructed, rather than when the module is imported.
+    '''
+    def __init__(self, path):
+        self.__path = path
+        self.__sheet = None
+    
+    def _sheet(self):
+        if self.__sheet is None:
+            self.__sheet = _load_cached_stylesheet(self.__path)
+        return self.__sheet
+    
+    def __getitem__(self, marker): return self._sheet()[marker]
+    def __iter__(self):            return iter(self._sheet())
+    def __len__(self):             return len(self._sheet())
+    def __contains__(self, marker): return marker in self._sheet()
+    def __repr__(self):            return repr(self._sheet())
+    def __reduce__(self):          return (dict, (self._sheet(),))
+    def get(self, marker, default=None): return self._sheet().get(marker, default)
+    def keys(self):                return self._sheet().keys()
+    def items(self):               return self._sheet().items()
+    def values(self):              return self._sheet().values()
+    def copy(self):                return self._sheet().copy()
 
 
 
-default_stylesheet=_load_cached_stylesheet('usfm.sty')
+default_stylesheet=_lazy_stylesheet('usfm.sty')
 
 
 
@@ -107,6 +145,107 @@ _default_meta = {'TextType':'Milestone', 'OccursUnder':None, 'Endmarker':None, '
 
 
 
+class reference_index(object):
+    '''
+    Map books to chapters to verses, giving the span of character offsets
+    into the source each occupies and the names of the markers it occurs
+    under.  The parser builds one as it goes, in its references attribute.
+    A span runs up to the start of the next book, chapter or verse, its end
+    is None if that is the end of the source.
+    
+    >>> p = parser([r'\\id JHN', r'\\c 3', r'\\p \\v 16 For God', r'\\v 17 For'])
+    >>> doc = list(p)
+    >>> p.references.span('JHN 3:16')
+    (14, 27)
+    >>> p.references.span('JHN 3')
+    (7, None)
+    >>> p.references.books['JHN']['chapters']['3']['verses']['17']['under']
+    [u'id', u'c', u'p']
+    '''
+    version = 2
+    _ref_re = re.compile(r'\s*(\S+)(?:\s+([^:\s]+)(?::(\S+))?)?\s*$', re.UNICODE)
+    _num_re = re.compile(r'\d+', re.UNICODE)
+    
+    def __init__(self, books=None):
+        self.books = {} if books is None else books
+        self.__open = []
+    
+    
+    def _open(self, depth, key, e):
+        '''
+        Record the start of a book (depth 0), chapter or verse at element e,
+        ending those open at the same depth or deeper.
+        '''
+        for n in self.__open[depth:]: n['span'][1] = e._pos
+        del self.__open[depth:]
+        if len(self.__open) < depth: return
+        under, a = [], e.parent
+        while a is not None:
+            under.append(unicode(a.name))
+            a = a.parent
+        under.reverse()
+        children = self.__open[-1].setdefault(('chapters','verses')[depth-1],{}) \
+                        if depth else self.books
+        node = children.setdefault(key, {'span':[e._pos, None], 'under':under})
+        self.__open.append(node)
+    
+    
+    def _verse(self, verses, verse):
+        if verse in verses: return verses[verse]
+        # Fall back to a verse range or list containing its leading number,
+        # so 16a or 16-17 find the verse 16 is in.
+        m = self._num_re.match(verse)
+        if not m: raise KeyError(verse)
+        v = int(m.group())
+        for k, n in verses.items():
+            ns = [int(x) for x in self._num_re.findall(k)]
+            if ns and ns[0] <= v <= ns[-1]: return n
+        raise KeyError(verse)
+    
+    
+    def lookup(self, ref):
+        '''
+        Return the index entry and the (book, chapter, verse) keys for a
+        reference such as 'JHN', 'JHN 3' or 'JHN 3:16'.  Raises KeyError if
+        it is not in the index.
+        '''
+        m = self._ref_re.match(ref)
+        if not m: raise KeyError(ref)
+        book, chapter, verse = m.groups()
+        node = self.books[book]
+        if chapter is not None: node = node.get('chapters',{})[chapter]
+        if verse is not None: node = self._verse(node.get('verses',{}), verse)
+        return node, (book, chapter, verse)
+    
+    
+    def span(self, ref):
+        '''Return the (start, end) character offsets of a reference.'''
+        return tuple(self.lookup(ref)[0]['span'])
+    
+    
+    def save(self, path, key=None):
+        '''
+        Write the index to path atomically, recording key, which names what
+        the parse depended on besides the source, for load to check.
+        '''
+        import json
+        data = json.dumps({'version':self.version, 'key':key, 'books':self.books})
+        atomic_write(path, data.encode('utf_8'), mode=0o644, replace=True)
+    
+    
+    @classmethod
+    def load(cls, path, key=None):
+        import json
+        with open(path, 'r') as f:
+            data = json.load(f)
+        if data.get('version') != cls.version:
+            raise ValueError('{0}: unsupported reference index version'.format(path))
+        if data.get('key') != key:
+            raise ValueError('{0}: reference index made with other parser options'.format(path))
+        return cls(data['books'])
+
+
+
 class parser(sfm.parser):
     '''
     >>> from pprint import pprint
@@ -242,6 +381,7 @@ class parser(sfm.parser):
                                default_meta=_default_meta, *args, **kwds):
         super(parser, self).__init__(source, stylesheet, default_meta,
                                      private_prefix='z',*args, **kwds)
+        self.references = reference_index()
     
     
     def _force_close(self, parent, tok):
@@ -254,6 +394,15 @@ class parser(sfm.parser):
         else: super(parser, self)._force_close(parent, tok)                          
     
     
+    def _Other_(self, parent):
+        if parent.name == 'id':
+            tok = unicode(self._tokens.peek()) if not self._exhausted() else u''
+            book = tok.split() if not tok.startswith(u'\\') else None
+            self.references._open(0, book[0] if book else u'', parent)
+        return self._default_(parent)
+    _other_ = _Other_
+    
+    
     def _ChapterNumber_(self, chapter_marker):
         tok = next(self._tokens)
         chapter = self.numeric_re.match(tok)
@@ -275,7 +424,8 @@ class parser(sfm.parser):
                 self._error(level.Structure, 'text cannot follow chapter marker \'{0}\'', tok, chapter_marker, )
                 chapter_marker.append(sfm.element(None, meta=self.default_meta, content=[tok]))
                 tok = None
-                
+        
+        self.references._open(1, chapter_marker.args[0], chapter_marker)
         return self._default_(chapter_marker)
     _chapternumber_ = _ChapterNumber_
 
@@ -299,6 +449,7 @@ class parser(sfm.parser):
         tok = tok.lstrip()
         
         if tok: self._tokens.put_back(tok)
+        self.references._open(2, verse_marker.args[0], verse_marker)
         return tuple()
     _versenumber_ = _VerseNumber_
     
@@ -306,6 +457,15 @@ class parser(sfm.parser):
     @staticmethod
     def _canonicalise_footnote(content):
         def g(e):
+            if isinstance(e, tuple):
+                # A streamed (event, node) pair: drop the \ft start and end
+                # events so its content is promoted into the note.
+                kind, e_ = e
+                if kind != 'text' and e_.name == 'ft' \
+                        and e_.parent.meta.get('StyleType') == 'Note':
+                    e_.parent.annotations['content-promoted'] = True
+                    return []
+                return [e]
             if getattr(e,'name', None) == 'ft':
                 e.parent.annotations['content-promoted'] = True
                 return e
@@ -334,6 +494,291 @@ class parser(sfm.parser):
         if tok.lstrip(): self._tokens.put_back(tok)
         return self._canonicalise_footnote(self._default_(parent))
 
+def _parse_book(path):
+    kwds = _book_parser_kwds
+    with warnings.catch_warnings(record=True) as diagnostics:
+        warnings.simplefilter('always', SyntaxWarning)
+        try:
+            with codecs.open(path, 'r', encoding=kwds['encoding']) as source:
+                doc = list(kwds['parser'](source, **kwds['options']))
+            res = kwds['transform'](doc) if kwds['transform'] else doc
+        except SyntaxError as err:
+            res = err
+    return (path, res, [(w.message, w.category, w.filename, w.lineno) 
+                            for w in diagnostics])
+
+
+def _init_book_parser(kwds):
+    global _book_parser_kwds
+    _book_parser_kwds = kwds
+
+
+def parse_many(paths, workers=None, ordered=True, transform=None,
+               parser=parser, encoding='utf_8_sig', **kwds):
+    '''
+    Parse many USFM files across a pool of worker processes, yielding 
+    (path, result) pairs in the order of paths or, if ordered is False, as
+    each book completes.  The result is the list of top level nodes, or
+    transform applied to it in the worker process when transform is given,
+    so large trees need not be sent back.  A book that fails to parse yields
+    its SyntaxError in place of a result.  SyntaxWarnings from the workers
+    are re-issued in this process with their file names and line numbers, so
+    the caller's warning filters apply to them.  Any extra keyword arguments
+    are passed on to the parser.  workers defaults to the number of CPUs, if
+    it is 0 the books are parsed in this process.
+    '''
+    options = dict(encoding=encoding, parser=parser, transform=transform,
+                   options=kwds)
+    if workers == 0:
+        _init_book_parser(options)
+        results = imap(_parse_book, paths)
+        pool = None
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(workers, _init_book_parser, (options,))
+        results = (pool.imap if ordered else pool.imap_unordered)(_parse_book, paths)
+    try:
+        for path, res, diagnostics in results:
+            for w in diagnostics:
+                warnings.warn_explicit(*w)
+            yield (path, res)
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+
+
+def _line_starts(lines):
+    table, o = [], 0
+    for l in lines:
+        table.append(o)
+        o += len(l)
+    return table
+
+
+def _fragment(lines, table, start, end):
+    '''Return the text between offsets start and end of lines as lines.'''
+    if end is None: end = table[-1] + len(lines[-1])
+    ls = bisect_right(table, start) - 1
+    le = bisect_right(table, end) - 1
+    if ls == le: return [lines[ls][start-table[ls]:end-table[ls]]]
+    frag = [lines[ls][start-table[ls]:]] + lines[ls+1:le] \
+         + [lines[le][:end-table[le]]]
+    if not frag[-1]: frag.pop()
+    return frag
+
+
+def _opens_with(line, name):
+    tag = u'\\' + name
+    return line.startswith(tag) \
+        and (len(line) == len(tag) or line[len(tag)] in u' \t\r\n\\')
+
+
+def _enclosing_units(doc, first, last, source, table):
+    '''
+    Yield (unit, following node) pairs, outermost first, for the nested
+    chapter and paragraph elements whose source text wholly contains lines
+    first to last of the old source and is bounded by unedited markers.
+    '''
+    container, following = doc, None
+    while True:
+        for i, e in enumerate(container):
+            if not isinstance(e, sfm.element) or e._lines is not table \
+                    or e.meta.get('StyleType') != 'Paragraph': 
+                continue
+            l = bisect_right(table, e._pos) - 1
+            if l > first: return
+            if l == first and not (e._pos == table[l] and l < len(source) 
+                                   and _opens_with(source[l], e.name)):
+                return
+            n = container[i+1] if i+1 < len(container) else following
+            if n is None or n._lines is table \
+                    and bisect_right(table, n._pos) - 1 >= last:
+                yield e, n
+                container, following = e, n
+                break
+        else:
+            return
+
+
+def _captures(nodes, following):
+    '''
+    Would following have been parsed into the last of nodes had they not been
+    parsed in isolation?
+    '''
+    if following is None: return False
+    if not isinstance(following, sfm.element): return True
+    under = following.meta.get('OccursUnder')
+    e = nodes[-1] if nodes else None
+    while isinstance(e, sfm.element):
+        if not under or e.name in under \
+                or e._annotations and 'implicit-closed' in e._annotations:
+            return True
+        e = e[-1] if len(e) else None
+    return False
+
+
+def _reparse_unit(unit, following, source, table, delta, parser, kwds):
+    parent = unit.parent
+    if parent is not None and parent.meta.get('Endmarker'): return None
+    start = unit._pos
+    end = following._pos + delta if following is not None else None
+    p = parser([], **kwds)
+    with warnings.catch_warnings(record=True) as diagnostics:
+        warnings.simplefilter('always', SyntaxWarning)
+        try:
+            p._fragment(_fragment(source, table, start, end), start, table)
+            nodes = list(p._default_(parent))
+        except SyntaxError:
+            return None
+    if not p._exhausted() or _captures(nodes, following): return None
+    for w in diagnostics:
+        warnings.warn_explicit(w.message, w.category, w.filename, w.lineno)
+    return nodes
+
+
+def _index(container, node):
+    return next(i for i,n in enumerate(container) if n is node)
+
+
+def _shift(nodes, delta, table):
+    for n in nodes:
+        if n._lines is table: n._pos += delta
+        if isinstance(n, sfm.element): _shift(n, delta, table)
+
+
+def reparse(doc, source, edits, parser=parser, **kwds):
+    '''
+    Bring doc, the list of top level nodes from an earlier parse, up to date
+    with source, the complete list of lines after editing, and return it.
+    edits is a sequence of (i1, i2, j1, j2) tuples saying lines i1 to i2 of
+    the old source were replaced by source[j1:j2], such as the non 'equal'
+    opcodes of difflib.SequenceMatcher.  Only the smallest chapter or
+    paragraph (any marker with a Paragraph StyleType) enclosing the edits is
+    re-parsed and spliced into the tree in place of the old one, and the
+    nodes after it have their positions moved.  If the edit changes the
+    structure around that element the enclosing elements are tried in turn,
+    and failing that the whole of source is parsed again.  Any extra keyword
+    arguments are passed on to the parser.
+    '''
+    source = list(source)
+    edits = list(edits)
+    table = doc[0]._lines if doc else None
+    if edits and table is not None:
+        first, last = min(e[0] for e in edits), max(e[1] for e in edits)
+        j1, j2 = min(e[2] for e in edits), max(e[3] for e in edits)
+        units = list(_enclosing_units(doc, first, last, source, table))
+        new = _line_starts(source)
+        delta = last < len(table) \
+            and (new[j2] - new[j1]) - (table[last] - table[first])
+        old, table[:] = table[:], new
+        try:
+            for unit, following in reversed(units):
+                nodes = _reparse_unit(unit, following, source, table, delta,
+                                      parser, kwds)
+                if nodes is None: continue
+                container = unit.parent if unit.parent is not None else doc
+                i = _index(container, unit)
+                container[i:i+1] = nodes
+                if delta:
+                    _shift(container[i+len(nodes):], delta, table)
+                    e = unit.parent
+                    while e is not None:
+                        container = e.parent if e.parent is not None else doc
+                        _shift(container[_index(container, e)+1:], delta, table)
+                        e = e.parent
+                return doc
+        except:
+            table[:] = old
+            raise
+        table[:] = old
+    doc[:] = parser(source, **kwds)
+    return doc
+
+
+def _canonical(value):
+    '''Return value with its mappings and sets as sorted lists, to repr.'''
+    if isinstance(value, collections.Mapping):
+        return sorted((_canonical(k), _canonical(v)) for k, v in value.items())
+    if isinstance(value, (set, frozenset)):
+        return sorted(_canonical(v) for v in value)
+    if isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    return value
+
+
+def _parse_key(parser, kwds):
+    '''
+    Return a hash of what parsing with parser and kwds depends on besides the
+    source: the parser class, the stylesheet and the other options.  The
+    default stylesheet is named by the key of its cache.
+    '''
+    sty = kwds.get('stylesheet', default_stylesheet)
+    sty = os.path.basename(_cached_stylesheet('usfm.sty')[1]) \
+            if sty is default_stylesheet else _canonical(sty)
+    opts = _canonical(dict((k, v) for k, v in kwds.items() if k != 'stylesheet'))
+    data = repr(('{0.__module__}.{0.__name__}'.format(parser), sty, opts))
+    return hashlib.sha1(data.encode('utf_8')).hexdigest()
+
+
+def index(path, encoding='utf_8_sig', parser=parser, **kwds):
+    '''
+    Return the reference_index for the USFM file at path.  The index is saved
+    next to the file, with an .idx extension, and read from there while it
+    is newer than the file and was made with the same parser, stylesheet and
+    options; otherwise the file is parsed, without building the tree, to
+    make it.  Any extra keyword arguments are passed on to the parser.
+    '''
+    index_path = path + os.extsep + 'idx'
+    key = _parse_key(parser, kwds)
+    if os.path.exists(index_path) and _newer(index_path, path):
+        try:
+            return reference_index.load(index_path, key)
+        except (ValueError, KeyError):
+            pass
+    with codecs.open(path, 'r', encoding=encoding) as source:
+        p = parser(source, **kwds)
+        for _ in p.events(): pass
+    try:
+        p.references.save(index_path, key)
+    except (IOError, OSError):
+        pass
+    return p.references
+
+
+def extract(path, ref, references=None, encoding='utf_8_sig', parser=parser, 
+            **kwds):
+    '''
+    Parse only the book, chapter or verse named by ref, e.g. 'JHN 3:16', from
+    the USFM file at path and return the top level nodes.  The markers the
+    reference occurs under are supplied as empty elements to hold it, so the
+    nodes have the same structure and positions as in a parse of the whole
+    file.  references is the file's reference_index, by default it is
+    obtained with index().
+    '''
+    if references is None:
+        references = index(path, encoding=encoding, parser=parser, **kwds)
+    node, (book, chapter, _) = references.lookup(ref)
+    with codecs.open(path, 'r', encoding=encoding) as source:
+        lines = list(source)
+    table = _line_starts(lines)
+    start, end = node['span']
+    p = parser([], **kwds)
+    p.source = path
+    sty = kwds.get('stylesheet', default_stylesheet)
+    parents, parent = [], None
+    for name in node['under']:
+        parent = sfm.element(name, parent=parent, meta=sty.get(name, p.default_meta),
+                             args=[chapter] if name == 'c' else [])
+        parent._pos, parent._lines = start, table
+        if parents: parents[-1].append(parent)
+        parents.append(parent)
+    p._fragment(_fragment(lines, table, start, end), start, table)
+    for e in reversed(parents):
+        e.extend(p._default_(e))
+    return parents[:1] + list(p._default_(None))
+
+
 class reference(sfm.position):
     def __new__(cls, pos, ref):
         p = super(reference,cls).__new__(cls, *pos)
@@ -151,21 +151,24 @@ class UnicodeSet(set):
         self.isclass = state
 
 
-def _expand(p, vals, ind, indval):
-    if vals[ind][indval].startswith("\\"):
-        g = p.group(int(vals[ind][indval][1]))
-        return "".join(_expand(p, vals, i, indices[i]) for i in range(g[0], g[1]))
+def _expand(p, vals, indices, ind):
+    if vals[ind][indices[ind]].startswith("\\"):
+        g = p.groups[int(vals[ind][indices[ind]][1]) - 1]
+        return "".join(_expand(p, vals, indices, i) for i in range(g[0], g[1]))
     else:
-        return vals[ind][indval]
+        return vals[ind][indices[ind]]
 
 
 def flatten(s):
     p = parse(s)
-    vals = map(sorted, p)
-    lens = map(len, vals)
+    vals = [sorted(x) for x in p]
+    lens = [len(x) for x in vals]
     num = len(vals)
+    if not num or 0 in lens:
+        return
     indices = [0] * num
     while True:
+        yield u"".join(_expand(p, vals, indices, i) for i in range(num))
         for i in range(num):
             if indices[i] == lens[i] - 1:
                 indices[i] = 0
@@ -174,8 +177,6 @@ def flatten(s):
                 break
         else:
             return
-        res = []
-        yield u"".join(_expand(p, vals, i, x) for i, x in enumerate(indices))
 
 
 def struni(s, groups=None):
@@ -3,11 +3,12 @@
 # Py2 and Py3 compatibility
 from __future__ import print_function
 
-import re, copy, os
+import re, os
 import unicodedata as ud
 from math import log10
 from itertools import groupby
 from difflib import SequenceMatcher
+from palaso.sldr.ducet import loadDucet
 
 def escape(s):
     '''Turn normal Unicode into escaped tailoring syntax'''
@@ -40,22 +41,67 @@ def unescape(s):
 def ducetSortKey(d, k, extra=None):
     '''Turn a sequence of sort keys for the given string into a single
         sort key.'''
-    res = [[], [], []]
-    i = len(k)
-    while i > 0:
-        try:
-            if extra and k[:i] in extra:
-                key = extra[k[:i]].key
+    return SortKeys(d)(k, extra)
+
+class SortKeys(object):
+    '''Makes sort keys by longest match against a DUCET and the tailored
+        elements of a Collation, caching the keys made from the DUCET alone.
+        A key is a list of the primary, secondary and tertiary weight lists,
+        which compare natively.'''
+
+    def __init__(self, ducet):
+        self.ducet = ducet
+        self.cache = {}
+        # the DUCET match for characters that start no longer DUCET key
+        self.chars = {}
+
+    def _ducetmatch(self, k, start):
+        '''Returns the length and primary, secondary and tertiary weights of the
+            longest DUCET key at start in k'''
+        res = self.chars.get(k[start])
+        if res is not None:
+            return res
+        longest = getattr(self.ducet, 'longest', None)
+        if longest is not None:
+            l, node = longest(k, start)
+            res = (l, tuple(zip(*self.ducet.elements(node))) or ((), (), ())) if l else (0, None)
+            if l == 1 and self.ducet.isleaf(node):
+                self.chars[k[start]] = res
+            return res
+        for i in range(len(k), start, -1):
+            if k[start:i] in self.ducet:
+                return (i - start, tuple(zip(*self.ducet[k[start:i]])) or ((), (), ()))
+        return (0, None)
+
+    def __call__(self, k, extra=None):
+        if extra:
+            return self._key(k, extra)
+        res = self.cache.get(k)
+        if res is None:
+            res = self.cache[k] = self._key(k, None)
+        return res
+
+    def _key(self, k, extra):
+        res = [[], [], []]
+        i = 0
+        n = len(k)
+        maxlen = getattr(extra, 'maxkeylen', n) if extra else 0
+        while i < n:
+            l, weights = self._ducetmatch(k, i)
+            # A tailored element as long as the DUCET match takes precedence
+            for j in range(min(n - i, maxlen), max(l, 1) - 1, -1):
+                if k[i:i+j] in extra:
+                    weights = extra[k[i:i+j]].key
+                    l = j
+                    break
             else:
-                key = zip(*d[k[:i]])
-        except KeyError:
-            i -= 1
-            continue
-        key_list = list(key)
-        res = [res[j] + list(key_list[j]) for j in range(3)]
-        k = k[i:]
-        i = len(k)
-    return res
+                if not l:
+                    break
+            res[0].extend(weights[0])
+            res[1].extend(weights[1])
+            res[2].extend(weights[2])
+            i += l
+        return res
 
 def filtersame(dat, level):
     '''A kind of groupby, return first of every sequence with the sortkey
@@ -80,35 +126,13 @@ def makegroupdict(dat, keyfunc):
         res[d[0][0]] = d
     return res
 
-__moduleDucet__ = None  # cache the default ducet
 def readDucet(path="") :
     if not path:
-        global __moduleDucet__
-        if __moduleDucet__ is not None:
-            return __moduleDucet__
-        ducetpath = os.path.join(os.path.abspath(os.path.dirname(__file__)), "allkeys.txt")
-    else:
-        ducetpath = path
+        path = os.path.join(os.path.abspath(os.path.dirname(__file__)), "allkeys.txt")
+    return loadDucet(path)
 
-    result = {}
-    keyre = re.compile(r'([0-9A-F]{4})', re.I)
-    valre = re.compile(r'\[[.*]([0-9A-F]{4})\.([0-9A-F]{4})\.([0-9A-F]{4})\]', re.I)
-
-    try :
-        with open(ducetpath, 'r') as f :
-            for contentLine in f.readlines():
-                parts = contentLine.split(';')
-                if len(parts) != 2:
-                    continue
-                key = u"".join(unichr(int(x, 16)) for x in keyre.findall(parts[0]))
-                vals = valre.findall(parts[1])
-                result[key] = tuple(tuple(int(x, 16) for x in v) for v in vals)
-    except :
-        print("ERROR: unable to read DUCET data in allkeys.txt")
-        return {}
-    if not path:
-        __moduleDucet__ = result
-    return result
+def _copykey(key):
+    return [list(x) if isinstance(x, list) else x for x in key]
 
 class Collation(dict):
 
@@ -116,6 +140,8 @@ class Collation(dict):
         if ducetDict is None:
             ducetDict = readDucet()
         self.ducet = ducetDict
+        self.sortkeys = SortKeys(ducetDict)
+        self.maxkeylen = 0
 
     def parse(self, string):
         """Parse LDML/ICU sort tailoring"""
@@ -152,6 +178,7 @@ class Collation(dict):
     def __setitem__(self, key, val):
         if key in self:
             raise KeyError(u"key {} already exists in collation with value {}".format(key, self[key]))
+        self.maxkeylen = max(self.maxkeylen, len(key))
         dict.__setitem__(self, key, val)
 
     def _setSortKeys(self):
@@ -220,8 +247,8 @@ class Collation(dict):
             strings in alphabet (e.g. main+aux exemplars)'''
         self._setSortKeys()
         # create (k, sortkey(k)) for the alphabet from the ducet and from the tailored
-        base = sorted([(x, ducetSortKey(self.ducet, x)) for x in alphabet if x in self.ducet], key=lambda x: x[1])
-        this = sorted([(x, ducetSortKey(self.ducet, x, extra=self)) for x in alphabet], key=lambda x: x[1])
+        base = sorted([(x, self.sortkeys(x)) for x in alphabet if x in self.ducet], key=lambda x: x[1])
+        this = sorted([(x, self.sortkeys(x, extra=self)) for x in alphabet], key=lambda x: x[1])
         # strip down to only primary orders
         basep = filtersame(base, 1)
         thisp = filtersame(this, 1)
@@ -270,23 +297,26 @@ class CollElement(object):
     def sortkey(self, collations, ducetDict, inc):
         if hasattr(self, 'key'):
             return self.key
-        self.key = ducetSortKey(ducetDict, self.base)   # stop lookup loops
+        keys = getattr(collations, 'sortkeys', None)
+        if keys is None or keys.ducet is not ducetDict:
+            keys = SortKeys(ducetDict)
+        self.key = keys(self.base)   # stop lookup loops
         b = collations.get(self.base, None)
         if b is not None and b.order <= self.order:
             b.sortkey(collations, ducetDict, inc)
-            basekey = copy.deepcopy(b.shortkey)
+            basekey = _copykey(b.shortkey)
         else:
-            basekey = copy.deepcopy(self.key)
+            basekey = _copykey(self.key)
         if self.level < 4 :
             basekey[self.level-1][-1] += inc
         if not self.exp and b is not None and b.exp:
             self.exp = b.exp
         if self.exp:
-            expkey = ducetSortKey(ducetDict, self.exp, extra=collations)
+            expkey = keys(self.exp, extra=collations)
             if expkey > basekey:
-                self.shortkey = copy.deepcopy(expkey) + [1]
+                self.shortkey = _copykey(expkey) + [1]
             else:
-                self.shortkey = copy.deepcopy(basekey)
+                self.shortkey = _copykey(basekey)
             basekey = [basekey[i] + expkey[i] for i in range(3)]
         else:
             self.shortkey = basekey
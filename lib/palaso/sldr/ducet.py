@@ -3,20 +3,34 @@
 # Py2 and Py3 compatibility
 from __future__ import print_function
 
-import os, re
+import array, bisect, os, re, struct, sys
+from palaso.compiled import array_at, compiled_paths, load_table, tobytes
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+try:
+    unichr
+except NameError:
+    unichr = chr
 
 
 # Read the DUCET file and return a corresponding data structure.
 def readDucet(path="") :
 
     ducetFilename = os.path.abspath(os.path.dirname(__file__) + path + "/allkeys.txt")
+    return loadDucet(ducetFilename)
+
+# end of readDucet
 
-    try :
-        with open(ducetFilename, 'r') as f :
-            content = f.readlines()
-    except :
-        print("ERROR: unable to read DUCET data in allkeys.txt")
-        return {}
+
+def parseDucet(ducetFilename) :
+    """Parse allkeys.txt into a dict of key string to a tuple of
+    (primary, secondary, tertiary) collation elements."""
+    with open(ducetFilename, 'r') as f :
+        content = f.readlines()
 
     result = {}
     keyre = re.compile(r'([0-9A-F]{4})', re.I)
@@ -29,10 +43,8 @@ def readDucet(path="") :
         if len(parts) != 2:
             continue
 
-        ####if lineno < 9500 or lineno > 10000: continue
-
         try:
-            key = u"".join(chr(int(x, 16)) for x in keyre.findall(parts[0]))
+            key = u"".join(unichr(int(x, 16)) for x in keyre.findall(parts[0]))
             vals = valre.findall(parts[1])
             result[key] = tuple(tuple(int(x, 16) for x in v) for v in vals)
         except:
@@ -40,7 +52,172 @@ def readDucet(path="") :
 
     return result
 
-# end of readDucet
+
+# The compiled table is a header followed by arrays of native unsigned ints:
+#   node_edges  nnodes+1  start of each trie node's edges, which run to the next's
+#   node_ces    nnodes+1  start of each node's collation elements, likewise
+#   edge_chars  nedges    codepoint of each edge, sorted within a node
+#   edge_nodes  nedges    node each edge leads to
+# then nces*3 unsigned shorts of primary, secondary and tertiary weights and
+# nnodes bytes, 1 for the nodes that end a key. Node 0 is the root.
+_magic = b'DUCT'
+_version = 1
+_header = struct.Struct('=4sBBHQdIII')
+
+
+def compileDucet(ducet, stat=(0, 0)):
+    """Return the compiled binary form of a DUCET dict as returned by
+    parseDucet(). stat is the (size, mtime) of the source file."""
+    # Build the trie as nested dicts of child nodes, then number the nodes
+    # breadth first so each node's children are together.
+    root = {}
+    ends = {}
+    for key, ces in ducet.items():
+        node = root
+        for c in key:
+            node = node.setdefault(ord(c), {})
+        ends[id(node)] = ces
+    nodes = [root]
+    node_edges = array.array('I', [0])
+    node_ces = array.array('I', [0])
+    edge_chars = array.array('I')
+    edge_nodes = array.array('I')
+    weights = array.array('H')
+    flags = array.array('B')
+    for node in nodes:
+        for c in sorted(node.keys()):
+            edge_chars.append(c)
+            edge_nodes.append(len(nodes))
+            nodes.append(node[c])
+        node_edges.append(len(edge_chars))
+        ces = ends.get(id(node))
+        flags.append(ces is not None)
+        for ce in ces or ():
+            weights.extend(ce)
+        node_ces.append(len(weights) // 3)
+    header = _header.pack(_magic, _version, len(sys.byteorder), 0, stat[0], stat[1],
+                          len(nodes), len(edge_chars), len(weights) // 3)
+    return b''.join([header] + [tobytes(a) for a in (node_edges, node_ces, edge_chars,
+                                                     edge_nodes, weights, flags)])
+
+
+class DucetTable(Mapping):
+    """Read only dict of DUCET key strings to a tuple of (primary, secondary,
+    tertiary) collation elements, read directly from a compiled table."""
+
+    def __init__(self, buf):
+        (magic, version, order, _, self.size, self.mtime, nnodes, nedges, nces) \
+                = _header.unpack_from(buf, 0)
+        if magic != _magic or version != _version or order != len(sys.byteorder):
+            raise ValueError("Not a compiled DUCET table")
+        self._buf = buf
+        offset = _header.size
+        self._node_edges = array_at(buf, offset, 'I', nnodes + 1)
+        offset += 4 * (nnodes + 1)
+        self._node_ces = array_at(buf, offset, 'I', nnodes + 1)
+        offset += 4 * (nnodes + 1)
+        self._edge_chars = array_at(buf, offset, 'I', nedges)
+        offset += 4 * nedges
+        self._edge_nodes = array_at(buf, offset, 'I', nedges)
+        offset += 4 * nedges
+        self._weights = array_at(buf, offset, 'H', 3 * nces)
+        offset += 6 * nces
+        self._flags = array_at(buf, offset, 'B', nnodes)
+        self._len = None
+        self._cache = {}
+
+    def child(self, node, char):
+        """Return the node reached from node by codepoint char, or 0 if none."""
+        lo = self._node_edges[node]
+        hi = self._node_edges[node + 1]
+        i = bisect.bisect_left(self._edge_chars, char, lo, hi)
+        if i < hi and self._edge_chars[i] == char:
+            return self._edge_nodes[i]
+        return 0
+
+    def elements(self, node):
+        """Return the collation elements of the key ending at node."""
+        s = self._node_ces[node]
+        e = self._node_ces[node + 1]
+        w = self._weights
+        return tuple((w[3*i], w[3*i+1], w[3*i+2]) for i in range(s, e))
+
+    def isend(self, node):
+        return self._flags[node] != 0
+
+    def isleaf(self, node):
+        """True if no longer key continues the key ending at node."""
+        return self._node_edges[node] == self._node_edges[node + 1]
+
+    def _find(self, key):
+        node = 0
+        for c in key:
+            node = self.child(node, ord(c))
+            if not node:
+                return 0
+        return node if self._flags[node] else 0
+
+    def longest(self, text, start=0):
+        """Return the length and node of the longest key that text has at start,
+        or (0, 0) if none."""
+        node = 0
+        res = (0, 0)
+        for i in range(start, len(text)):
+            node = self.child(node, ord(text[i]))
+            if not node:
+                break
+            if self._flags[node]:
+                res = (i + 1 - start, node)
+        return res
+
+    def __getitem__(self, key):
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+        node = self._find(key)
+        if not node:
+            raise KeyError(key)
+        res = self._cache[key] = self.elements(node)
+        return res
+
+    def __contains__(self, key):
+        return key in self._cache or self._find(key) != 0
+
+    def __len__(self):
+        if self._len is None:
+            self._len = sum(1 for f in self._flags if f)
+        return self._len
+
+    def __iter__(self):
+        stack = [(0, u"")]
+        while stack:
+            node, key = stack.pop()
+            if self._flags[node]:
+                yield key
+            for i in range(self._node_edges[node + 1] - 1, self._node_edges[node] - 1, -1):
+                stack.append((self._edge_nodes[i], key + unichr(self._edge_chars[i])))
+
+
+_tables = {}
+def loadDucet(ducetFilename):
+    """Return a DucetTable of the given allkeys.txt, shared by everything that
+    loads it. The table is compiled on first use and kept on disk, to be
+    memory mapped by later processes until allkeys.txt changes."""
+    ducetFilename = os.path.abspath(ducetFilename)
+    if ducetFilename in _tables:
+        return _tables[ducetFilename]
+    try:
+        st = os.stat(ducetFilename)
+        stat = (st.st_size, float(st.st_mtime))
+        res = load_table(compiled_paths((ducetFilename,), 'ducet'), DucetTable,
+                         lambda t: (t.size, t.mtime) == stat,
+                         lambda: compileDucet(parseDucet(ducetFilename), stat))
+    except (IOError, OSError):
+        print("ERROR: unable to read DUCET data in allkeys.txt")
+        return {}
+    _tables[ducetFilename] = res
+    return res
 
 
 def ducetCompare(ducetDict, str1, str2) :
@@ -25,10 +25,11 @@
 from __future__ import print_function
 from xml.etree import ElementTree as et
 from xml.etree import ElementPath as ep
-import re, os, codecs
+import re, os, codecs, io, marshal, sys
 import xml.parsers.expat
 from functools import reduce
 from six import string_types
+from palaso.compiled import atomic_write
 from .py3xmlparser import XMLParser, TreeBuilder
 
 _elementprotect = {
@@ -37,6 +38,9 @@ _elementprotect = {
     '>': '&gt;' }
 _attribprotect = dict(_elementprotect)
 _attribprotect['"'] = '&quot;'
+_protectres = {
+    id(_elementprotect): re.compile(u'[&<>]'),
+    id(_attribprotect): re.compile(u'[&<>"]') }
 
 class ETWriter(object):
     """ General purpose ElementTree pretty printer complete with options for attribute order
@@ -67,7 +71,10 @@ class ETWriter(object):
             return (tag, None, None)
 
     def _protect(self, txt, base=_attribprotect):
-        return re.sub(u'['+u"".join(base.keys())+u"]", lambda m: base[m.group(0)], txt)
+        r = _protectres.get(id(base))
+        if r is None:
+            r = re.compile(u'['+u"".join(base.keys())+u"]")
+        return r.sub(lambda m: base[m.group(0)], txt) if r.search(txt) else txt
 
     def _nsprotectattribs(self, attribs, localattribs, namespaces):
         if attribs is not None:
@@ -83,54 +90,118 @@ class ETWriter(object):
             return self.attributeOrder.get(n.tag, {}).get(x, self.maxAts)
         return sorted((attribs if attribs is not None else n.keys()), key=lambda x:(getorder(x), x))
 
-    def serialize_xml(self, write, base = None, indent = '', topns = True, namespaces = {}):
+    def _serial_children(self, n):
+        """Returns the children of n to serialise, called before n is written"""
+        return list(n)
+
+    def serialize_xml(self, write, base = None, indent = '', topns = True, namespaces = {}, chunksize = 1 << 16):
         """Output the object using write() in a normalised way:
-                topns if set puts all namespaces in root element else put them as low as possible"""
+                topns if set puts all namespaces in root element else put them as low as possible
+                Output is collected and passed to write() in pieces of about chunksize characters"""
+        buf = []
+        size = [0]
+        def out(s):
+            buf.append(s)
+            size[0] += len(s)
+            if size[0] >= chunksize:
+                write(u"".join(buf))
+                del buf[:]
+                size[0] = 0
         if base is None:
             base = self.root
-            write('<?xml version="1.0" encoding="utf-8"?>\n')
-        (tag, q, ns) = self._localisens(base.tag)
-        localattribs = {}
-        if ns and ns not in namespaces:
-            namespaces[ns] = q
-            localattribs['xmlns:'+q] = ns
-        if topns:
-            if base == self.root:
-                for n,q in self.namespaces.items():
-                    localattribs['xmlns:'+q] = n
-                    namespaces[n] = q
-        else:
-            for c in base:
-                (lt, lq, lns) = self._localisens(c.tag)
-                if lns and lns not in namespaces:
-                    namespaces[lns] = q
+            out('<?xml version="1.0" encoding="utf-8"?>\n')
+        self._serialize(out, base, indent, topns, namespaces)
+        if buf:
+            write(u"".join(buf))
+
+    def save(self, fname, topns = True):
+        """Serialise the whole tree as UTF-8 to the named file or a binary file object"""
+        fh = open(fname, 'wb') if isinstance(fname, string_types) else fname
+        try:
+            self.serialize_xml(lambda s: fh.write(s.encode('utf-8')), topns=topns, namespaces={})
+        finally:
+            if fh is not fname:
+                fh.close()
+
+    def _serialize(self, write, base, indent, topns, namespaces):
+        """Writes base and its descendents. The namespaces declared in scope are
+            kept in a single set, undoing each element's additions after it is
+            written, rather than in a copy of namespaces for each element."""
+        localisens = self._localisens
+        sortedattrs = self._sortedattrs
+        takesCData = self.takesCData
+        eprotect = _protectres[id(_elementprotect)]
+        aprotect = _protectres[id(_attribprotect)]
+        names = {}
+        def localise(tag):
+            res = names.get(tag)
+            if res is None:
+                res = localisens(tag)
+                if res[2] is None or self.namespaces.get(res[2]):   # unknown namespaces are numbered on each use
+                    names[tag] = res
+            return res
+        def protect(r, txt, base):
+            return r.sub(lambda m: base[m.group(0)], txt) if r.search(txt) else txt
+
+        def element(base, indent, declared, top=False):
+            children = self._serial_children(base)
+            (tag, q, ns) = localise(base.tag)
+            localattribs = {}
+            added = []
+            if ns and ns not in declared:
+                added.append(ns)
+                localattribs['xmlns:'+q] = ns
+            if topns:
+                if base is self.root:
+                    for n, lq in self.namespaces.items():
+                        localattribs['xmlns:'+lq] = n
+                        if n not in declared and n not in added:
+                            added.append(n)
+            else:
+                for c in children:
+                    (lt, lq, lns) = localise(c.tag)
+                    if lns and lns not in declared and lns not in added:
+                        added.append(lns)
+                        localattribs['xmlns:'+lq] = lns
+            for k, v in base.attrib.items():
+                (lt, lq, lns) = localise(k)
+                if lns and lns not in declared and lns not in added:
+                    added.append(lns)
                     localattribs['xmlns:'+lq] = lns
-        self._nsprotectattribs(getattr(base, 'attrib', None), localattribs, namespaces)
-        for c in getattr(base, 'comments', []):
-            write(u'{}<!--{}-->\n'.format(indent, c))
-        write(u'{}<{}'.format(indent, tag))
-        if len(localattribs):
-            def getorder(x):
-                return self.attributeOrder.get(tag, {}).get(x, self.maxAts)
-            def cmpattrib(x, y):
-                return cmp(getorder(x), getorder(y)) or cmp(x, y)
-            for k in self._sortedattrs(base, localattribs):
-                write(u' {}="{}"'.format(self._localisens(k)[0], self._protect(localattribs[k])))
-        if len(base):
-            write('>\n')
-            for b in base:
-                self.serialize_xml(write, base=b, indent=indent + self.indent, topns=topns, namespaces=namespaces.copy())
-            write('{}</{}>\n'.format(indent, tag))
-        elif base.text:
-            if tag not in self.takesCData:
-                t = self._protect(base.text.replace('\n', '\n' + indent), base=_elementprotect)
+                localattribs[lt] = v
+            declared.update(added)
+            if top:
+                for n in added:
+                    namespaces[n] = q
+            for c in getattr(base, 'comments', []):
+                write(u'%s<!--%s-->\n' % (indent, c))
+            write(u'%s<%s' % (indent, tag))
+            if len(localattribs) == 1:
+                for k, v in localattribs.items():
+                    write(u' %s="%s"' % (k, protect(aprotect, v, _attribprotect)))
+            elif localattribs:
+                write(u"".join([u' %s="%s"' % (k, protect(aprotect, localattribs[k], _attribprotect))
+                                    for k in sortedattrs(base, localattribs)]))
+            if children:
+                write('>\n')
+                cindent = indent + self.indent
+                for b in children:
+                    element(b, cindent, declared)
+                write(u'%s</%s>\n' % (indent, tag))
+            elif base.text:
+                if tag not in takesCData:
+                    t = protect(eprotect, base.text.replace('\n', '\n' + indent), _elementprotect)
+                else:
+                    t = "<![CDATA[\n\t" + indent + base.text.replace('\n', '\n\t' + indent) + "\n" + indent + "]]>"
+                write(u'>%s</%s>\n' % (t, tag))
             else:
-                t = "<![CDATA[\n\t" + indent + base.text.replace('\n', '\n\t' + indent) + "\n" + indent + "]]>"
-            write(u'>{}</{}>\n'.format(t, tag))
-        else:
-            write('/>\n')
-        for c in getattr(base, 'commentsafter', []):
-            write(u'{}<!--{}-->\n'.format(indent, c))
+                write('/>\n')
+            for c in getattr(base, 'commentsafter', []):
+                write(u'%s<!--%s-->\n' % (indent, c))
+            declared.difference_update(added)
+
+        # Declarations made by the top element are also left in namespaces
+        element(base, indent, set(namespaces), True)
 
     def add_namespace(self, q, ns):
         if ns in self.namespaces: return self.namespaces[ns]
@@ -254,6 +325,77 @@ class _arrayDict(dict):
         if not len(self[k]): del self[k]
         
 
+def _hashindex(nodes):
+    """Index nodes by attrHash, each entry in document order"""
+    res = _arrayDict()
+    for n in nodes:
+        res.set(n.attrHash, n)
+    return res
+
+
+class _Element(getattr(et, '_Element_Py', et.Element)):
+    """ An element of an Ldml tree, which keeps the index of its children by
+        attrHash that _childindex() builds. Appending a child adds it to the
+        index, any other change to the children drops the index and any
+        change to the hashes of an element in a tree drops them all. """
+    hashes = 0          # bumped by Ldml._calc_hashes() for elements in a tree
+
+    def _changed(self):
+        self.__dict__.pop('_childindex', None)
+
+    def append(self, element):
+        super(_Element, self).append(element)
+        index = self.__dict__.get('_childindex')
+        if index is not None:
+            if hasattr(element, 'attrHash'):
+                index.set(element.attrHash, element)
+            else:
+                self._changed()
+
+    def extend(self, elements):
+        super(_Element, self).extend(elements)
+        self._changed()
+
+    def insert(self, index, element):
+        super(_Element, self).insert(index, element)
+        self._changed()
+
+    def remove(self, element):
+        super(_Element, self).remove(element)
+        self._changed()
+
+    def __setitem__(self, index, element):
+        super(_Element, self).__setitem__(index, element)
+        self._changed()
+
+    def __delitem__(self, index):
+        super(_Element, self).__delitem__(index)
+        self._changed()
+
+    def clear(self):
+        super(_Element, self).clear()
+        self._changed()
+
+
+def _append(node, child, index):
+    """Append child to node, adding it to index, the index of the children of node"""
+    node.append(child)
+    if node.__dict__.get('_childindex') is not index:
+        index.set(child.attrHash, child)
+
+
+def _childindex(node):
+    """Index the children of node by attrHash, each entry in document order, reusing
+        the index node keeps if it is an _Element whose children are unchanged"""
+    res = node.__dict__.get('_childindex') if isinstance(node, _Element) else None
+    if res is None or res.hashes != _Element.hashes:
+        res = _hashindex(node)
+        res.hashes = _Element.hashes
+        if isinstance(node, _Element):
+            node._childindex = res
+    return res
+
+
 class _minhash(object):
     _maxbits = 56
     _bits = 4
@@ -298,6 +440,60 @@ class _minhash(object):
         return res
 
 
+def _hash_salt():
+    """Identifies the string hashing of this process, which _minhash uses"""
+    return hash(u'palaso.sldr.ldml')
+
+
+class LdmlCache(object):
+    """ An on-disk cache of parsed and normalised LDML trees, one marshal file per
+        source file keyed by a hash of its content, the drafts setting and the code
+        and DTD that order the tree. Pass one to Ldml() or flattenlocale() to use it. """
+    version = 1
+
+    def __init__(self, path):
+        import hashlib
+        self.path = path
+        self.hits = self.misses = 0
+        context = hashlib.sha1('{0} {1} {2}.{3}'.format(self.version, marshal.version,
+                                    *sys.version_info[:2]).encode('ascii'))
+        for f in (os.path.splitext(__file__)[0] + '.py', os.path.join(os.path.dirname(__file__), 'ldml.dtd')):
+            if os.path.exists(f):
+                with open(f, 'rb') as fh:
+                    context.update(fh.read())
+        self._context = context
+
+    def __reduce__(self):
+        return (self.__class__, (self.path,))
+
+    def key(self, data, usedrafts):
+        h = self._context.copy()
+        h.update(b'd' if usedrafts else b'-')
+        h.update(data)
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.path, key + os.extsep + 'marshal')
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as fh:
+                res = marshal.loads(fh.read())
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return res
+
+    def __setitem__(self, key, entry):
+        try:
+            if not os.path.exists(self.path):
+                os.makedirs(self.path)
+            atomic_write(self._path(key), marshal.dumps(entry))
+        except (IOError, OSError):
+            pass
+
+
 class Ldml(ETWriter):
     takesCData = set(('cr',))
     silns = "urn://www.sil.org/ldml/0.1"
@@ -413,7 +609,7 @@ class Ldml(ETWriter):
         cls.maxEls = elementCount[0] + 1
         cls.maxAts = max(attribCount.values()) + 1
 
-    def __init__(self, fname, usedrafts=True):
+    def __init__(self, fname, usedrafts=True, cache=None):
         if not hasattr(self, 'elementOrder'):
             self.__class__.ReadMetadata()
         self.namespaces = {}
@@ -423,7 +619,7 @@ class Ldml(ETWriter):
         comments = []
 
         if fname is None:
-            self.root = getattr(et, '_Element_Py', et.Element)('ldml')
+            self.root = _Element('ldml')
             self.root.document = self
             self.default_draft = 'unconfirmed'
             return
@@ -432,10 +628,18 @@ class Ldml(ETWriter):
             fh = open(self.fname, 'rb')     # expat does utf-8 decoding itself. Don't do it twice
         else:
             fh = fname
-        if hasattr(et, '_Element_Py'):
-            tb = TreeBuilder(element_factory=et._Element_Py)
-        else:
-            tb = TreeBuilder()
+        if cache is not None:
+            data = fh.read()
+            fh.close()
+            if not isinstance(data, bytes):
+                data = data.encode('utf-8')
+            key = cache.key(data, usedrafts)
+            entry = cache.get(key)
+            if entry is not None:
+                self._restore(entry, usedrafts)
+                return
+            fh = io.BytesIO(data)
+        tb = TreeBuilder(element_factory=_Element)
         parser = XMLParser(target=tb, encoding="UTF-8")
         def doComment(data):
             # resubmit as new start tag=!-- and sort out in main loop
@@ -468,7 +672,96 @@ class Ldml(ETWriter):
                 curr = getattr(elem, 'parent', None)
         fh.close()
         self.analyse()
-        self.normalise(self.root, usedrafts=usedrafts)
+        if cache is None:
+            self.normalise(self.root, usedrafts=usedrafts)
+            return
+        # Entries hold the ordered tree before its alternates are packed, so
+        # that the hashes can be recalculated in processes whose string hash
+        # salt differs from the one that wrote it.
+        self.normalise(self.root, addguids=False)
+        tree = self._rehash(self.root, usedrafts, record=True)
+        cache[key] = (self.namespaces, self.default_draft, self.uid, _hash_salt(), tree)
+
+    def _rehash(self, base, usedrafts, record=False):
+        """Hash an already ordered tree and pack up its alternates, as normalise()
+            does, optionally returning it as nested tuples for an LdmlCache"""
+        children = [self._rehash(b, usedrafts, record) for b in base]
+        self._calc_hashes(base, usedrafts=usedrafts)
+        if record:
+            comments, commentsafter = (getattr(base, a, None) for a in ('comments', 'commentsafter'))
+            res = (base.tag, dict(base.attrib), base.text, tuple(children),
+                   comments and tuple(comments), commentsafter and tuple(commentsafter),
+                   base.contentHash.hashed, base.attrHash.hashed)
+        else:
+            res = None
+        if usedrafts:
+            self._pack_alternates(base)
+        return res
+
+    def _unpack(self, entry, usedrafts, hashed, parent=None):
+        tag, attrib, text, children, comments, commentsafter, content, key = entry
+        e = _Element(tag, attrib)
+        e.text = text
+        e.document = self
+        if parent is not None:
+            e.parent = parent
+        if comments is not None:
+            e.comments = list(comments)
+        if commentsafter is not None:
+            e.commentsafter = list(commentsafter)
+        if children:
+            e.extend([self._unpack(c, usedrafts, hashed, e) for c in children])
+        if hashed:
+            e.entry = entry
+            e.contentHash = _minhash(nominhash = True)
+            e.contentHash.hashed = content
+            e.attrHash = _minhash(nominhash = True)
+            e.attrHash.hashed = key
+            if usedrafts and children:
+                self._pack_alternates(e)
+        return e
+
+    def _restore(self, entry, usedrafts):
+        self.namespaces, self.default_draft, self.uid, salt, tree = entry
+        hashed = salt == _hash_salt()
+        self.root = self._unpack(tree, usedrafts, hashed)
+        if not hashed:
+            self._rehash(self.root, usedrafts)
+
+    def _pack(self, usedrafts):
+        """Returns this tree as an LdmlCache entry, as _rehash() records it, so that
+            a tree changed by one overlay() can be restored. Elements restored from
+            an entry are recorded as that entry unless they have changed, which
+            elements of other documents appended by overlay() have not, and only
+            changed elements are rehashed."""
+        def record(base):
+            entry = getattr(base, 'entry', None)
+            if entry is not None and getattr(base, 'document', self) is not self:
+                return entry
+            children = []
+            for c in list(base):
+                children.append(record(c))
+                alternates = getattr(c, 'alternates', {})
+                children.extend(record(alternates[a]) for a in sorted(alternates))
+            if entry is not None and base.text == entry[2] and base.attrib == entry[1] \
+                    and len(children) == len(entry[3]) and all(a is b for a, b in zip(children, entry[3])):
+                return entry
+            if getattr(base, 'document', self) is self:
+                # rehash with the alternates among the children, as normalise() does
+                for c in list(base):
+                    alternates = getattr(c, 'alternates', None)
+                    if alternates:
+                        i = list(base).index(c)
+                        base[i+1:i+1] = [alternates[a] for a in sorted(alternates)]
+                        del c.alternates
+                self._calc_hashes(base, usedrafts=usedrafts)
+                if usedrafts:
+                    self._pack_alternates(base)
+            comments, commentsafter = (getattr(base, a, None) for a in ('comments', 'commentsafter'))
+            return (base.tag, dict(base.attrib), base.text, tuple(children),
+                    comments and tuple(comments), commentsafter and tuple(commentsafter),
+                    base.contentHash.hashed, base.attrHash.hashed)
+        return (self.namespaces, self.default_draft, self.uid, _hash_salt(), record(self.root))
 
     def copynode(self, n, parent=None):
         res = n.copy()
@@ -484,18 +777,19 @@ class Ldml(ETWriter):
         attrib.update(attribs)
         tag = self._reverselocalns(tag)
         e = parent.makeelement(tag, attrib)
-        e.parent = parent
         e.document = parent.document
         if self.useDrafts:
             alt = self.alt(alt)
             if 'draft' not in e.attrib and self.use_draft is not None:
                 e.set('draft', self.use_draft)
-            self._calc_hashes(e, self.useDrafts)
-            equivs = [x for x in parent if x.attrHash == e.attrHash]
-            if len(equivs):
+            self._calc_hashes(e, self.useDrafts)    # before e is in the tree, so indexes stand
+            e.parent = parent
+            equivs = _childindex(parent).get(e.attrHash)
+            if equivs:
                 if 'alt' not in e.attrib:
                     e.set('alt', alt)
                 return self._add_alt_leaf(equivs[0], e, default=e.get('draft', None), leaf=True, alt=alt)
+        e.parent = parent
         parent.append(e)
         return e
 
@@ -656,22 +950,29 @@ class Ldml(ETWriter):
         base.tail = None
         if usedrafts or addguids:
             self._calc_hashes(base, usedrafts=usedrafts)
-        if usedrafts:                                       # pack up all alternates
-            temp = {}
-            for c in base:
-                a = c.get('alt', None)
-                if a is None or a.find("proposed") == -1:
-                    temp[c.attrHash] = c
-            tbase = list(base)
-            for c in tbase:
-                a = c.get('alt', '')
-                if a.find("proposed") != -1 and c.attrHash in temp:
-                    #a = re.sub(r"-?proposed.*$", "", a)
-                    t = temp[c.attrHash]
-                    if not hasattr(t, 'alternates'):
-                        t.alternates = {}
-                    t.alternates[a] = c
-                    base.remove(c)
+        if usedrafts:
+            self._pack_alternates(base)
+
+    def _pack_alternates(self, base):
+        """Move proposed alternates of a child out of base and into its alternates"""
+        tbase = list(base)
+        proposed = [c for c in tbase if c.get('alt', '').find("proposed") != -1]
+        if not proposed:
+            return
+        temp = {}
+        for c in tbase:
+            a = c.get('alt', None)
+            if a is None or a.find("proposed") == -1:
+                temp[c.attrHash] = c
+        for c in proposed:
+            a = c.get('alt')
+            if c.attrHash in temp:
+                #a = re.sub(r"-?proposed.*$", "", a)
+                t = temp[c.attrHash]
+                if not hasattr(t, 'alternates'):
+                    t.alternates = {}
+                t.alternates[a] = c
+                base.remove(c)
 
     def analyse(self):
         identity = self.root.find('./identity/special/{' + self.silns + '}identity')
@@ -683,6 +984,8 @@ class Ldml(ETWriter):
             self.uid = None
 
     def _calc_hashes(self, base, usedrafts=False):
+        if getattr(base, 'parent', None) is not None:
+            _Element.hashes += 1
         base.contentHash = _minhash(nominhash = True)
         for b in base:
             base.contentHash.merge(b.contentHash)
@@ -707,29 +1010,27 @@ class Ldml(ETWriter):
                 base.contentHash.update(k, v)     # content hash has non key attributes
         base.contentHash.merge(base.attrHash)               #   and keying hash
 
-    def serialize_xml(self, write, base = None, indent = '', topns = True, namespaces = {}):
+    def serialize_xml(self, write, base = None, indent = '', topns = True, namespaces = {}, chunksize = 1 << 16):
         if self.uid is not None:
             self.ensure_path('identity/special/sil:identity[@uid="{}"]'.format(self.uid))
-        if self.useDrafts:
-            n = base if base is not None else self.root
-            draft = n.get('draft', '')
-            if draft and (len(n) or draft == self.default_draft):
-                del n.attrib['draft']
-            offset = 0
-            alt = n.get('alt', '')
-            for (i, c) in enumerate(list(n)):
-                if not hasattr(c, 'alternates'): continue
-                for a in sorted(c.alternates.keys()):
-                    c.alternates[a].set('alt', (alt+"-"+a if alt else a))
-                    offset += 1
-                    n.insert(i + offset, c.alternates[a])
-                    c.alternates[a].tempnode = True
-        super(Ldml, self).serialize_xml(write, base, indent, topns, namespaces)
-        if self.useDrafts:
-            n = base if base is not None else self.root
-            for c in list(n):
-                if hasattr(c, 'tempnode') and c.tempnode:
-                    n.remove(c)
+        super(Ldml, self).serialize_xml(write, base, indent, topns, namespaces, chunksize)
+
+    def _serial_children(self, n):
+        """Drops redundant drafts from n and lists its alternates after their elements"""
+        if not self.useDrafts:
+            return list(n)
+        draft = n.get('draft', '')
+        if draft and (len(n) or draft == self.default_draft):
+            del n.attrib['draft']
+        res = []
+        alt = n.get('alt', '')
+        for c in n:
+            res.append(c)
+            if not hasattr(c, 'alternates'): continue
+            for a in sorted(c.alternates.keys()):
+                c.alternates[a].set('alt', (alt+"-"+a if alt else a))
+                res.append(c.alternates[a])
+        return res
 
     def get_draft(self, e, default=None):
         ldraft = e.get('draft', None) if e is not None else None
@@ -740,35 +1041,39 @@ class Ldml(ETWriter):
         """Add missing information in self from other. Honours @draft attributes"""
         if this == None: this = self.root
         other = getattr(other, 'root', other)
+        index = _childindex(this)
         for o in other:
             # simple if for now, if more use a dict
             if o.tag == '{'+self.silns+'}external-resources':
-                self._overlay_external_resources(o, this, usedrafts)
+                self._overlay_external_resources(o, this, usedrafts, index)
             else:
-                self._overlay_child(o, this, usedrafts)
+                self._overlay_child(o, this, usedrafts, index)
 
-    def _overlay_child(self, o, this, usedrafts):
-        addme = True
-        for t in filter(lambda x: x.attrHash == o.attrHash, this):
-            addme = False
+    def _overlay_child(self, o, this, usedrafts, index):
+        ts = index.get(o.attrHash)
+        if ts:
+            t = ts[0]           # only do one alignment
             if o.contentHash != t.contentHash:
                 if o.tag not in self.blocks:
                     self.overlay(o, usedrafts=usedrafts, this=t)
                 elif usedrafts:
-                    self._merge_leaf(other, t, o)
-            break  # only do one alignment
-        if addme and (o.tag != "alias" or not len(this)):  # alias in effect turns it into blocking
-            this.append(o)
+                    self._merge_leaf(this, t, o)
+        elif o.tag != "alias" or not len(this):  # alias in effect turns it into blocking
+            _append(this, o, index)
 
-    def _overlay_external_resources(self, other, this, usedrafts):
+    def _overlay_external_resources(self, other, this, usedrafts, index):
         """Handle sil:font fallback mechanism"""
         silfonttag = '{'+self.silns+'}font'
         fonts = []
-        this = filter(lambda x: x.attrHash == o.attrHash, this)[0]
+        if other.attrHash not in index:
+            self._overlay_child(other, this, usedrafts, index)
+            return
+        this = index[other.attrHash][0]
         for t in list(this):
             if t.tag == silfonttag:
                 fonts.append(t)
                 this.remove(t)
+        index = _childindex(this)
         for o in other:
             if o.tag == silfonttag:
                 types = o.get('types', '').split(' ')
@@ -783,10 +1088,10 @@ class Ldml(ETWriter):
                             tt = f.get('types', 'default').split(' ')
                             if t in tt:
                                 f.set('types', " ".join(filter(lambda x: x != t, tt)))
-                        fonts = filter(lambda x: x.get('types', '') != '', fonts)
-                this.append(o)
+                        fonts = [f for f in fonts if f.get('types', '') != '']
+                _append(this, o, index)
             else:
-                self._overlay_child(o, this, usedrafts)
+                self._overlay_child(o, this, usedrafts, index)
         for f in fonts:
             this.append(f)
 
@@ -845,18 +1150,26 @@ class Ldml(ETWriter):
         # if empty elements, test .text and all the attributes
         if not len(other) and not len(this):
             return (other.contentHash == this.contentHash)
+        index = _hashindex(this)    # changed as children are removed, so not kept
+        removed = set()
         for o in other:
-            for t in filter(lambda x: x.attrHash == o.attrHash, this):
-                if o.contentHash == t.contentHash or (o.tag not in self.blocks and self.difference(o, this=t)):
-                    if hasattr(t, 'alternates') and hasattr(o, 'alternates'):
-                        for (k, v) in o.alternates:
-                            if k in t.alternates and v.contentHash == t.alternates[k].contentHash:
-                                del t.alternates[k]
-                        if len(t.alternates) == 0:
-                            this.remove(t)
-                    else:
-                        this.remove(t)
-                break
+            ts = index.get(o.attrHash)
+            if not ts:
+                continue
+            t = ts[0]
+            if o.contentHash == t.contentHash or (o.tag not in self.blocks and self.difference(o, this=t)):
+                if hasattr(t, 'alternates') and hasattr(o, 'alternates'):
+                    for (k, v) in o.alternates.items():
+                        if k in t.alternates and v.contentHash == t.alternates[k].contentHash:
+                            del t.alternates[k]
+                    if len(t.alternates) == 0:
+                        removed.add(id(t))
+                        index.remove(t.attrHash, t)
+                else:
+                    removed.add(id(t))
+                    index.remove(t.attrHash, t)
+        if removed:         # removing each in turn is quadratic on large nodes
+            this[:] = [t for t in this if id(t) not in removed]
         return not len(this) and (not this.text or this.text == other.text)
 
     def _align(self, this, other, base):
@@ -873,11 +1186,9 @@ class Ldml(ETWriter):
                     del blist[t.contentHash]
             elif t.mergeBase is not None:
                 del blist[t.contentHash]
-        odict = _arrayDict()
-        for v in olist.values(): odict.set(v.attrHash, v)
+        odict = _hashindex(olist.values())
         if base is not None:
-            bdict = _arrayDict()
-            for v in blist.values(): bdict.set(v.attrHash, v)
+            bdict = _hashindex(blist.values())
         for t in filter(lambda x: x.mergeOther == None, this):     # go over everything not yet associated
             # this is pretty horrible - find first alignment on key attributes. (sufficient for ldml)
             t.mergeOther = odict.pop(t.attrHash)
@@ -891,7 +1202,7 @@ class Ldml(ETWriter):
                     t.mergeBase = bdict.pop(t.attrHash)
                     if t.mergeBase is not None: del blist[t.mergeBase.contentHash]
         for e in olist.values():       # pick up stuff in other but not in this
-            newe = self.copynode(e, this.parent)
+            newe = self.copynode(e, this)
             if base is not None and e.contentHash in blist:
                 newe.mergeBase = blist.pop(e.contentHash)
             elif base is not None:
@@ -1001,6 +1312,8 @@ class Ldml(ETWriter):
         if base is not None and hasattr(base, 'root'): base = base.root
         self._align(this, other, base)
         # other and base can be None
+        removed = set()
+        added = []
         for t in list(this):       # go through children merging them
             if t.mergeBase is None:
                 if self.useDrafts and t.mergeOther is not None and t.mergeOther.contentHash != t.contentHash:
@@ -1011,18 +1324,20 @@ class Ldml(ETWriter):
                     if self.useDrafts:
                         res |= self._merge_with_alts(t.mergeBase, t.mergeOther, t, default=default, copycomments=copycomments)
                     else:
-                        this.remove(t)                                  # swap us out
-                        this.append(t.mergeOther)
+                        removed.add(id(t))                              # swap us out
+                        added.append(t.mergeOther)
                         res = True
                 elif t.mergeBase.contentHash != t.mergeOther.contentHash:
                     res |= self.merge(t.mergeOther, t.mergeBase, t)        # could be a clash so recurse
                 elif self.useDrafts:       # base == other
                     res |= self._merge_with_alts(t.mergeBase, t.mergeOther, t, default=default, copycomments=copycomments)
             elif t.mergeOther is None and t.mergeBase.contentHash == t.contentHash:
-                this.remove(t)
+                removed.add(id(t))
                 res = True
             elif self.useDrafts:
                 res |= self._merge_with_alts(t.mergeBase, t.mergeOther, t, default=default, copycomments=copycomments)
+        if removed or added:        # removing each in turn is quadratic on large nodes
+            this[:] = [t for t in this if id(t) not in removed] + added
         if base is not None and this.text == base.text:
             if other is not None:
                 res = res or (this.text != other.text)
@@ -1042,7 +1357,7 @@ class Ldml(ETWriter):
         elif self.useDrafts:
             res |= self._merge_with_alts(base, other, this, default=default, copycomments=copycomments)
         oattrs = set(other.keys() if other is not None else [])
-        for k in this.keys():                                  # go through our attributes
+        for k in list(this.keys()):                            # go through our attributes
             if k in oattrs:
                 if k in base.attrib and base.get(k) == this.get(k) and this.get(k) != other.get(k):
                     res = True
@@ -1176,47 +1491,41 @@ def _prepare_parent(next, token):
     return select
 ep.ops['..'] = _prepare_parent
 
-def flattenlocale(lname, dirs=[], rev='f', changed=set(), autoidentity=False, skipstubs=False, fname=None, flattencollation=False):
+def flattenlocale(lname, dirs=[], rev='f', changed=set(), autoidentity=False, skipstubs=False, fname=None, flattencollation=False, cache=None, store=None):
     """ Flattens an ldml file by filling in missing details from the fallback chain.
         If rev true, then do the opposite and unflatten a flat LDML file by removing
         everything that is the same in the fallback chain.
         changed contains an optional set of locales that if present says that the operation
         is only applied if one or more of the fallback locales are in the changed set.
         autoidentity says to insert or remove script information from the identity element.
+        cache is an optional LdmlCache used to load the locale and its fallbacks.
+        store is an optional LocaleStore to find and load locales with instead of dirs,
+        which when flattening overlays its flattened fallback chain in one go.
         Values for rev: f - flatten, r - unflatten, c - copy"""
-    def trimtag(s):
-        r = s.rfind('_')
-        if r < 0:
-            return ''
-        else:
-            return s[:r]
-
     def getldml(lname, dirs):
+        if store is not None:
+            return store.load(lname)
         for d in dirs:
             f = os.path.join(d, lname + '.xml')
             if os.path.exists(f):
-                return Ldml(f)
+                return Ldml(f, cache=cache)
             f = os.path.join(d, lname[0].lower(), lname + '.xml')
             if os.path.exists(f):
-                return Ldml(f)
+                return Ldml(f, cache=cache)
         return None
 
     if isinstance(lname, Ldml):
         l = lname
         lname = fname
     elif not isinstance(lname, string_types):
-        l = Ldml(lname)
+        l = Ldml(lname, cache=cache)
         lname = fname
     else:
         l = getldml(lname, dirs)
     if l is None: return l
     if skipstubs and len(l.root) == 1 and l.root[0].tag == 'identity': return None
     if rev != 'c':
-        fallbacks = l.get_parent_locales(lname)
-        if not len(fallbacks):
-            fallbacks = [trimtag(lname)]
-        if 'root' not in fallbacks and lname != 'root':
-            fallbacks += ['root']
+        fallbacks = _fallbacks(lname, l.get_parent_locales(lname))
         if len(changed):       # check against changed
             dome = False
             for f in fallbacks:
@@ -1224,21 +1533,28 @@ def flattenlocale(lname, dirs=[], rev='f', changed=set(), autoidentity=False, sk
                     dome = True
                     break
             if not dome: return None
-        dome = True
-        for f in fallbacks:    # apply each fallback
-            while len(f):
-                o = getldml(f, dirs)
-                if o is not None:
-                    if rev == 'r':
-                        l.difference(o)
-                        dome = False
-                        break   # only need one for unflatten
-                    else:
-                        if f == 'root':
-                            l.flag_nonroots()
-                        l.overlay(o)
-                f = trimtag(f)
-            if not dome: break
+        if rev == 'f' and store is not None:
+            chain = store.chain(fallbacks)
+            if chain:
+                if 'root' in chain:
+                    l.flag_nonroots()
+                l.overlay(store.flattened(chain))
+        else:
+            dome = True
+            for f in fallbacks:    # apply each fallback
+                while len(f):
+                    o = getldml(f, dirs)
+                    if o is not None:
+                        if rev == 'r':
+                            l.difference(o)
+                            dome = False
+                            break   # only need one for unflatten
+                        else:
+                            if f == 'root':
+                                l.flag_nonroots()
+                            l.overlay(o)
+                    f = _trimtag(f)
+                if not dome: break
     if skipstubs and len(l.root) == 1 and l.root[0].tag == 'identity': return None
     if autoidentity:
         i = l.root.find('identity')
@@ -1271,6 +1587,213 @@ def flattenlocale(lname, dirs=[], rev='f', changed=set(), autoidentity=False, sk
 
     return l
 
+
+def _trimtag(s):
+    r = s.rfind('_')
+    if r < 0:
+        return ''
+    else:
+        return s[:r]
+
+
+def _fallbacks(lname, parents):
+    """The fallback locales flattenlocale() overlays onto lname, given its parent
+        locales, each of which is followed in turn by its trimmed tags"""
+    res = list(parents)
+    if not len(res):
+        res = [_trimtag(lname)]
+    if 'root' not in res and lname != 'root':
+        res.append('root')
+    return res
+
+
+class _treememo(LdmlCache):
+    """ An LdmlCache of the most recently used trees held in memory, in front of
+        an optional LdmlCache on disk """
+    def __init__(self, backing=None, size=256):
+        from collections import OrderedDict
+        super(_treememo, self).__init__(None)
+        self.backing = backing
+        self.size = size
+        self._trees = OrderedDict()
+
+    def get(self, key):
+        entry = self._trees.pop(key, None)
+        if entry is None and self.backing is not None:
+            entry = self.backing.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._remember(key, entry)
+        return entry
+
+    def __setitem__(self, key, entry):
+        self._remember(key, entry)
+        if self.backing is not None:
+            self.backing[key] = entry
+
+    def _remember(self, key, entry):
+        self._trees[key] = entry
+        while len(self._trees) > self.size:
+            self._trees.popitem(last=False)
+
+
+class LocaleStore(object):
+    """ Finds locales in a list of SLDR style directories, holding either name.xml
+        or l/name.xml, and loads and flattens them for flattenlocale(). The
+        directories are listed once rather than probed for each locale. The most
+        recently used parsed trees are kept, as are the most recently used
+        flattened fallback chains, such as zh then root, so each locale is
+        flattened by overlaying one copy of a chain flattened in memory, and each
+        chain is flattened by overlaying its own parent chain onto its first
+        locale. cache is an optional LdmlCache to use for first loads. """
+    def __init__(self, dirs, cache=None, usedrafts=True, size=256):
+        self.dirs = list(dirs)
+        self.cache = cache
+        self.usedrafts = usedrafts
+        self._memo = _treememo(cache, size)
+        self._flat = _treememo(None, size)
+        self._paths = None
+
+    def _index(self):
+        if self._paths is None:
+            self._paths = {}
+            # Index so that, as flattenlocale() probes, earlier directories win
+            # and d/name.xml wins over d/n/name.xml.
+            for d in reversed(self.dirs):
+                if not os.path.isdir(d):
+                    continue
+                subdirs = [s for s in os.listdir(d) if len(s) == 1 and os.path.isdir(os.path.join(d, s))]
+                for sd in [os.path.join(d, s) for s in subdirs] + [d]:
+                    for f in os.listdir(sd):
+                        name, ext = os.path.splitext(f)
+                        if ext == '.xml' and (sd == d or name[:1].lower() == os.path.basename(sd)):
+                            self._paths[name] = os.path.join(sd, f)
+        return self._paths
+
+    def path(self, name):
+        """Returns the file the named locale is loaded from, or None"""
+        return self._index().get(name)
+
+    def locales(self):
+        """Returns the names of all the locales found"""
+        return sorted(self._index().keys())
+
+    def load(self, name):
+        """Returns a new Ldml for the named locale, or None if there is no such locale"""
+        f = self.path(name)
+        return None if f is None else Ldml(f, usedrafts=self.usedrafts, cache=self._memo)
+
+    def chain(self, fallbacks):
+        """Returns the locales in this store that flattenlocale() overlays, in order,
+            for a list of fallbacks, each followed by its trimmed tags"""
+        res = []
+        for f in fallbacks:
+            while len(f):
+                if self.path(f) is not None:
+                    res.append(f)
+                f = _trimtag(f)
+        return tuple(res)
+
+    def fallback_chain(self, lname):
+        """Returns the chain of the named locale, from the parentLocales of the
+            supplemental data rather than by loading the locale"""
+        if not hasattr(Ldml, 'parentLocales'):
+            Ldml.ReadSupplementalData()
+        return self.chain(_fallbacks(lname, Ldml.parentLocales.get(lname, [])))
+
+    def flattened(self, chain):
+        """Returns a new Ldml of the locales in a chain overlaid in turn, as
+            flattenlocale() overlays them, flagging the non root locales. The chain
+            after its first locale is flattened first, the first locale overlaid
+            with it and the result kept as an LdmlCache entry, which later calls
+            restore a copy of."""
+        if len(chain) == 1:
+            return self.load(chain[0])
+        entry = self._flat.get(chain)
+        if entry is None:
+            l = self.load(chain[0])
+            if 'root' in chain[1:]:
+                l.flag_nonroots()
+            l.overlay(self.flattened(chain[1:]))
+            self._flat[chain] = l._pack(self.usedrafts)
+            return l
+        res = Ldml(None, usedrafts=self.usedrafts)
+        res._restore(entry, self.usedrafts)
+        return res
+
+    def flatten(self, lname, **kws):
+        """flattenlocale() the named locale, finding it and its fallbacks in this store"""
+        return flattenlocale(lname, self.dirs, store=self, **kws)
+
+
+def _chains(names, store):
+    """Groups locale names by the last locale short of root in their fallback
+        chains, each group ordered by the length of those chains so that the
+        chains a locale is flattened onto are flattened first, largest groups first"""
+    groups = {}
+    for n in names:
+        chain = (n,) + store.fallback_chain(n)
+        top = [c for c in chain if c != 'root'][-1:] or [n]
+        groups.setdefault(top[0], []).append((len(chain), n))
+    res = [[n for _, n in sorted(g)] for g in groups.values()]
+    return sorted(res, key=lambda g: (-len(g), g[0]))
+
+
+def _flatten_group(names):
+    store, kws = _flatten_store
+    res = []
+    for n in names:
+        l = store.flatten(n, **kws)
+        if l is None:
+            res.append((n, None))
+            continue
+        out = []
+        l.serialize_xml(out.append)
+        res.append((n, u"".join(out)))
+    return res
+
+
+def _init_flatten_store(dirs, cache, kws):
+    global _flatten_store
+    _flatten_store = (LocaleStore(dirs, cache=cache), kws)
+
+
+def flatten_all(dirs, workers=None, locales=None, cache=None, **kws):
+    """ Flattens every locale in dirs, or those named in locales, across a pool of
+        worker processes, yielding (name, xml) pairs as each group of locales
+        completes. xml is the serialised flattened locale or None if flattenlocale()
+        returns None for it. Locales are grouped by the furthest locale short of
+        root in the fallback chain flattenlocale() uses, from parentLocales and
+        then trimming tags, so zh_Hant_TW goes with zh while zh_Hant, whose parent
+        is root, is a group of its own. Each group is flattened by one worker with
+        shorter chains first, so each flattened fallback chain is built once, from
+        the flattened chain of its parent, and is shared by every locale that
+        inherits from it. cache is an optional LdmlCache and kws are passed on to
+        flattenlocale(). workers defaults to the number of CPUs, if it is 0 the
+        locales are flattened in this process. """
+    store = LocaleStore(dirs)
+    if locales is None:
+        locales = store.locales()
+    groups = _chains(locales, store)
+    if workers == 0:
+        _init_flatten_store(dirs, cache, kws)
+        results = map(_flatten_group, groups)
+        pool = None
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(workers, _init_flatten_store, (dirs, cache, kws))
+        results = pool.imap_unordered(_flatten_group, groups)
+    try:
+        for res in results:
+            for r in res:
+                yield r
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+
 if __name__ == '__main__':
     import sys, codecs
     l = Ldml(sys.argv[1])
@@ -300,9 +300,13 @@ class Exemplars(object):
         self.scripts = Counter()
         self.codes_for_scripts = dict()
         self.bases_for_marks = dict()
+        self.marks_for_bases = dict()
         self.max_multigraph_length = 1
         self.always_separate_marks = set()
         self.need_splitting = True
+        self.split = None
+        self.resplit = None
+        self.char_properties = dict()
 
         self.unittest = False
 
@@ -431,10 +435,14 @@ class Exemplars(object):
         self.count_marks()
         while self.need_splitting:
             self.need_splitting = False
+            # Only clusters made by splits need looking at again.
+            self.resplit = self.split
+            self.split = set()
             self.find_indic_matras_and_viramas()
             self.find_marks_on_same_bases()
             self.find_productive_marks()
             self.find_second_marks()
+        self.split = self.resplit = None
         self.parcel_marks()
         self.parcel_ignorable()
         self.parcel_frequency()
@@ -483,6 +491,11 @@ class Exemplars(object):
                     bases_for_mark.add(exemplar.base)
                     self.bases_for_marks[mark] = bases_for_mark
 
+        # Index the marks by their set of bases.
+        self.marks_for_bases = dict()
+        for mark, bases_for_mark in self.bases_for_marks.items():
+            self.marks_for_bases.setdefault(frozenset(bases_for_mark), list()).append(mark)
+
     def find_numbers(self):
         """Numbers without diacritics go into the digits exemplar."""
         for exemplar in list(self.clusters.keys()):
@@ -512,10 +525,26 @@ class Exemplars(object):
 
         del self.clusters[exemplar]
         self.need_splitting = True
+        if self.split is not None:
+            self.split.add(exemplar_mark)
+            self.split.add(new_exemplar)
+
+    def splittable(self):
+        """Return the clusters that a pass of the analysis could split.
+
+        Until a whole round of passes has been made, that is all of them.
+        After that, whether a pass splits a cluster depends only on the cluster,
+        so only those made by splits since the start of the previous round
+        need looking at again.
+        """
+        if self.resplit is None or self.split is None:
+            return list(self.clusters.keys())
+        return [exemplar for exemplar in self.clusters
+                if exemplar in self.split or exemplar in self.resplit]
 
     def find_indic_matras_and_viramas(self):
         """Indic matras and viramas are always separate marks."""
-        for exemplar in list(self.clusters.keys()):
+        for exemplar in self.splittable():
             count = self.clusters[exemplar]
             for trailer_index in range(len(exemplar.trailers)):
                 trailer = exemplar.trailers[trailer_index]
@@ -525,7 +554,11 @@ class Exemplars(object):
 
     def find_marks_on_same_bases(self):
         """If a set of diacritics has the sames bases, the diacritics are separate."""
-        for exemplar in list(self.clusters.keys()):
+        marks_with_same_bases = dict()
+        for mark, bases_for_mark in self.bases_for_marks.items():
+            marks_with_same_bases[mark] = self.marks_for_bases.get(frozenset(bases_for_mark), ())
+
+        for exemplar in self.splittable():
             count = self.clusters[exemplar]
             for trailer_index in range(len(exemplar.trailers)):
                 trailer = exemplar.trailers[trailer_index]
@@ -533,19 +566,15 @@ class Exemplars(object):
                     # The trailer is a Mark, as it was found,
                     # and only Marks are in that data structure.
                     current_mark = trailer
-                    current_bases = self.bases_for_marks[current_mark]
 
-                    # Compare the current set of bases to all the other sets of bases.
-                    for other_mark in self.bases_for_marks.keys():
+                    # Split once for each other mark with the same set of bases.
+                    for other_mark in marks_with_same_bases[current_mark]:
                         if current_mark != other_mark:
-                            other_bases = self.bases_for_marks[other_mark]
-                            difference = current_bases.symmetric_difference(other_bases)
-                            if len(difference) == 0:
-                                self.split_exemplar(exemplar, trailer_index, count)
+                            self.split_exemplar(exemplar, trailer_index, count)
 
     def find_productive_marks(self):
         """Split clusters if a mark occurs on many bases."""
-        for exemplar in list(self.clusters.keys()):
+        for exemplar in self.splittable():
             count = self.clusters[exemplar]
             for trailer_index in range(len(exemplar.trailers)):
                 trailer = exemplar.trailers[trailer_index]
@@ -670,55 +699,78 @@ class Exemplars(object):
 
         return False
 
+    def properties(self, char):
+        """Return the properties of a character needed to find clusters.
+
+        The properties are looked up in ICU the first time a character is seen
+        and cached in char_properties, as a tuple of the script code and
+        whether the character is punctuation, an allowable base, a mark,
+        and a mark that always combines with its base.
+        """
+        props = self.char_properties.get(char)
+        if props is None:
+            script = Script.getScript(char)
+            script_code = Script.getScriptCode(script)
+            self.codes_for_scripts.setdefault(script_code, script)
+            props = (script_code,
+                     self.ucd.ispunct(char),
+                     self.allowable(char),
+                     self.ucd.ismark(char),
+                     self.ucd.is_always_combine(char))
+            self.char_properties[char] = props
+        return props
+
     def process(self, text):
         """Analyze a string."""
         i = 0
         text = self.ucd.normalize('NFD', text)
+        properties = self.properties
 
         # Record script of each character.
-        for char in text:
-            script = Script.getScript(char)
-            script_code = Script.getScriptCode(script)
-            self.scripts[script_code] += 1
-            self.codes_for_scripts[script_code] = script
+        for char, count in Counter(text).items():
+            self.scripts[properties(char)[0]] += count
+
+        # Only look for multigraphs if some have been specified.
+        multigraphs = self._main | self._auxiliary | self._index | self._punctuation
+        clusters = self.clusters
+        text_length = len(text)
 
         # Record clusters
-        while i < len(text):
+        while i < text_length:
 
             # Look for multigraphs (from length of max_multigraph_length down to 1) character(s)
             # of multigraphs already specified in a LDML file.
             # Longest possible matches are looked at first.
-            for multigraph_length in range(self.max_multigraph_length, 0, -1):
-                multigraph = text[i:i + multigraph_length]
-
-                if (multigraph in self._main or
-                   multigraph in self._auxiliary or
-                   multigraph in self._index or
-                   multigraph in self._punctuation):
-                    exemplar = Exemplar(multigraph)
-                    self.clusters[exemplar] += 1
-                    i += multigraph_length
-                    break
+            if multigraphs:
+                for multigraph_length in range(self.max_multigraph_length, 0, -1):
+                    multigraph = text[i:i + multigraph_length]
+
+                    if multigraph in multigraphs:
+                        exemplar = Exemplar(multigraph)
+                        clusters[exemplar] += 1
+                        i += multigraph_length
+                        break
 
             # No multigraphs were found at this position,
             # so continue processing a single character
             # if we have not gone beyond the end of the text.
-            if not i < len(text):
+            if not i < text_length:
                 break
 
             char = text[i]
+            (script_code, punct, allowable, mark, always_combine) = properties(char)
 
             # Test for punctuation.
-            if self.ucd.ispunct(char):
+            if punct:
                 exemplar = Exemplar(char)
-                self.clusters[exemplar] += 1
+                clusters[exemplar] += 1
                 i += 1
                 continue
 
             # Find grapheme clusters.
 
             # Ensure exemplar base has needed properties.
-            if not self.allowable(char):
+            if not allowable:
                 i += 1
                 continue
 
@@ -728,23 +780,24 @@ class Exemplars(object):
             # Then find the end of the cluster
             # (which may consist of only base characters).
             length = base_length = 1
-            while i + length < len(text):
+            while i + length < text_length:
                 trailer = text[i + length]
-                if self.ucd.is_zwj(trailer):
+                if trailer == u'\u200D':
                     # ZWJ found, so the cluster continues.
                     length += 1
                     continue
-                if self.ucd.is_zwnj(trailer):
+                if trailer == u'\u200C':
                     # ZWNJ found, so the end of the cluster has been reached,
                     # but put include ZWNJ in the cluster
                     length += 1
                     break
-                if self.ucd.ismark(trailer):
+                (script_code, punct, allowable, mark, always_combine) = properties(trailer)
+                if mark:
                     # A Mark was found, so the cluster continues.
                     length += 1
 
                     # Marks such as nuktas are considered part of the base.
-                    if self.ucd.is_always_combine(trailer):
+                    if always_combine:
                         # A Mark such as a nukta was found, so the base continues,
                         # as well as the cluster.
                         base_length += 1
@@ -763,9 +816,77 @@ class Exemplars(object):
             trailers = text[i + base_length:i + length]
             exemplar = Exemplar(base, trailers)
 
-            self.clusters[exemplar] += 1
+            clusters[exemplar] += 1
             i += length
 
+    def process_corpus(self, paths, workers=None, chunksize=1 << 22):
+        """Analyze UTF-8 text files, as if the text of each was passed to process().
+
+        The files are split at line boundaries into spans of about chunksize bytes,
+        which are processed across a pool of worker processes and their cluster
+        and script counts merged in corpus order. workers defaults to the number
+        of CPUs, if it is 0 the spans are processed in this process.
+        """
+        spans = list()
+        for path in paths:
+            size = os.path.getsize(path)
+            for start in range(0, size, chunksize):
+                spans.append((path, start, min(start + chunksize, size)))
+        if workers == 0:
+            for span in spans:
+                self.process(_read_span(*span))
+            return
+        import multiprocessing
+        settings = dict((k, getattr(self, k)) for k in _corpus_settings)
+        pool = multiprocessing.Pool(workers, _init_corpus, (type(self), settings))
+        try:
+            for clusters, scripts in pool.imap(_process_span, spans):
+                self.clusters.update(clusters)
+                self.scripts.update(scripts)
+                for script_code in scripts:
+                    if script_code not in self.codes_for_scripts:
+                        self.codes_for_scripts[script_code] = Script(script_code)
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+def _read_span(path, start, end):
+    """Return the text of the lines of a UTF-8 file that start within [start, end)."""
+    lines = list()
+    with open(path, 'rb') as f:
+        if start:
+            # Skip the rest of a line started in the previous span.
+            f.seek(start - 1)
+            f.readline()
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            lines.append(line)
+    # Universal newlines, as reading the file in text mode would give.
+    text = b''.join(lines).decode('utf-8')
+    return text.replace(u'\r\n', u'\n').replace(u'\r', u'\n')
+
+
+# Exemplars attributes that affect process() and so are given to each worker.
+_corpus_settings = ('_main', '_auxiliary', '_index', '_punctuation',
+                    'max_multigraph_length', 'unittest')
+_corpus_exemplars = None
+
+
+def _init_corpus(cls, settings):
+    global _corpus_exemplars
+    _corpus_exemplars = cls()
+    for k, v in settings.items():
+        setattr(_corpus_exemplars, k, v)
+
+
+def _process_span(span):
+    _corpus_exemplars.clusters = Counter()
+    _corpus_exemplars.scripts = Counter()
+    _corpus_exemplars.process(_read_span(*span))
+    return (_corpus_exemplars.clusters, _corpus_exemplars.scripts)
 
 if __name__ == '__main__':
     main()
@@ -24,16 +24,21 @@
 # SUCH DAMAGE.
 
 from xml.etree import ElementTree as et
-import itertools, re, os, sys
+import io, itertools, json, re, os, sys, time
 from collections import namedtuple
 
 try:
     from . import UnicodeSets
-except ValueError:
+except (ValueError, ImportError):
     if __name__ == '__main__':
         sys.path.insert(0, os.path.dirname(__file__))
         import UnicodeSets
 
+try:
+    unicode
+except NameError:
+    unicode = str
+
 
 CharCode = namedtuple('CharCode', ['primary', 'tertiary_base', 'tertiary', 'prebase'])
 SortKey = namedtuple('SortKey', ['primary', 'index', 'tertiary', 'tiebreak'])
@@ -48,6 +53,7 @@ class Keyboard(object):
         self.settings = {}
         self.history = []
         self.context = ""
+        self._charcodes = {}
         self.parse(path)
 
     def _addrules(self, element, transform):
@@ -95,6 +101,39 @@ class Keyboard(object):
             modifiers = [x.lower() for x in words[:-1]]
             yield self.process(words[-1], modifiers)
 
+    def run_tests(self, tests):
+        '''Process each (keys, expected) pair of a test corpus, as
+            process_string would, and report as a dict: the number of tests
+            and keystrokes, the time taken, the failures, whose output after
+            the last keystroke is not as expected (if expected is not None),
+            and for each type of transforms the attributes of each
+            transform with the number of times it matched'''
+        for r in self.transforms.values():
+            r.count()
+        failures = []
+        keystrokes = 0
+        start = time.time()
+        try:
+            for keys, expected in tests:
+                output = u""
+                try:
+                    for c in self.process_string(keys):
+                        output = u"*" + c.outputs[-1] + u"*" if c.error else c.outputs[-1]
+                        keystrokes += 1
+                except Exception as e:
+                    failures.append(dict(keys=keys, expected=expected, exception=repr(e)))
+                    continue
+                if expected is not None and output != expected:
+                    failures.append(dict(keys=keys, expected=expected, output=output))
+            t = time.time() - start
+            rules = dict((k, [dict(s, hits=h) for s, h in zip(r.sources, r.hits)])
+                         for k, r in self.transforms.items())
+        finally:
+            for r in self.transforms.values():
+                r.count(False)
+        return dict(tests=len(tests), keystrokes=keystrokes, time=t,
+                    failures=failures, rules=rules)
+
     def parse_modifiers(self, modifiers):
         '''Flatten a modifier list into a list of possible modifiers'''
         resn = []
@@ -156,8 +195,7 @@ class Keyboard(object):
     def _process_empty(self, context, ruleset):
         '''Copy layer input to output'''
         context.reset_output(ruleset)
-        output = context.input(ruleset)[context.offset(ruleset):]
-        context.results(ruleset, len(output), output)
+        context.copy(ruleset)
 
     def _process_simple(self, context, ruleset='simple', handleSettings=True):
         '''Handle a simple replacement transforms type'''
@@ -178,7 +216,7 @@ class Keyboard(object):
         curr = context.offset(ruleset)
         instr = context.input(ruleset)
         while curr < len(instr):
-            r = trans.match(instr[curr:], partial=partial, fail=fail)
+            r = trans.match(instr, curr, partial=partial, fail=fail)
             if r[0] is not None:
                 if getattr(r[0], 'error', 0): return False
                 context.results(ruleset, r[1], getattr(r[0], 'to', ""))
@@ -196,7 +234,7 @@ class Keyboard(object):
         # if there is no base, insert one
         if (0, 0) not in [(x.primary, x.tertiary) for x in k]:
             s += u"\u25CC"
-            k += SortKey(0, 0, 0, 0)  # push this to the front
+            k.append(SortKey(0, 0, 0, 0))  # push this to the front
         # sort key is (primary, secondary, string index)
         return u"".join(s[y] for y in sorted(range(len(s)), key=lambda x:k[x]))
 
@@ -208,32 +246,83 @@ class Keyboard(object):
         return res
 
     def _get_charcodes(self, instr, curr, trans):
-        '''Returns a list of some CharCodes, 1 per char, for the string at curr''' 
-        r = trans.match(instr[curr:])
+        '''Returns a list of some CharCodes, 1 per char, for the string at curr,
+            and the index just past the chars of instr they depend on (see
+            extent in Rules.match). The list is made once for each rule and length
+            matched.'''
+        r = trans.match(instr, curr, extent=True)
+        k = (id(r[0]), r[1])
+        if k in self._charcodes:
+            return self._charcodes[k], r[2]
         if r[0] is not None:
             orders = [int(x) for x in self._padlist(getattr(r[0], 'order', "0"), r[1])]
             bases = [bool(x) for x in self._padlist(getattr(r[0], 'tertiary_base', "false"), r[1])]
             tertiaries = [int(x) for x in self._padlist(getattr(r[0], 'tertiary', "0"), r[1])]
             prebases = [bool(x) for x in self._padlist(getattr(r[0], 'prebase', "false"), r[1])]
-            return [CharCode(orders[i], bases[i], tertiaries[i], prebases[i]) for i in range(r[1])]
+            res = [CharCode(orders[i], bases[i], tertiaries[i], prebases[i]) for i in range(r[1])]
         else:
-            return [CharCode(0, 0, 0, False)]
+            res = [CharCode(0, 0, 0, False)]
+        self._charcodes[k] = res
+        return res, r[2]
+
+    def _get_sortkeys(self, codes, curr, state):
+        '''Returns the SortKeys for the CharCodes at curr, the indices in codes at
+            which a new run starts and the state after them, given the state
+            before them: (start of run, inside the start of a run, current
+            primary, current base index, primary of the previous key)'''
+        (startrun, isinit, currprimary, currbaseindex, lastprimary) = state
+        keys = []
+        ends = []
+        for i, c in enumerate(codes):               # calculate sort key for each character in turn
+            if c.tertiary and curr + i > startrun:      # can't start with tertiary, treat as primary 0
+                key = SortKey(currprimary, currbaseindex, c.tertiary, curr + i)
+            else:
+                key = SortKey(c.primary, curr + i, 0, curr + i)
+                if c.primary == 0 or c.tertiary_base:   # primary 0 is always a tertiary base
+                    currprimary = c.primary
+                    currbaseindex = curr + i
+
+            if ((key.primary != 0 or key.tertiary != 0) and not c.prebase) \
+                    or (c.prebase and curr + i > startrun and lastprimary == 0):  # prebase can't have tertiary
+                isinit = False      # After the prefix, so any following prefix char starts a new run
+
+            # identify a run boundary
+            if not isinit and ((key.primary == 0 and key.tertiary == 0) or c.prebase):
+                ends.append(i)
+                startrun = curr + i
+                isinit = True
+            keys.append(key)
+            lastprimary = key.primary
+        return keys, ends, (startrun, isinit, currprimary, currbaseindex, lastprimary)
 
     def _process_reorder(self, context, ruleset='reorder'):
-        '''Handle the reorder transforms'''
+        '''Handle the reorder transforms. The CharCodes matched at each position,
+            with the SortKeys and sorted runs made from them, are kept in the
+            context and reused by the next keystroke where its input and the
+            state before them are unchanged, so only the run it touches is
+            matched, keyed and sorted again.'''
         if ruleset not in self.transforms:
             self._process_empty(context, ruleset)
             return
         trans = self.transforms[ruleset]
         instr = context.input(ruleset)
         context.reset_output(ruleset)
+        # steps[pos] is (codes, extent, keyed) for the codes matched at pos,
+        #  kept from the last keystroke if instr is unchanged as far as extent,
+        #  and keyed is (state, keys, ends, state after, sorted runs) if they
+        #  have been keyed, as by _get_sortkeys
+        kept, same = context.reuse(ruleset)
+        steps = {}
 
         # scan for start of sortable run. Normally empty
         startrun = context.offset(ruleset)
         curr = startrun
         while curr < len(instr):
-            codes = self._get_charcodes(instr, curr, trans)
-            for c in codes:
+            step = kept.get(curr)
+            if step is None or step[1] > same:
+                step = self._get_charcodes(instr, curr, trans) + (None,)
+            steps[curr] = step
+            for c in step[0]:
                 if c.prebase or c.primary == 0:
                     break
                 curr += 1
@@ -244,36 +333,41 @@ class Keyboard(object):
             context.results(ruleset, curr - startrun, instr[startrun:curr])
 
         startrun = curr
-        keys = [None] * (len(instr) - startrun)
-        isinit = True           # inside the start of a run (.{prebase}* .{order==0 && tertiary==0})
-        currprimary = 0
-        currbaseindex = curr
-        while curr < context.len(ruleset):
-            codes = self._get_charcodes(instr, curr, trans)
-            for i, c in enumerate(codes):               # calculate sort key for each character in turn
-                if c.tertiary and curr + i > startrun:      # can't start with tertiary, treat as primary 0
-                    key = SortKey(currprimary, currbaseindex, c.tertiary, curr + i)
-                else:
-                    key = SortKey(c.primary, curr + i, 0, curr + i)
-                    if c.primary == 0 or c.tertiary_base:   # primary 0 is always a tertiary base
-                        currprimary = c.primary
-                        currbaseindex = curr + i
-
-                if ((key.primary != 0 or key.tertiary != 0) and not c.prebase) \
-                        or (c.prebase and curr + i > startrun \
-                            and keys[curr+i-startrun-1].primary == 0):  # prebase can't have tertiary
-                    isinit = False      # After the prefix, so any following prefix char starts a new run
-
-                # identify a run boundary
-                if not isinit and ((key.primary == 0 and key.tertiary == 0) or c.prebase):
-                    # output sorted run and reset for new run
-                    context.results(ruleset, curr + i - startrun,
-                                    self._sort(startrun, curr + i, instr, keys))
-                    startrun = curr + i
-                    keys = [None] * (len(instr) - startrun)
-                    isinit = True
-                keys[curr+i-startrun] = key
+        keys = []
+        state = (curr, True, 0, curr, None)
+        fresh = False           # whether any key of this run is newly made
+        while curr < len(instr):
+            step = steps.get(curr)
+            if step is None:
+                step = kept.get(curr)
+                if step is None or step[1] > same:
+                    step = self._get_charcodes(instr, curr, trans) + (None,)
+            (codes, extent, keyed) = step
+            stepfresh = keyed is None or keyed[0] != state
+            if stepfresh:
+                stepkeys, ends, after = self._get_sortkeys(codes, curr, state)
+                sorts = None
+            else:
+                (_, stepkeys, ends, after, sorts) = keyed
+            fresh = fresh or stepfresh
+            made = []
+            last = 0
+            for n, i in enumerate(ends):
+                # output sorted run, unless it is as kept, and reset for new run
+                keys.extend(stepkeys[last:i])
+                made.append(self._sort(startrun, curr + i, instr, keys) if fresh else sorts[n])
+                context.results(ruleset, curr + i - startrun, made[n])
+                startrun = curr + i
+                keys = []
+                last = i
+                fresh = stepfresh
+            keys.extend(stepkeys[last:])
+            if made != sorts:
+                step = (codes, extent, (state, stepkeys, ends, after, made))
+            steps[curr] = step
+            state = after
             curr += len(codes)
+        context.keep(ruleset, steps)
         if curr > startrun:
             # output but don't store any residue. Reprocess it next time.
             context.outputs[context.index(ruleset)] += self._sort(startrun, curr, instr, keys)
@@ -303,9 +397,17 @@ class Rules(object):
         self.type = ruletype
         self.rules = Rule()
         self.reverse = ruletype == 'backspace'      # work backwards
+        self.states = None
+        self.sources = []       # transform attributes in the order appended
+        self.hits = None        # matches of each source, when counting
 
     def append(self, transform):
         '''Insert or merge a rule into this set of rules'''
+        self.states = None
+        source = len(self.sources)
+        self.sources.append(dict(transform.attrib))
+        if self.hits is not None:
+            self.hits.append(0)
         f = transform.get('from')
         if self.reverse:
             chars = UnicodeSets.parse(f).reverse()
@@ -331,38 +433,84 @@ class Rules(object):
                         j.default = Rule()
                     newjobs.add(j.default)
                 if isFinal:
-                    for j, string in newjobs:
-                        j.merge(transform.attrib)
+                    for j in newjobs:
+                        j.merge(transform.attrib, source)
             jobs = newjobs
 
-    def match(self, s, ind=0, partial=False, fail=False):
-        '''Finds the merged rule for the given passed in string.
+    def compile(self):
+        '''Flattens the trie into a DFA held in lists indexed by state:
+            a dict of the state each char leads to, the state any other
+            char leads to (or -1), the (before, after, rule) contexts in
+            which reaching the state matches a rule, and whether more
+            input could lead on from it. State 0 is the start.
+            Contexts are not folded into the states: a before context lies
+            behind where matching starts, so the DFA would have to start
+            each match earlier by a different amount for each rule. They
+            are flattened to strings when rules are appended and checked
+            only at the accepting states that have any, so lookahead, the
+            length of the longest after context, bounds how far past the
+            chars it walks a match may look.'''
+        nodes = [self.rules]
+        numbers = {id(self.rules): 0}
+        def number(n):
+            if n is None:
+                return -1
+            res = numbers.get(id(n))
+            if res is None:
+                res = numbers[id(n)] = len(nodes)
+                nodes.append(n)
+            return res
+        edges, defaults, accepts, more = [], [], [], []
+        for n in nodes:     # nodes grows as new ones are numbered
+            edges.append(dict((k, number(v)) for k, v in n.items()))
+            defaults.append(number(n.default))
+            accepts.append(n.accepts())
+            more.append(len(n) > 0)
+        self.states = (edges, defaults, accepts, more)
+        self.lookahead = max([len(a) for acc in accepts for (b, a, r) in acc] or [0])
+
+    def count(self, on=True):
+        '''Start counting, afresh, the matches of each source transform
+            in hits, or stop counting'''
+        self.hits = [0] * len(self.sources) if on else None
+
+    def match(self, s, ind=0, partial=False, fail=False, extent=False):
+        '''Finds the merged rule for the passed in string at index ind.
             Returns (rule, length) where length is how many chars from
             string were used to match rule.
-            Returns (None, 0) on failure'''
+            Returns (None, 0) on failure.
+            If extent, the index just past the chars of s the result depends
+            on, or len(s) + 1 if more input could change it, is appended'''
+        if self.states is None:
+            self.compile()
+        (edges, defaults, accepts, more) = self.states
         start = ind
         last = None
         lastind = start
-        curr = self.rules
-        if fail and s[ind] in curr:
+        state = 0
+        if fail and s[ind] in edges[0]:
             lastind = start + 1
-        while ind < len(s):
-            if s[ind] not in curr:
-                if curr.default:
-                    curr = curr.default
-                else:
-                    return (last, lastind - start)
-            curr = curr[s[ind]]
+        end = len(s)
+        stop = end + 1
+        while ind < end:
+            state = edges[state].get(s[ind], defaults[state])
+            if state < 0:
+                stop = ind + 1 + self.lookahead
+                break
             ind += 1
-            if curr.rule:
-                newlast = curr.context_match(s, start, ind)
-                if newlast is not None:
+            for (before, after, rule) in accepts[state]:
+                if s.endswith(before, 0, start) and s.startswith(after, ind):
                     lastind = ind
-                    last = newlast
-        if partial and len(curr):
-            return (None, ind - start)
+                    last = rule
+                    break
         else:
-            return (last, lastind - start)
+            if partial and more[state]:
+                return (None, ind - start, stop) if extent else (None, ind - start)
+            if not more[state] and defaults[state] < 0:
+                stop = end + self.lookahead     # no more input would be read
+        if self.hits is not None and last is not None:
+            self.hits[last.source] += 1
+        return (last, lastind - start, stop) if extent else (last, lastind - start)
         
 
 class Rule(dict):
@@ -373,27 +521,28 @@ class Rule(dict):
         self.rule = False
         self.default = None
         self.contexts = {}
+        self.source = None      # index of the transform that made the rule
 
     def __hash__(self):
         return hash(id(self))
 
-    def merge(self, e):
+    def merge(self, e, source=None):
         if 'before' in e or 'after' in e:
-            before = UnicodeSets.flatten(e.get('before', ""))
-            after = UnicodeSets.flatten(e.get('after', ""))
+            before = list(UnicodeSets.flatten(e.get('before', "")))
+            after = list(UnicodeSets.flatten(e.get('after', "")))
             for b in before or [""]:
                 for a in after or [""]:
                     k = (b, a)
                     if k == ("", ""):
-                        self._coremerge(e)
+                        self._coremerge(e, source)
                         continue
                     if k not in self.contexts:
                         self.contexts[k] = Rule()
-                    self.contexts[k]._coremerge(e) 
+                    self.contexts[k]._coremerge(e, source)
         else:
-            self._coremerge(e)
+            self._coremerge(e, source)
 
-    def _coremerge(self, e):
+    def _coremerge(self, e, source=None):
         for k, v in e.items():
             if k in ('from', 'before', 'after'):
                 continue
@@ -401,17 +550,21 @@ class Rule(dict):
         if 'to' in e:
             self.to = UnicodeSets.struni(e['to'])
         self.rule = True
+        self.source = source
 
-    def _matchcontext(self, m, s, beg, end):
-        return (not len(m[0]) or (len(m[0]) <= beg          and s[beg-len(m[0]):beg] == m[0])) \
-           and (not len(m[1]) or (len(m[1]) <= len(s) - end and s[end:end+len(m[1])] == m[1]))
+    def accepts(self):
+        '''Returns the (before, after, rule) contexts in which this
+            element matches, in the order they are tried. A rule without
+            context comes last.'''
+        res = [(b, a, r) for (b, a), r in self.contexts.items()]
+        if self.rule:
+            res.append(("", "", self))
+        return tuple(res)
 
     def context_match(self, s, beg, end):
-        if not len(self.contexts):
-            return self
-        for m, r in self.contexts.items():
-            if self._matchcontext(m, s, beg, end):
-                return r
+        for (before, after, rule) in self.accepts():
+            if s.endswith(before, 0, beg) and s.startswith(after, end):
+                return rule
         return None
 
 class Context(object):
@@ -431,6 +584,8 @@ class Context(object):
         self.offsets = [0] * len(self.slotnames)    # pointer into last layer output
                                                     # corresponding to end of stables
         self.offsets[0] = len(chars)
+        self.kept = [None] * len(self.slotnames)    # (input, steps) a layer keeps
+                                                    # for the next keystroke
         self.error = 0                              # are we in an error state?
 
     def clone(self, chars=""):
@@ -439,6 +594,7 @@ class Context(object):
         res.stables = self.stables[:]
         res.outputs = self.outputs[:]
         res.offsets = self.offsets[:]
+        res.kept = self.kept[:]
         res.stables[0] += chars
         res.outputs[0] += chars
         res.offsets[0] += len(chars)
@@ -469,6 +625,38 @@ class Context(object):
         ind = self.index(name)
         self.outputs[ind] = self.stables[ind]
 
+    def copy(self, name):
+        '''Pass the rest of the input through as output, stable as far
+            as the input is stable'''
+        ind = self.index(name)
+        instr = self.outputs[ind-1]
+        stable = len(self.stables[ind-1])
+        if stable > self.offsets[ind]:
+            self.stables[ind] += instr[self.offsets[ind]:stable]
+            self.offsets[ind] = stable
+        self.outputs[ind] = self.stables[ind] + instr[self.offsets[ind]:]
+
+    def keep(self, name, steps):
+        '''Keep what this layer made from its input for the next keystroke'''
+        ind = self.index(name)
+        self.kept[ind] = (self.outputs[ind-1], steps)
+
+    def reuse(self, name):
+        '''Return what this layer kept from its input at the last keystroke,
+            and the length of the start of that input that is unchanged'''
+        ind = self.index(name)
+        if self.kept[ind] is None:
+            return {}, 0
+        (old, steps) = self.kept[ind]
+        new = self.outputs[ind-1]
+        same = self.offsets[ind]
+        if old[:same] != new[:same]:
+            return {}, 0
+        end = min(len(old), len(new))
+        while same < end and old[same] == new[same]:
+            same += 1
+        return steps, same
+
     def results(self, name, length, res):
         '''Remove from input, in effect, and put result into stables'''
         ind = self.index(name)
@@ -482,6 +670,85 @@ class Context(object):
             self.offsets[ind] += length
 
 
+def read_tests(path):
+    '''Read a test corpus, one test per line: the key sequence, as given
+        to process_string, then a tab and the expected output. Lines without
+        a tab are run without checking their output. Blank lines and those
+        starting with # are ignored. Returns a list of (keys, expected)'''
+    res = []
+    with io.open(path, encoding="utf-8") as inf:
+        for l in inf:
+            l = l.rstrip(u"\r\n")
+            if not l.strip() or l.startswith(u"#"):
+                continue
+            if u"\t" in l:
+                keys, expected = l.split(u"\t", 1)
+                res.append((keys, UnicodeSets.struni(expected)))
+            else:
+                res.append((l, None))
+    return res
+
+
+def run_corpus(jobs, workers=None, chunksize=1 << 8):
+    '''Run each of an iterable of (keyboard path, tests) and yield, in
+        order, the report from Keyboard.run_tests for each, with the path
+        and the time taken to load the keyboard added. The tests are run in
+        chunks of chunksize across a pool of worker processes, each of which
+        loads a keyboard once for all the chunks of it that it runs. workers
+        defaults to the number of CPUs, if it is 0 the tests are run in this
+        process.'''
+    if workers == 0:
+        for path, tests in jobs:
+            start = time.time()
+            kbd = Keyboard(path)
+            load = time.time() - start
+            res = kbd.run_tests(tests)
+            res.update(keyboard=path, load=load)
+            yield res
+        return
+    import multiprocessing
+    chunks = ((n, path, tests[i:i+chunksize]) for n, (path, tests) in enumerate(jobs)
+                                              for i in range(0, max(len(tests), 1), chunksize))
+    pool = multiprocessing.Pool(workers)
+    try:
+        report = None
+        for n, path, load, part in pool.imap(_run_chunk, chunks):
+            if report is not None and report[0] != n:
+                yield report[1]
+                report = None
+            if report is None:
+                part.update(keyboard=path, load=load)
+                report = (n, part)
+                continue
+            res = report[1]
+            res['load'] = max(res['load'], load)
+            for k in ('tests', 'keystrokes', 'time', 'failures'):
+                res[k] += part[k]
+            for k, rules in res['rules'].items():
+                for r, p in zip(rules, part['rules'][k]):
+                    r['hits'] += p['hits']
+        if report is not None:
+            yield report[1]
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+# The keyboard last loaded by this worker process, as (path, Keyboard).
+_corpus_keyboard = None
+
+
+def _run_chunk(chunk):
+    global _corpus_keyboard
+    (n, path, tests) = chunk
+    load = 0.
+    if _corpus_keyboard is None or _corpus_keyboard[0] != path:
+        start = time.time()
+        _corpus_keyboard = (path, Keyboard(path))
+        load = time.time() - start
+    return (n, path, load, _corpus_keyboard[1].run_tests(tests))
+
+
 def main():
     '''Process a testfile of key sequences, one sequence per line,
         to give test results: comma separated for each keystroke,
@@ -489,17 +756,35 @@ def main():
     import argparse, codecs, sys
 
     parser = argparse.ArgumentParser()
-    parser.add_argument('file',help='Input LDML keyboard file')
+    parser.add_argument('file',nargs='+',help='Input LDML keyboard file')
     parser.add_argument('-t','--testfile',help='File of key sequences, one per line')
     parser.add_argument('-o','--outfile',help='Where to send results')
+    parser.add_argument('-j','--json',action='store_true',
+                        help='Run each keyboard against a test corpus, the testfile or the '
+                             'keyboard file with a .tests extension, and report as JSON')
+    parser.add_argument('-w','--workers',type=int,help='Worker processes for --json [number of CPUs]')
     args = parser.parse_args()
 
-    kbd = Keyboard(args.file)
+    if args.json:
+        start = time.time()
+        jobs = ((f, read_tests(args.testfile or os.path.splitext(f)[0] + '.tests')) for f in args.file)
+        res = dict(keyboards=list(run_corpus(jobs, workers=args.workers)))
+        res['time'] = time.time() - start
+        outfile = open(args.outfile, "w") if args.outfile else sys.stdout
+        json.dump(res, outfile, indent=1, separators=(",", ": "), sort_keys=True)
+        outfile.write("\n")
+        if args.outfile:
+            outfile.close()
+        return
+    elif len(args.file) > 1:
+        parser.error('only --json takes more than one keyboard')
+
+    kbd = Keyboard(args.file[0])
     if args.outfile:
         outfile = codecs.open(args.outfile, "w", encoding="utf-8")
     else:
-        outfile = codecs.EncodedFile(sys.stdout, "utf-8")
-    with open(args.testfile) as inf:
+        outfile = codecs.getwriter("utf-8")(getattr(sys.stdout, 'buffer', sys.stdout))
+    with io.open(args.testfile, encoding="utf-8") as inf:
         for l in inf.readlines():
             res = list(kbd.process_string(l))
             outfile.write(u", ".join(map(unicode, res)) + u"\n")
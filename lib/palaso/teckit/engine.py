@@ -11,7 +11,13 @@
 from __future__ import with_statement, absolute_import
 
 from palaso.teckit import _engine
-import codecs, sys
+from contextlib import contextmanager
+import codecs, sys, threading, time
+
+try:
+    unicode
+except NameError:
+    unicode = str
 
 from palaso.teckit._engine import getVersion, memoize
 from palaso.teckit._engine import Option
@@ -83,11 +89,14 @@ def _form_from_flags(form, flags):
 
 
 class Converter(object):
+    _memo_limit = 256
+    
     def __init__(self, mapping, forward=True,source=Form.Unspecified,target=Form.Unspecified):
         source = _form_from_flags(source, mapping.lhsFlags if forward else mapping.rhsFlags)
         target = _form_from_flags(target, mapping.rhsFlags if forward else mapping.lhsFlags)
         self._converter = _engine.createConverter(mapping, len(mapping), forward, source, target)
         self._buffer    = _engine.create_string_buffer(80*4)
+        self._expansion = 1.0
     
     
     def __del__(self):
@@ -136,7 +145,7 @@ class Converter(object):
         name = (self.lhsName + '<->' + self.rhsName).lower()
         errtype = UnicodeEncodeError if self.sourceFlags.unicode else UnicodeDecodeError
         if self.sourceFlags.unicode:
-            end = cons/4
+            end = cons//4
             end -= (lhc if end != len(input) else 0)
             start = end -1
         else:
@@ -151,50 +160,227 @@ class Converter(object):
         return _unicode_decoder(data)[0] if self.targetFlags.unicode else data
     
     
-    def convert(self, input, finished=False, options=Option.UseReplacementCharSilently):
-        # Validate input parameters and do an necessary conversions
-        if self.sourceFlags.unicode and isinstance(input,str):
-            raise TypeError("source is type 'str' but type 'unicode' is expected")
-        if not self.sourceFlags.unicode and isinstance(input, unicode):
-            raise TypeError("source is type 'unicode' but type 'str' is expected")    
-        data = _unicode_encoder(input)[0] if self.sourceFlags.unicode else input
+    def _coerce_from_source(self, input):
+        if self.sourceFlags.unicode:
+            if isinstance(input, bytes):
+                raise TypeError("source is type 'str' but type 'unicode' is expected")
+            return _unicode_encoder(input)[0]
+        if isinstance(input, unicode):
+            raise TypeError("source is type 'unicode' but type 'str' is expected")
+        return input
+    
+    
+    def _output_buffer(self, size):
+        # The buffer is kept between calls and only ever grows.
+        if size > len(self._buffer):
+            self._buffer = _engine.create_string_buffer(size)
+        return self._buffer
+    
+    
+    def _convert(self, input, data, finished, options, res):
+        # Convert the source encoded data appending the raw output chunks to
+        #  res.  The output buffer is sized from the largest output to input
+        #  ratio seen so far and doubled whenever TECkit reports it full.
+        convert = _engine.convertBufferOpt
+        converter = self._converter
         options |= finished and Option.InputIsComplete
         
-        buf = self._buffer; cons = outs = 0; res = ''
+        buf = self._output_buffer(int(len(data)*self._expansion) + 64)
+        done = 0
         while data:
+            full = False
             try:
-                cons,outs,lhc = _engine.convertBufferOpt(self._converter, 
-                                                         data, len(data), 
-                                                         buf, len(buf), 
-                                                         options)
-            except FullBuffer as e: pass
+                cons,outs,lhc = convert(converter, data, len(data), 
+                                        buf, len(buf), options)
+            except FullBuffer as e:
+                cons,outs,lhc = e.args
+                full = True
             except EmptyBuffer as e:
                 if finished: 
-                    raise self._unicode_error('expected more data.')
+                    raise UnicodeError('expected more data.')
+                cons,outs,lhc = e.args
             except UnmappedChar as err:
-                self._handle_unmapped_char(input, 'convert', err)
+                self._handle_unmapped_char(input, 'convert', 
+                                           done + err.args[0], *err.args[1:])
             
-            res += self._coerce_to_target(str(buf[:outs]))
+            res.append(buf[:outs])
+            if cons and outs > cons*self._expansion:
+                self._expansion = float(outs)/cons
+            if full:
+                buf = self._output_buffer(2*len(buf))
+            done += cons
             data = data[cons:]
         
         if finished:
-            res += self.flush()
+            self._flush(input, done, options, res)
         return res
     
     
-    def flush(self,finished=True,options=Option.UseReplacementCharSilently):
-        options |= finished and Option.InputIsComplete
-        
-        buf = self._buffer; outs = 0; res  = ''
+    def _flush(self, input, done, options, res):
+        buf = self._buffer
         while True:
             try:
                 outs,lhc = _engine.flushOpt(self._converter, 
                                             buf, len(buf), 
                                             options)
-                return res + self._coerce_to_target(str(buf[:outs]))
-            except FullBuffer as outs:
-                res += self._coerce_to_target(str(buf[:outs]))
+                res.append(buf[:outs])
+                return res
+            except FullBuffer as e:
+                res.append(buf[:e.args[0]])
+                buf = self._output_buffer(2*len(buf))
             except UnmappedChar as err:
-                self._handle_unmapped_char(input, 'flush', err)
+                self._handle_unmapped_char(input, 'flush', done, err.args[0], 1)
+    
+    
+    def convert(self, input, finished=False, options=Option.UseReplacementCharSilently):
+        data = self._coerce_from_source(input)
+        return self._coerce_to_target(b''.join(
+                    self._convert(input, data, finished, options, [])))
+    
+    
+    def convert_many(self, inputs, options=Option.UseReplacementCharSilently):
+        '''Convert each of a sequence of complete texts, such as the text
+           nodes of a document, yielding the results in order.  The output
+           buffer is shared between them, and a text seen before in the same
+           batch is not passed to TECkit again.'''
+        coerce_from, coerce_to = self._coerce_from_source, self._coerce_to_target
+        convert, join = self._convert, b''.join
+        seen = {}
+        for input in inputs:
+            res = seen.get(input)
+            if res is None:
+                data = coerce_from(input)
+                res = coerce_to(join(convert(input, data, True, options, [])))
+                if len(input) <= self._memo_limit: seen[input] = res
+            yield res
+    
+    
+    def convert_stream(self, stream, size=64*1024, 
+                       options=Option.UseReplacementCharSilently):
+        '''Convert the whole of a file object, read size items at a time,
+           yielding the converted text as it becomes available.  The stream
+           must yield unicode if the source side of the mapping is Unicode
+           and byte strings otherwise.'''
+        read = stream.read
+        coerce_from, coerce_to = self._coerce_from_source, self._coerce_to_target
+        input = read(size)
+        while input:
+            following = read(size)
+            data = coerce_from(input)
+            yield coerce_to(b''.join(self._convert(input, data, not following, 
+                                                   options, [])))
+            input = following
+    
+    
+    def flush(self,finished=True,options=Option.UseReplacementCharSilently):
+        options |= finished and Option.InputIsComplete
+        input = u'' if self.sourceFlags.unicode else b''
+        return self._coerce_to_target(b''.join(self._flush(input, 0, options, [])))
+
 
 
+class ConverterPool(object):
+    '''
+    A thread safe pool of Converters shared between worker threads.
+    Converters are kept per mapping, direction and source and target forms,
+    at most size of each, and are reset before being handed out again.  A
+    thread asking for a converter when all of them are in use waits for one
+    to be released, up to timeout seconds if given, before raising
+    ConverterBusy.
+    
+    The hits, misses and waits attributes count requests met by an idle
+    converter, requests that created a new one, and requests that had to
+    wait, and wait_time is the total time spent waiting.
+    '''
+    def __init__(self, size=4, timeout=None):
+        self.size = size
+        self.timeout = timeout
+        self.hits = self.misses = self.waits = 0
+        self.wait_time = 0.0
+        self._lock = threading.Condition()
+        self._idle = {}     # key to list of idle converters
+        self._made = {}     # key to number of converters in existence
+    
+    
+    def acquire(self, mapping, forward=True, source=Form.Unspecified, target=Form.Unspecified):
+        '''Take a converter out of the pool, creating one if there is
+           room.  It must be given back with release.'''
+        key = (mapping, forward, source, target)
+        with self._lock:
+            waited = None
+            while True:
+                idle = self._idle.get(key)
+                if idle:
+                    self.hits += 1
+                    conv = idle.pop()
+                    break
+                if self._made.get(key, 0) < self.size:
+                    self.misses += 1
+                    self._made[key] = self._made.get(key, 0) + 1
+                    conv = None
+                    break
+                now = time.time()
+                if waited is None:
+                    self.waits += 1
+                    waited = now
+                elif self.timeout is not None and now - waited >= self.timeout:
+                    self.wait_time += now - waited
+                    raise ConverterBusy('no converter released within %ss: %r'
+                                        % (self.timeout, mapping))
+                self._lock.wait(None if self.timeout is None 
+                                     else self.timeout - (now - waited))
+            if waited is not None:
+                self.wait_time += time.time() - waited
+        
+        if conv is None:
+            try:
+                conv = Converter(mapping, forward, source, target)
+            except:
+                self._discard(key)
+                raise
+        conv._pool_key = key
+        return conv
+    
+    
+    def release(self, conv):
+        '''Reset a converter taken with acquire and return it to the pool.'''
+        key = conv._pool_key
+        try:
+            conv.reset()
+        except:
+            self._discard(key)
+            raise
+        with self._lock:
+            self._idle.setdefault(key, []).append(conv)
+            self._lock.notify_all()
+    
+    
+    def _discard(self, key):
+        with self._lock:
+            self._made[key] -= 1
+            self._lock.notify_all()
+    
+    
+    @contextmanager
+    def converter(self, mapping, forward=True, source=Form.Unspecified, target=Form.Unspecified):
+        '''Use a pooled converter for the duration of a with statement.'''
+        conv = self.acquire(mapping, forward, source, target)
+        try:
+            yield conv
+        finally:
+            self.release(conv)
+    
+    
+    def convert(self, mapping, input, forward=True, options=Option.UseReplacementCharSilently,
+                source=Form.Unspecified, target=Form.Unspecified):
+        '''Convert the complete text input with a pooled converter.'''
+        with self.converter(mapping, forward, source, target) as conv:
+            return conv.convert(input, finished=True, options=options)
+    
+    
+    def stats(self):
+        '''Return the pool's counters and the number of converters made.'''
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses, waits=self.waits,
+                        wait_time=self.wait_time, 
+                        converters=sum(self._made.values()))
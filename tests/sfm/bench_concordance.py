@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+'''
+Measure word concordance building on a synthetic USFM corpus, comparing
+palaso.sfm.concordance against the groupby/unicodedata word splitting and
+sets of formatted reference strings previously used by the concordance
+script.  The books are parsed before timing starts.
+'''
+import collections, operator, sys, time, unicodedata, warnings
+from itertools import groupby
+from functools import reduce
+from optparse import OptionParser
+
+import palaso.sfm as sfm
+from palaso.sfm import usfm, concordance
+import usfm_corpus
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    from itertools import ifilter, imap
+except ImportError:
+    ifilter, imap = filter, map
+
+
+def legacy_word_char(char, __ucd_category=unicodedata.category):
+    return __ucd_category(char) in concordance.word_cat
+
+def legacy_words(text):
+    joiner = u''.join
+    return imap(joiner,
+                imap(operator.itemgetter(1),
+                     ifilter(operator.itemgetter(0),
+                             groupby(text, legacy_word_char))))
+
+def legacy_book(doc):
+    '''The concordance script's per book word references map.'''
+    refs = collections.defaultdict(set)
+    doc = sfm.sfilter(sfm.text_properties('publishable','vernacular'),
+                      usfm.decorate_references(doc))
+    for txt in sfm.sreduce(lambda e,ts,_: ts, lambda e,ts: ts.append(e) or ts, doc, []):
+        for word in legacy_words(txt):
+            refs[word].add('{r.book} {r.chapter}:{r.verse}'.format(r=txt.pos))
+    return refs
+
+
+def legacy(docs):
+    refs = collections.defaultdict(set)
+    for doc in docs:
+        for w, rs in legacy_book(doc).items(): refs[w] |= rs
+    return refs
+
+
+def current(docs):
+    classes = concordance.word_classes()
+    refs = concordance.postings()
+    for doc in docs:
+        concordance.book(doc, classes, refs=refs)
+    return refs
+
+
+def measure(f, docs):
+    start = time.time()
+    res = f(docs)
+    t = time.time() - start
+    size = None
+    if tracemalloc:
+        del res
+        tracemalloc.start()
+        res = f(docs)
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+    return res, t, size
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options]\n' + __doc__)
+    parser.add_option('-b','--books',type='int',default=66,help='Number of books [%default]')
+    parser.add_option('-c','--chapters',type='int',default=20,help='Chapters per book [%default]')
+    (opts, args) = parser.parse_args()
+
+    warnings.simplefilter('ignore')
+    books = usfm_corpus.corpus(usfm_corpus.books[:opts.books], opts.chapters)
+    docs = [list(usfm.parser(lines)) for _, lines in books]
+    sys.stdout.write('corpus: {0} books\n'.format(len(docs)))
+
+    # Measure the copies of the parse the legacy code makes in its own time.
+    new, tn, mn = measure(current, docs)
+    old, to, mo = measure(legacy, docs)
+    assert sorted(old) == sorted(new.words), 'word lists differ'
+    assert all(sorted(old[w]) == new.references(w) for w in old), 'references differ'
+    for name, t, m in (('legacy', to, mo), ('postings', tn, mn)):
+        sys.stdout.write('{0:>9}: {1:7.2f}s'.format(name, t))
+        if m is not None:
+            sys.stdout.write(' {0:8.1f} MB retained'.format(m/float(1<<20)))
+        sys.stdout.write('\n')
+    sys.stdout.write('{0} words, {1} references\n'.format(len(new), new.count()))
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+'''
+Measure the usfmtec text transducer on a synthetic New Testament with a
+large CSV dictionary of word, phrase and morph replacements, comparing
+palaso.sfm.conversion against the per node regular expressions and per
+word morph alternation previously used by the usfmtec script.  The books
+are parsed before timing starts and no encoding converter is used.
+'''
+import os, random, re, shutil, sys, tempfile, time, unicodedata, warnings
+from itertools import groupby
+from optparse import OptionParser
+
+from palaso.sfm import usfm, conversion
+import usfm_corpus
+
+if sys.version_info[0] < 3:
+    import palaso.unicsv as csv
+    csv_mode = 'rb'
+else:
+    import csv
+    csv_mode = 'r'
+
+
+# The usfmtec transducer as it was, with its options passed in decoded and
+#  the inline morph pattern flags moved to the front for Python 3.
+word_cat = set(['Lu', 'Ll', 'Lt', 'Lm', 'Lo', 'Mn', 'Mc', 'Me', 'Pd', 'Cs', 'Co', 'Cn'])
+
+def isword(char):
+    return unicodedata.category(char) in word_cat
+
+def aswords(txt):
+    g = [(i[0], "".join(i[1])) for i in groupby(txt, isword)]
+    res = [i[1] for i in g]
+    if not g[0][0]: res.insert(0, "")
+    return res
+
+class legacy_transducer(object):
+    def __init__(self, oquotes, cquotes, punc):
+        self.caps = [1]
+        self.oquotes, self.cquotes, self.punc = oquotes, cquotes, punc
+        self.capquotes = oquotes
+        self.case = ''
+        self.enc = conversion.notec()
+        self.tags, self.dict, self.phrases, self.phrase_keys = {}, {}, {}, {}
+        self.morphs = {}
+        self.morph_keys = ''
+        self.morphid = '!'
+        self.ctags = self.calltags = set()
+
+    def load_dict(self, entries, incol, outcol, tagcol=None):
+        morph_keys = []
+        maxcol = max(incol, outcol, tagcol)
+        for e in entries:
+            if len(e) <= maxcol or (len(e[0]) and e[0][0] == "#"): continue
+            k = self.enc.convert(e[incol], finished=True).strip()
+            if k.find(self.morphid) != -1:
+                if k[0] != self.morphid:
+                    mk = '^' + k
+                else:
+                    mk = k[1:]
+                    k = k[1:]
+                if k[-1] != self.morphid:
+                    mk = mk + '$'
+                else:
+                    k = k[0:-1]
+                    mk = mk[0:-1]
+                morph_keys.append(mk)
+                self.morphs[k] = e[outcol].strip()
+            elif len([c for c in k if isword(c)]) != len(k):
+                self.phrases[k] = e[outcol].strip()
+            else:
+                self.dict[k] = e[outcol].strip()
+            if tagcol != None and e[tagcol]:
+                self.tags[k] = set(e[tagcol].split())
+        morph_keys.sort(key=lambda x: -len(x))
+        self.morph_keys = "|".join(morph_keys)
+        for k in sorted(self.phrases.keys(), key=lambda x: -len(x)):
+            p = aswords(k)
+            self.phrase_keys.setdefault(p[0], []).append(p)
+
+    def element_start(self, node):
+        if node.meta.get('StyleType') == 'Note': self.caps.append(1)
+        return node
+
+    def element_end(self, node):
+        if node.meta.get('StyleType') == 'Note': self.caps.pop()
+
+    def convert_node(self, tnode):
+        if tnode.parent and not (set(tnode.parent.meta['TextProperties']) & set(('publishable', 'vernacular'))):
+            return tnode
+        if tnode.parent and ((tnode.parent.meta.get('StyleType') == 'Paragraph' and tnode is tnode.parent[0]) or tnode.parent.name in self.ctags):
+            self.caps[-1] = 1
+        self.tnode = tnode
+        return re.sub(u'[^\x00-\x1f]+', self.convert, tnode)
+
+    def convert(self, match):
+        res = self.enc.convert(match.group(0), finished=True)
+        if res.strip() == '': return res
+        if self.caps[-1]:
+            res = re.sub(u'^([\\s' + self.oquotes + u']*)(.)',
+                            lambda m: m.group(1) + m.group(2).upper(), res)
+        if re.search(u'[{1}][{0}]*\\s*$'.format(self.cquotes, self.punc), res):
+            self.caps[-1] = 1
+        elif re.search(u'[{0}]+\\s*$'.format(self.cquotes), res):
+            pass
+        elif re.match(u'^\\s*\\S', res):
+            self.caps[-1] = 0
+        rlist = aswords(res)
+        res = ""
+        while len(rlist):
+            l = len(rlist)
+            wd = rlist.pop(0)
+            if wd:
+                case = wd[0].isupper()
+                wd = wd[0].lower() + wd[1:]
+                found = False
+                if wd in self.phrase_keys:
+                    for p in self.phrase_keys[wd]:
+                        if len(p) <= l and p[1:] == rlist[0:len(p)-1]:
+                            s = "".join(p)
+                            if s in self.tags and self.tnode.parent.name not in self.tags[s]: continue
+                            del rlist[0:len(p)-1]
+                            wd = self.phrases[s]
+                            found = True
+                            break
+                if not found and wd in self.dict and (not wd in self.tags or self.tnode.parent.name in self.tags[wd]):
+                    wd = self.dict[wd]
+                    found = True
+                elif self.morph_keys and not found:
+                    wd = re.sub('(?iu)(' + self.morph_keys + ')',
+                                lambda m: self.morphs[m.group(1)] if m.group(1) not in self.tags or self.tnode.parent.name in self.tags[wd] else m.group(1), wd)
+                if case:
+                    wd = wd[0].upper() + wd[1:]
+            if len(rlist):
+                res += wd + rlist.pop(0)
+            else:
+                res += wd
+        res = re.sub(u'([{0}][{1}\\s]*[{2}\\s]*)(.)'.format(self.punc, self.cquotes, self.oquotes), lambda m: m.group(1) + (m.group(2).upper() if isword(m.group(2)[0]) else m.group(2)), res)
+        if self.tnode.parent and (self.tnode.parent.meta['TextType'] == 'Title' or self.tnode.parent.name in self.calltags) and self.capquotes:
+            res = re.sub(u'(^\\s*|\\s)([' + self.capquotes + u']*)(.)', lambda m: m.group(1) + m.group(2) + (m.group(3).upper() if isword(m.group(3)[0]) else m.group(3)), res)
+        elif self.capquotes:
+            res = re.sub(u'(?<=[' + self.capquotes + u'])([' + self.oquotes + u']*)(.)', lambda m: m.group(1) + m.group(2).upper() if isword(m.group(2)[0]) else m.group(1) + m.group(2), res)
+        return res
+
+
+def dictionary(size, seed=1):
+    '''Return size rows of word, phrase and morph replacements, with marker
+       limits on a few of the words and phrases.'''
+    rng = random.Random(seed)
+    words = set()
+    while len(words) < size * 9 // 10:
+        words.add(usfm_corpus.word(rng))
+    # The old transducer shares marker limits between words and morphs of
+    #  the same spelling, so keep the limited words apart from the morphs.
+    rows = [[w, w.upper(), 'nd' if len(w) > 3 and rng.random() < 0.05 else '']
+            for w in sorted(words)]
+    while len(rows) < size - len(usfm_corpus._syllables):
+        p = u'{0} {1}'.format(usfm_corpus.word(rng), usfm_corpus.word(rng))
+        rows.append([p, p.replace(u' ', u'_'), 'p' if rng.random() < 0.1 else ''])
+    # It also keys morph replacements on the stem alone, so prefixes and
+    #  suffixes are given different stems.
+    for i, s in enumerate(usfm_corpus._syllables):
+        rows.append([s + u'!', s.upper() + u'-', ''] if i % 2 else
+                    [u'!' + s, u'-' + s.upper(), ''])
+    return rows
+
+
+def transduce(conv, docs):
+    return [conversion.sfmmap(conv.element_start, conv.element_end, conv.convert_node, d)
+            for d in docs]
+
+
+def timed(f, *args):
+    start = time.time()
+    res = f(*args)
+    return res, time.time() - start
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options]\n' + __doc__)
+    parser.add_option('-c','--chapters',type='int',default=10,help='Chapters per book [%default]')
+    parser.add_option('-d','--dictionary',type='int',default=50000,help='Dictionary entries [%default]')
+    (opts, args) = parser.parse_args()
+    warnings.simplefilter('ignore')
+
+    books = usfm_corpus.corpus(usfm_corpus.new_testament, opts.chapters)
+    # The transducers rewrite the documents in place, so each gets a copy.
+    docs = [list(usfm.parser(lines)) for _, lines in books]
+    copy = [list(usfm.parser(lines)) for _, lines in books]
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, 'dict.csv')
+        with open(path, 'wb') as f:
+            for r in dictionary(opts.dictionary):
+                f.write(u','.join(r).encode('utf_8') + b'\n')
+        with open(path, csv_mode) as f:
+            rows = list(csv.reader(f))
+    finally:
+        shutil.rmtree(tmp)
+    sys.stdout.write('corpus: {0} books, {1} dictionary entries\n'.format(len(docs), len(rows)))
+
+    quotes = dict(oquotes=u'\'"\u2018\u201c\\[{(<\u00ab',
+                  cquotes=u'\'"\u2019\u201d\\]})>\u00bb', punc=u'.!?')
+    old = legacy_transducer(**quotes)
+    _, lo = timed(old.load_dict, rows, 0, 1, 2)
+    lex = conversion.lexicon(conversion.tokenizer())
+    _, ln = timed(lex.load, rows, 0, 1, 2)
+    new = conversion.transducer(lexicon=lex, openquotes=quotes['oquotes'],
+                                closequotes=quotes['cquotes'], sentencepunc=quotes['punc'])
+
+    ro, to = timed(transduce, old, docs)
+    rn, tn = timed(transduce, new, copy)
+    assert rn == ro, 'converted text differs'
+    sys.stdout.write('  legacy: load {0:6.2f}s  convert {1:7.2f}s\n'.format(lo, to))
+    sys.stdout.write('   tries: load {0:6.2f}s  convert {1:7.2f}s\n'.format(ln, tn))
+
+    # Reconvert with a paragraph cache, after editing one verse per book.
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, 'paragraphs.cache')
+        edited = [[l.rstrip(u'\n') + u' edited\n' if i == 100 else l
+                   for i, l in enumerate(lines)] for _, lines in books]
+        for run, src in (('cold', [ls for _, ls in books]), ('warm', edited)):
+            docs = [list(usfm.parser(lines)) for lines in src]
+            (cache, _), tl = timed(lambda: (conversion.paragraph_cache(path, [b'bench']), 0))
+            new = conversion.transducer(lexicon=lex, openquotes=quotes['oquotes'],
+                                        closequotes=quotes['cquotes'], sentencepunc=quotes['punc'],
+                                        cache=cache)
+            rc, tc = timed(lambda: [new(d) for d in docs])
+            _, ts = timed(cache.save)
+            sys.stdout.write('  {0} cache: load {1:5.2f}s  convert {2:6.2f}s  save {3:5.2f}s'
+                             '  {4.hits} hits {4.misses} misses\n'.format(run, tl, tc, ts, cache))
+        assert rc == [transduce(new, [d])[0] for d in
+                      [list(usfm.parser(lines)) for lines in edited]], 'cached text differs'
+    finally:
+        shutil.rmtree(tmp)
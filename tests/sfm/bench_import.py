@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+'''
+Measure the start up cost of palaso.sfm.usfm in fresh interpreters: the
+time to import the module and the time to import it and construct the
+first parser, which loads the default stylesheet from its cache.  Also
+compares loading the stylesheet cache with loading the bz2 compressed
+pickle it replaced.
+'''
+import bz2, marshal, os, pickle, subprocess, sys, tempfile, time
+from optparse import OptionParser
+
+
+def run(statement, repeat):
+    cmd = [sys.executable, '-c', statement]
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        subprocess.check_call(cmd)
+        t = time.time() - start
+        best = t if best is None else min(best, t)
+    return best
+
+
+def load(f, path, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        f(path)
+    return (time.time() - start) / repeat
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options]\n' + __doc__)
+    parser.add_option('-r','--repeat',type='int',default=10,help='Timing runs, best is reported [%default]')
+    (opts, args) = parser.parse_args()
+    
+    base = run('pass', opts.repeat)
+    imp = run('import palaso.sfm.usfm', opts.repeat)
+    first = run('import palaso.sfm.usfm as u; u.parser([])', opts.repeat)
+    sys.stdout.write('interpreter:        {0:8.2f} ms\n'.format(base*1000))
+    sys.stdout.write('import:             {0:8.2f} ms\n'.format((imp-base)*1000))
+    sys.stdout.write('import + parser():  {0:8.2f} ms\n'.format((first-base)*1000))
+    
+    from palaso.sfm import usfm
+    sheet = usfm.default_stylesheet.copy()
+    _, cached_path = usfm._cached_stylesheet('usfm.sty')
+    fd, pickled_path = tempfile.mkstemp()
+    with os.fdopen(fd, 'wb') as f:
+        f.write(bz2.compress(pickle.dumps(sheet)))
+    try:
+        def load_bz2(p): 
+            with open(p, 'rb') as f: return pickle.loads(bz2.decompress(f.read()))
+        def load_marshal(p):
+            with open(p, 'rb') as f: return marshal.loads(f.read())
+        sys.stdout.write('bz2 pickle load:    {0:8.2f} ms\n'.format(load(load_bz2, pickled_path, opts.repeat)*1000))
+        sys.stdout.write('cache load:         {0:8.2f} ms\n'.format(load(load_marshal, cached_path, opts.repeat)*1000))
+    finally:
+        os.unlink(pickled_path)
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+'''
+Measure SFM lexer throughput in MB/s on a synthetic multi-book USFM corpus,
+comparing the block tokenising lexer against the previous per-line
+finditer/groupby/text.concat pipeline.
+'''
+import operator, re, sys, time
+from itertools import chain, groupby
+from optparse import OptionParser
+
+import palaso.sfm as sfm
+from palaso.sfm import text, position
+import usfm_corpus
+
+try:
+    from itertools import imap
+except ImportError:
+    imap = map
+
+_tokeniser = re.compile(r'(?<!\\)\\[^\s\\]+|(?:\\\\|[^\\])+',re.DOTALL | re.UNICODE)
+
+def line_lexer(lines):
+    '''The per line lexer pipeline the block lexer replaced.'''
+    lmss = enumerate(imap(_tokeniser.finditer, lines))
+    fs = (text(m.group(), position(l+1,m.start()+1)) for l,ms in lmss for m in ms)
+    gs = groupby(fs, operator.methodcaller('startswith','\\'))
+    return chain.from_iterable(g if istag else (text.concat(g),) for istag,g in gs)
+
+block_lexer = sfm.parser._parser__lexer
+
+
+def run(lexer, books, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        n = 0
+        for _, lines in books:
+            for _ in lexer(lines): n += 1
+        t = time.time() - start
+        best = t if best is None else min(best, t)
+    return best, n
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options]\n' + __doc__)
+    parser.add_option('-b','--books',type='int',default=66,help='Number of books [%default]')
+    parser.add_option('-c','--chapters',type='int',default=20,help='Chapters per book [%default]')
+    parser.add_option('-r','--repeat',type='int',default=3,help='Timing runs, best is reported [%default]')
+    (opts, args) = parser.parse_args()
+    
+    books = usfm_corpus.corpus(usfm_corpus.books[:opts.books], opts.chapters)
+    size = sum(len(l.encode('utf-8')) for _,b in books for l in b) / float(1<<20)
+    sys.stdout.write('corpus: {0} books, {1:.1f} MB\n'.format(len(books), size))
+    for name, lexer in (('line', line_lexer), ('block', block_lexer)):
+        t, n = run(lexer, books, opts.repeat)
+        sys.stdout.write('{0:>6} lexer: {1:8.2f} MB/s {2:9d} tokens {3:6.2f}s\n'.format(name, size/t, n, t))
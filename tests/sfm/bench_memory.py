@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+'''
+Measure the memory held by parsed USFM trees in bytes per node on a
+synthetic New Testament, comparing the slotted text nodes and line table
+offsets against the previous representation of a text subclass with an
+instance dict, a position tuple per node and an annotations dict per
+element.  Requires Python 3 for tracemalloc.
+'''
+import gc, sys, tracemalloc, warnings
+from optparse import OptionParser
+
+import palaso.sfm as sfm
+from palaso.sfm import usfm, position
+import usfm_corpus
+
+try:
+    unicode
+except NameError:
+    unicode = str
+
+
+class legacy_text(unicode):
+    def __new__(cls, content, pos, parent):
+        return super(legacy_text, cls).__new__(cls, content)
+
+    def __init__(self, content, pos, parent):
+        self.pos = pos
+        self.parent = parent
+
+
+class legacy_element(list):
+    __slots__ = ('pos', 'name', 'args', 'parent', 'meta', 'annotations')
+
+
+def legacy_copy(doc, parent=None):
+    res = []
+    for n in doc:
+        if isinstance(n, sfm.element):
+            e = legacy_element()
+            e.pos = position(*n.pos)
+            e.name, e.args, e.parent, e.meta = n.name, n.args, parent, n.meta
+            e.annotations = dict(n._annotations or {})
+            e.extend(legacy_copy(n, e))
+            res.append(e)
+        else:
+            res.append(legacy_text(unicode(n), position(*n.pos), parent))
+    return res
+
+
+def count(doc):
+    return sum(1 + (count(n) if isinstance(n, sfm.element) else 0) for n in doc)
+
+
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    res = build()
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    return res, size
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options]\n' + __doc__)
+    parser.add_option('-c','--chapters',type='int',default=10,help='Chapters per book [%default]')
+    (opts, args) = parser.parse_args()
+    
+    books = usfm_corpus.corpus(usfm_corpus.new_testament, opts.chapters)
+    warnings.simplefilter('ignore', SyntaxWarning)
+    usfm.default_stylesheet.copy()  # Keep the stylesheet out of the figures.
+    docs, after = measure(lambda: [list(usfm.parser(b)) for _,b in books])
+    nodes = sum(map(count, docs))
+    _, before = measure(lambda: [legacy_copy(d) for d in docs])
+    sys.stdout.write('{0} books, {1} nodes\n'.format(len(docs), nodes))
+    sys.stdout.write('before: {0:8.1f} bytes/node {1:8.1f} MB\n'.format(before/float(nodes), before/float(1<<20)))
+    sys.stdout.write(' after: {0:8.1f} bytes/node {1:8.1f} MB\n'.format(after/float(nodes), after/float(1<<20)))
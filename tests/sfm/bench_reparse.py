@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+'''
+Measure the latency of bringing a parsed USFM book up to date after a one
+line edit, comparing usfm.reparse against parsing the whole book again.
+'''
+import sys, time, warnings
+from optparse import OptionParser
+
+from palaso.sfm import usfm
+import usfm_corpus
+
+
+def edits(lines, count):
+    '''Yield (new lines, edits) for count successive single verse edits
+       spread through the book.'''
+    verses = [i for i,l in enumerate(lines) if l.startswith(u'\\v ')]
+    for k in range(count):
+        i = verses[k * len(verses) // count]
+        lines = list(lines)
+        lines[i] = lines[i].rstrip(u'\n') + u' edited\n'
+        yield lines, [(i, i+1, i, i+1)]
+
+
+def run(f, book, count):
+    start = time.time()
+    for new, es in edits(book, count):
+        f(new, es)
+    return (time.time() - start) / count
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options]\n' + __doc__)
+    parser.add_option('-c','--chapters',type='int',default=50,help='Chapters in the book [%default]')
+    parser.add_option('-v','--verses',type='int',default=30,help='Verses per chapter [%default]')
+    parser.add_option('-n','--edits',type='int',default=50,help='Number of edits timed [%default]')
+    (opts, args) = parser.parse_args()
+    warnings.simplefilter('ignore')
+
+    book = usfm_corpus.book('GEN', opts.chapters, opts.verses)
+    doc = list(usfm.parser(book))
+    sys.stdout.write('book: {0} lines\n'.format(len(book)))
+    full = run(lambda new, es: list(usfm.parser(new)), book, opts.edits)
+    incr = run(lambda new, es: usfm.reparse(doc, new, es), book, opts.edits)
+    sys.stdout.write('   full parse: {0:8.2f} ms/edit\n'.format(full*1000))
+    sys.stdout.write('      reparse: {0:8.2f} ms/edit\n'.format(incr*1000))
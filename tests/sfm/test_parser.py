@@ -4,10 +4,10 @@ Created on Nov 2, 2009
 @author: tim_eves@sil.org
 '''
 import unittest
-import codecs, itertools, operator, warnings
+import codecs, io, itertools, operator, os, shutil, sys, tempfile, warnings
 
 import palaso.sfm as sfm
-from palaso.sfm import usfm, text, handler
+from palaso.sfm import usfm, text, handler, concordance, conversion
 
 try:
     from itertools import imap
@@ -34,6 +34,21 @@ def flatten(doc):
             for c in flatten(e): yield c
     return itertools.chain.from_iterable(imap(_g, doc))
 
+def unstream(events):
+    root = []
+    stack = [root]
+    for ev, n in events:
+        if ev == 'start':
+            e = sfm.element(n.name, n.pos, n.args, meta=n.meta)
+            e.annotations = n.annotations
+            stack[-1].append(e)
+            stack.append(e)
+        elif ev == 'end':
+            stack.pop()
+        else:
+            stack[-1].append(n)
+    return root
+
 def _test_round_trip_parse(self, source, parser, *args, **kwds):
 #    src_name = getattr(source,'name',None)
 #    src_encoding = getattr(source, 'encoding', None)
@@ -97,6 +112,56 @@ class SFMTestCase(unittest.TestCase):
                           (3,1),(3,4)]) # \l3\n
                 
     
+    def test_block_lexer(self):
+        src = ['\\le unix\n',
+               '\\le windows\r\n',
+               'bare text\n',
+               '\\\\escaped backslash\n',
+               '\\li1 skipped \\ backslash\n',
+               '\\le missing']
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", SyntaxWarning)
+            ref = list(sfm.parser(src))
+            # A string source is split at its newlines.
+            self.assertEqual(list(sfm.parser(''.join(src))), ref)
+            block_size = sfm.parser._block_size
+            try:
+                sfm.parser._block_size = 1
+                self.assertEqual(list(sfm.parser(src)), ref)
+                self.assertEqual([tuple(e.pos) for e in flatten(sfm.parser(src))],
+                                 [tuple(e.pos) for e in flatten(ref)])
+            finally:
+                sfm.parser._block_size = block_size
+    
+    def test_events(self):
+        src = ['\\lonely\n',
+               '\\sfm text\n',
+               'bare text\n',
+               '\\more-sfm more text\n',
+               'over a line break\\marker']
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", SyntaxWarning)
+            self.assertEqual(unstream(sfm.parser(src).events()),
+                             list(sfm.parser(src)))
+            self.assertEqual([(ev, tuple(n.pos)) for ev,n in sfm.parser(src).events()],
+                             [('start',(1,1)),('text',(1,8)),('end',(1,1)),
+                              ('start',(2,1)),('text',(2,6)),('end',(2,1)),
+                              ('start',(4,1)),('text',(4,11)),('end',(4,1)),
+                              ('start',(5,18)),('end',(5,18))])
+    
+    def test_compact_nodes(self):
+        doc = list(sfm.parser(['\\li1 text\n', '\\l2 more\n', 'text\n']))
+        t = doc[1][0]
+        self.assertFalse(hasattr(t, '__dict__'))
+        self.assertTrue(doc[0]._lines is t._lines)
+        self.assertEqual(t.pos, (2,5))
+        self.assertEqual(t[5:].pos, (3,1))
+        self.assertEqual(t.split('\n')[1].pos, (3,1))
+        t.pos = sfm.position(7,1)
+        self.assertEqual(t.lstrip('m').pos, (7,2))
+        self.assertEqual(doc[0]._annotations, None)
+        self.assertEqual(str(doc[0]), '\\li1 text\n')
+    
     def test_pprint(self):
         src = ['\\test\n',
                '\\test text\n',
@@ -154,6 +219,19 @@ class USFMTestCase(unittest.TestCase):
         for r in [(list(usfm.parser([s], error_level=usfm.level.Note)),r) for s,r in tests]:
             self.assertEqual(*r)
 
+    def test_events(self):
+        srcs = [r'\id MAT\mt Text \f + \fk deep\fk*\f*more text.',
+                r'\id TEST\mt \f + \fr 1.14 \fq religious festivals;\ft or \fq seasons.\f*',
+                r'\id TEST\c 1 text\p \v 1 text',
+                r'\id TEST\c 2 \p \v 3 text\v 4 verse\p \v 5 \nd Lord\nd* end']
+        for s in srcs:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", SyntaxWarning)
+                ref = list(usfm.parser([s], error_level=usfm.level.Unrecoverable))
+                doc = unstream(usfm.parser([s], error_level=usfm.level.Unrecoverable).events())
+            self.assertEqual(doc, ref)
+            self.assertEqual(sfm.pprint(doc), sfm.pprint(ref))
+
 #    def test_sytax_warning(self):
 #        with warnings.catch_warnings():
 #            warnings.resetwarnings()
@@ -185,6 +263,193 @@ class USFMTestCase(unittest.TestCase):
 #                          (4, 11, 'JHN', '3', '16')])   # end{}     c
 #                            
 
+    def test_parse_many(self):
+        books = {'a.usfm': u'\\id TEST\\c 1\\p \\v 1 text\n',
+                 'b.usfm': u'\\id TEST\\mt \\whoops\n',
+                 'c.usfm': u'\\id TEST\\mt text\\f*\n'}
+        tmp = tempfile.mkdtemp()
+        try:
+            paths = []
+            for name, src in sorted(books.items()):
+                paths.append(os.path.join(tmp, name))
+                with codecs.open(paths[-1], 'w', encoding='utf_8') as f:
+                    f.write(src)
+            for workers in (0, 2):
+                with warnings.catch_warnings(record=True) as diagnostics:
+                    warnings.simplefilter("always", SyntaxWarning)
+                    res = list(usfm.parse_many(paths, workers=workers))
+                self.assertEqual([p for p,_ in res], paths)
+                self.assertEqual(res[0][1], list(usfm.parser([books['a.usfm']])))
+                self.assertEqual(len(diagnostics), 1)
+                self.assertEqual(diagnostics[0].filename, paths[1])
+                self.assertTrue(str(diagnostics[0].message).startswith(paths[1]))
+                self.assertTrue(isinstance(res[2][1], SyntaxError))
+                self.assertTrue(str(res[2][1]).startswith(paths[2]))
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", SyntaxWarning)
+                res = dict(usfm.parse_many(paths, workers=2, ordered=False, transform=len))
+            self.assertEqual((res[paths[0]], res[paths[1]]), (1, 1))
+            self.assertTrue(isinstance(res[paths[2]], SyntaxError))
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_reparse(self):
+        src = [u'\\id TEST\n', u'\\c 1\n', u'\\p\n', u'\\v 1 one\n', u'\\v 2 two\n',
+               u'\\p \\v 3 three \\nd Lord\\nd*\n', u'\\c 2\n', u'\\p\n', u'\\v 1 four\n']
+        edits = [([u'\\v 2 two more\n'], 4, 5),               # within a paragraph
+                 ([u'\\p new\n', u'\\q1 poem\n'], 5, 5),      # new paragraphs
+                 ([u'\\c 3\n', u'\\p\n'], 8, 8),              # new chapter
+                 ([], 1, 6),                                  # deleted chapter
+                 ([u'\\v 1 \\nd open\n', u'\\nd* at eof'], 8, 9)]
+        for new, i, j in edits:
+            lines = src[:i] + new + src[j:]
+            doc = list(usfm.parser(src))
+            ref = list(usfm.parser(lines))
+            usfm.reparse(doc, lines, [(i, j, i, i+len(new))])
+            self.assertEqual(doc, ref)
+            self.assertEqual([(e.pos, e.parent and e.parent.name) for e in flatten(doc)],
+                             [(e.pos, e.parent and e.parent.name) for e in flatten(ref)])
+
+    def test_reference_index(self):
+        src = [u'\\id TEST book\n', u'\\c 1\n', u'\\p\n', u'\\v 1 one\n',
+               u'\\v 2 two \\nd Lord\\nd*\n', u'\\q1 poem\n', u'\\c 2\n',
+               u'\\p \\v 1-3 four\n']
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, 'test.usfm')
+            with codecs.open(path, 'w', encoding='utf_8') as f:
+                f.writelines(src)
+            refs = usfm.index(path)
+            idx = path + os.extsep + 'idx'
+            self.assertTrue(os.path.exists(idx))
+            self.assertEqual(usfm.index(path).books, refs.books)
+            # an index made with other parser options is not used
+            key = usfm._parse_key(usfm.parser, {})
+            loose = {'error_level': sfm.level.Unrecoverable}
+            self.assertRaises(ValueError, usfm.reference_index.load, idx, usfm._parse_key(usfm.parser, loose))
+            self.assertEqual(usfm.index(path, **loose).books, refs.books)
+            self.assertRaises(ValueError, usfm.reference_index.load, idx, key)
+            self.assertEqual(usfm.reference_index.load(idx, usfm._parse_key(usfm.parser, loose)).books, refs.books)
+            sty = usfm.default_stylesheet.copy()
+            del sty['q1']
+            self.assertNotEqual(usfm._parse_key(usfm.parser, {'stylesheet': sty}), key)
+            self.assertEqual(refs.span('TEST 1:2'), (31, 62))
+            self.assertEqual(refs.span('TEST 2:2'), refs.span('TEST 2:1-3'))
+            self.assertRaises(KeyError, refs.span, 'TEST 3')
+            self.assertEqual(refs.span('TEST 1:2a'), (31, 62))
+            self.assertEqual(refs.span('TEST 2:2-3'), refs.span('TEST 2:1-3'))
+            self.assertRaises(KeyError, refs.span, 'TEST 1:4b')
+            self.assertRaises(KeyError, refs.span, 'TEST 1:a')
+            self.assertRaises(KeyError, usfm.extract, path, 'TEST 1:x', refs)
+
+            doc = list(usfm.parser(src))
+            c1 = doc[0][1]
+            ex = usfm.extract(path, 'TEST 1:2')
+            self.assertEqual(len(ex), 1)
+            self.assertEqual(ex[0][0], elem(('c','1'), elem('p', *c1[0][3:]), c1[1]))
+            self.assertEqual([e.pos for e in flatten(ex[0][0][0])],
+                             [e.pos for e in flatten(c1[0][3:])])
+            self.assertEqual(usfm.extract(path, 'TEST 2', refs)[0][0], doc[0][2])
+            self.assertEqual(usfm.extract(path, 'TEST', refs), doc)
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_stylesheet_cache(self):
+        tmp = tempfile.mkdtemp()
+        data_dir = usfm._PALASO_DATA
+        try:
+            usfm._PALASO_DATA = os.path.join(tmp, 'sfm')
+            _, cached_path = usfm._cached_stylesheet('usfm.sty')
+            stale = os.path.join(tmp, 'sfm', 'usfm.sty.0000000000000000.marshal')
+            os.makedirs(usfm._PALASO_DATA)
+            open(stale, 'wb').close()
+            sheet = usfm._lazy_stylesheet('usfm.sty')
+            self.assertFalse(os.path.exists(cached_path))
+            self.assertEqual(sheet.copy(), dict(usfm.default_stylesheet))
+            self.assertTrue(os.path.exists(cached_path))
+            self.assertFalse(os.path.exists(stale))
+            self.assertEqual(usfm._load_cached_stylesheet('usfm.sty'), sheet.copy())
+        finally:
+            usfm._PALASO_DATA = data_dir
+            shutil.rmtree(tmp)
+
+    concordance_src = [u'\\id TEST book\n', u'\\c 1\n', u'\\p\n', u'\\v 1 In the beginning,\n',
+                       u'\\v 2 the void\\f + \\fr 1:2 \\ft note\\f*\n', u'\\s the heading\n',
+                       u'\\p \\v 3 non-stop the\n']
+
+    def test_concordance(self):
+        refs = concordance.book(list(usfm.parser(self.concordance_src)))
+        self.assertEqual(sorted(refs), [u'In', u'beginning', u'heading', u'non-stop',
+                                        u'note', u'the', u'void'])
+        self.assertEqual(refs.references(u'the'), [u'TEST 1:1', u'TEST 1:2', u'TEST 1:3'])
+        self.assertEqual(refs.references(u'note'), [u'TEST 1:2'])
+
+    @unittest.skipIf(sys.version_info[0] > 2, 'palaso.unicsv is Python 2 only')
+    def test_concordance_merge(self):
+        refs = concordance.book(list(usfm.parser(self.concordance_src)))
+        master = io.BytesIO(u'Word,References\r\nthe,TEST 1:1\r\nunused,\r\n'.encode('utf_8'))
+        out = io.BytesIO()
+        unused = []
+        counts = concordance.merge(master, out, refs, lambda w,r: unused.append((w,r)))
+        rows = out.getvalue().decode('utf_8').splitlines()
+        self.assertEqual(rows[:3], [u'Word,References',
+                                    u'the,"TEST 1:1, TEST 1:2, TEST 1:3"', u'unused,'])
+        self.assertEqual(len(rows), 9)
+        self.assertEqual(counts, (6, 6))
+        self.assertEqual(unused, [(u'unused', 3)])
+        master = io.BytesIO(u'Word,References\r\nthe,\r\nthe,\r\n'.encode('utf_8'))
+        self.assertRaises(ValueError, concordance.merge, master, io.BytesIO(), refs)
+
+    def test_conversion(self):
+        src = [u'\\id TEST book\n', u'\\c 1\n', u'\\s the big cat\n', u'\\p\n',
+               u'\\v 1 the big cat sat. undone "by the cat\n',
+               u'\\v 2 \\nd big cat\\nd* unCAT\n']
+        lex = conversion.lexicon(conversion.tokenizer())
+        lex.load([[u'cat', u'dog', u''], [u'big cat', u'lion', u's'], [u'un!', u'non', u''],
+                  [u'#sat', u'ignored', u''], [u'short', u'row']], 0, 1, 2)
+        self.assertEqual(len(lex), 3)
+        conv = conversion.transducer(lexicon=lex, capitaltags=['s'])
+        doc = conv(usfm.parser(src))
+        self.assertEqual(sfm.pprint(doc).splitlines()[2:],
+                         [u'\\s The lion',
+                          u'\\p',
+                          u'\\v 1 The big dog sat. Nondone "By the dog',
+                          u'\\v 2 \\nd big dog\\nd* nonCAT'])
+
+    def test_conversion_cache(self):
+        src = [u'\\id TEST book\n', u'\\c 1\n', u'\\p\n', u'\\v 1 one. two\n',
+               u'\\p \\v 2 three\n', u'\\v 3 four\\f + \\ft five\\f*\n', u'\\p six\n']
+        edited = src[:3] + [u'\\v 1 one, two\n'] + src[4:]
+        lex = conversion.lexicon(conversion.tokenizer())
+        lex.add(u'three', u'3')
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, 'paragraphs')
+            for lines, hits, misses in ((src, 0, 3), (src, 3, 0), (edited, 2, 1)):
+                cache = conversion.paragraph_cache(path, [b'test'])
+                conv = conversion.transducer(lexicon=lex, cache=cache)
+                doc = conv(usfm.parser(lines))
+                cache.save()
+                self.assertEqual(doc, conversion.transducer(lexicon=lex)(usfm.parser(lines)))
+                self.assertEqual((cache.hits, cache.misses), (hits, misses))
+            self.assertEqual(len(cache), 4)
+            # a different context misses
+            self.assertEqual(conversion.paragraph_cache(path, [b'other']).get(
+                                cache.key(doc[0][1][0], 1)), None)
+            # as does a change to the conversion code
+            digest = conversion._code_digest
+            conversion._code_digest = lambda: b'changed'
+            try:
+                self.assertNotEqual(conversion.paragraph_cache(path, [b'test']).key(doc[0][1][0], 1),
+                                    cache.key(doc[0][1][0], 1))
+            finally:
+                conversion._code_digest = digest
+            cache.size = 100
+            cache.save()
+            self.assertEqual(len(conversion.paragraph_cache(path)), 2)
+        finally:
+            shutil.rmtree(tmp)
+
     def test_round_trip_parse(self):
         pass
 #        _test_round_trip_parse(self, codecs.open('data/mat.1.usfm','r',encoding='utf_8_sig'), usfm.parser)
@@ -200,6 +465,8 @@ if __name__ == "__main__":
          doctest.DocTestSuite('palaso.sfm.records'),
          doctest.DocTestSuite('palaso.sfm.style'),
          doctest.DocTestSuite('palaso.sfm.usfm'),
+         doctest.DocTestSuite('palaso.sfm.concordance'),
+         doctest.DocTestSuite('palaso.sfm.conversion'),
          unittest.defaultTestLoader.loadTestsFromName(__name__)
          ])
     warnings.simplefilter("ignore", SyntaxWarning)
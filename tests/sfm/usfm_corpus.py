@@ -0,0 +1,55 @@
+'''
+Synthetic USFM corpus generator used by the sfm benchmarks.  The books are
+structurally realistic (chapters, paragraphs, verses, character styles and
+footnotes) but the words are pseudo-random so corpora of any size can be
+produced reproducibly without shipping real scripture texts.
+'''
+import random
+
+books = ['GEN','EXO','LEV','NUM','DEU','JOS','JDG','RUT','1SA','2SA','1KI',
+         '2KI','1CH','2CH','EZR','NEH','EST','JOB','PSA','PRO','ECC','SNG',
+         'ISA','JER','LAM','EZK','DAN','HOS','JOL','AMO','OBA','JON','MIC',
+         'NAM','HAB','ZEP','HAG','ZEC','MAL','MAT','MRK','LUK','JHN','ACT',
+         'ROM','1CO','2CO','GAL','EPH','PHP','COL','1TH','2TH','1TI','2TI',
+         'TIT','PHM','HEB','JAS','1PE','2PE','1JN','2JN','3JN','JUD','REV']
+new_testament = books[39:]
+
+_syllables = ['ka','lo','mi','ne','su','ta','ri','po','we','ya','an','en',
+              'or','ul','th','sh','ch','ing','ed','er']
+
+
+def word(rng):
+    return ''.join(rng.choice(_syllables) for _ in range(rng.randint(1, 4)))
+
+
+def sentence(rng, words=12):
+    ws = [word(rng) for _ in range(rng.randint(words//2, words*3//2))]
+    ws[0] = ws[0].capitalize()
+    return ' '.join(ws) + rng.choice('..,;?!')
+
+
+def book(code, chapters=20, verses=30, seed=None):
+    '''Return the lines of a synthetic USFM book.'''
+    rng = random.Random(seed if seed is not None else code)
+    out = [u'\\id {0} Synthetic test book\n'.format(code),
+           u'\\h {0}\n'.format(code.title()),
+           u'\\mt1 The book of {0}\n'.format(code.title())]
+    for c in range(1, chapters+1):
+        out.append(u'\\c {0}\n'.format(c))
+        out.append(u'\\s1 {0}\n'.format(sentence(rng, 4)))
+        out.append(u'\\p\n')
+        for v in range(1, verses+1):
+            if rng.random() < 0.1:
+                out.append(u'\\p\n')
+            line = u'\\v {0} {1}'.format(v, sentence(rng))
+            if rng.random() < 0.2:
+                line += u' \\nd {0}\\nd* {1}'.format(word(rng), sentence(rng, 6))
+            if rng.random() < 0.1:
+                line += u'\\f + \\fr {0}.{1} \\ft {2}\\f*'.format(c, v, sentence(rng, 8))
+            out.append(line + u'\n')
+    return out
+
+
+def corpus(codes=books, chapters=20, verses=30):
+    '''Return a list of (book code, lines) pairs.'''
+    return [(b, book(b, chapters, verses)) for b in codes]
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+'''
+Measure the throughput, in tags per second, of canonicalising a synthetic
+feed of language tags, comparing LangTags.canonicalise_many, in this
+process and across a pool of workers, against parsing and analysing every
+tag as was previously needed.  The feed mostly repeats a few popular tags,
+as given or with _ for - and odd case, with a long tail of rarer tags and
+of tags with regions and variants that are not in the database and need
+analysing.  The results must be identical.
+'''
+import os, random, sys, time
+from optparse import OptionParser
+
+from palaso import langtags
+from palaso.langtags import LangTags, LangTag
+
+regions = ['US', 'GB', 'IN', 'NG', 'BR', 'CN', 'RU', 'ZZ', 'FR', 'PG']
+variants = ['fonipa', '1996', 'x-foo', 'u-ca-gregory']
+
+
+def legacy(lts, tags):
+    return [str(LangTag(t).analyse(lts)) for t in tags]
+
+
+def feed(size, seed=1):
+    rng = random.Random(seed)
+    # Read the tags from alltags.txt rather than going through all of them in
+    #  LangTags, which would copy them all out of the database.
+    with open(os.path.join(os.path.dirname(langtags.__file__), 'sldr', 'alltags.txt')) as f:
+        known = sorted(set(t.lstrip('*') for t in f.read().split() if t != '='))
+    popular = rng.sample(known, 200)
+    res = []
+    for _ in range(size):
+        r = rng.random()
+        if r < 0.7:
+            t = popular[min(int(rng.expovariate(0.05)), len(popular) - 1)]
+        elif r < 0.9:
+            t = rng.choice(known)
+        else:
+            t = rng.choice(known).split('-')[0] + '-' + rng.choice(regions)
+            if rng.random() < 0.5:
+                t += '-' + rng.choice(variants)
+        r = rng.random()
+        if r < 0.1:
+            t = t.replace('-', '_')
+        elif r < 0.15:
+            t = t.lower()
+        res.append(t)
+    return res
+
+
+def timed(f, *args):
+    start = time.time()
+    res = f(*args)
+    return res, time.time() - start
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options]\n' + __doc__)
+    parser.add_option('-n','--number',type='int',default=200000,help='Tags in the feed [%default]')
+    parser.add_option('-w','--workers',type='int',default=None,help='Worker processes [number of CPUs]')
+    (opts, args) = parser.parse_args()
+
+    lts = LangTags()
+    tags = feed(opts.number)
+    old, to = timed(legacy, lts, tags)
+    new, tn = timed(lambda: list(lts.canonicalise_many(tags)))
+    lts._canonical.clear()
+    par, tp = timed(lambda: list(lts.canonicalise_many(tags, workers=opts.workers, chunksize=1 << 14)))
+    assert old == new == par, 'results differ'
+    sys.stdout.write('{0} tags, {1} distinct\n'.format(len(tags), len(set(tags))))
+    for name, t in (('legacy', to), ('canonicalise_many', tn), ('pool', tp)):
+        sys.stdout.write('{0:>18}: {1:7.2f}s {2:10.0f} tags/s\n'.format(name, t, len(tags) / t))
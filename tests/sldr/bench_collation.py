@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+'''
+Measure minimising and writing out large collation tailorings, of
+thousands of tailored strings of letters and combining diacritics, with
+Collation's longest match sort keys over the compiled DUCET, against the
+sort keys previously made by trying every prefix of a string in a DUCET
+dict and deep copying keys.  The minimised tailorings must be
+identical.
+'''
+import copy, random, sys, time
+from optparse import OptionParser
+
+from palaso.sldr import collation
+from palaso.sldr.ducet import parseDucet
+
+
+def legacySortKey(d, k, extra=None):
+    res = [[], [], []]
+    i = len(k)
+    while i > 0:
+        try:
+            if extra and k[:i] in extra:
+                key = extra[k[:i]].key
+            else:
+                key = zip(*d[k[:i]])
+        except KeyError:
+            i -= 1
+            continue
+        key_list = list(key)
+        res = [res[j] + list(key_list[j]) for j in range(3)]
+        k = k[i:]
+        i = len(k)
+    return res
+
+
+class LegacyCollElement(collation.CollElement):
+
+    def sortkey(self, collations, ducetDict, inc):
+        if hasattr(self, 'key'):
+            return self.key
+        self.key = legacySortKey(ducetDict, self.base)
+        b = collations.get(self.base, None)
+        if b is not None and b.order <= self.order:
+            b.sortkey(collations, ducetDict, inc)
+            basekey = copy.deepcopy(b.shortkey)
+        else:
+            basekey = copy.deepcopy(self.key)
+        if self.level < 4 :
+            basekey[self.level-1][-1] += inc
+        if not self.exp and b is not None and b.exp:
+            self.exp = b.exp
+        if self.exp:
+            expkey = legacySortKey(ducetDict, self.exp, extra=collations)
+            if expkey > basekey:
+                self.shortkey = copy.deepcopy(expkey) + [1]
+            else:
+                self.shortkey = copy.deepcopy(basekey)
+            basekey = [basekey[i] + expkey[i] for i in range(3)]
+        else:
+            self.shortkey = basekey
+        self.key = basekey
+        return basekey
+
+
+class LegacyCollation(collation.Collation):
+
+    def parse(self, string):
+        super(LegacyCollation, self).parse(string)
+        for v in self.values():
+            v.__class__ = LegacyCollElement
+
+    def minimise(self, alphabet):
+        self._setSortKeys()
+        base = sorted([(x, legacySortKey(self.ducet, x)) for x in alphabet if x in self.ducet], key=lambda x: x[1])
+        this = sorted([(x, legacySortKey(self.ducet, x, extra=self)) for x in alphabet], key=lambda x: x[1])
+        basep = collation.filtersame(base, 1)
+        thisp = collation.filtersame(this, 1)
+        self._stripoverlaps(zip(*basep), zip(*thisp))
+        bases = collation.makegroupdict(base, lambda x:x[1][0])
+        thiss = collation.makegroupdict(this, lambda x:x[1][0])
+        for k, v in thiss.items():
+            if len(v) == 1 or k in self:
+                continue
+            self._stripoverlaps(zip(*bases[k][1:]), zip(*v[1:]))
+
+
+letters = u'abcdefghijklmnopqrstuvwxyz'
+marks = [(chr(c) if sys.version_info[0] > 2 else unichr(c)) for c in range(0x300, 0x340)]
+
+
+def tailoring(size, seed=1):
+    '''Return tailoring rules for size strings, and the alphabet to minimise
+        them against.'''
+    rng = random.Random(seed)
+    items = set()
+    while len(items) < size:
+        items.add(u''.join(rng.choice(letters) + (rng.choice(marks) if rng.random() < 0.3 else u'')
+                           for _ in range(rng.randint(1, 3))))
+    items = sorted(items)
+    rng.shuffle(items)
+    rules = []
+    for i in range(0, size, 50):
+        rules.append(u'&' + rng.choice(letters) + u' ' + u' '.join(
+                        rng.choice([u'<', u'<<', u'<<<']) + u' ' + x for x in items[i:i+50]))
+    return u'\n'.join(rules), list(letters) + items
+
+
+def run(cls, ducet, rules, alphabet, wrap=0):
+    c = cls(ducet)
+    c.parse(rules)
+    start = time.time()
+    c.minimise(alphabet)
+    tm = time.time() - start
+    start = time.time()
+    res = c.asICU(wrap=wrap)
+    return res, tm, time.time() - start
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options]\n' + __doc__)
+    parser.add_option('-s','--size',type='int',default=5000,help='Tailored strings [%default]')
+    parser.add_option('-w','--wrap',type='int',default=0,help='Wrap ICU output lines at this length [%default]')
+    (opts, args) = parser.parse_args()
+
+    rules, alphabet = tailoring(opts.size)
+    ducet = parseDucet(collation.os.path.join(collation.os.path.dirname(collation.__file__), 'allkeys.txt'))
+    old, mo, ao = run(LegacyCollation, ducet, rules, alphabet, opts.wrap)
+    new, mn, an = run(collation.Collation, collation.readDucet(), rules, alphabet, opts.wrap)
+    assert old == new, 'tailorings differ'
+    sys.stdout.write('{0} tailored strings, {1} lines after minimising\n'.format(opts.size, len(new.splitlines())))
+    for name, m, a in (('legacy', mo, ao), ('sortkeys', mn, an)):
+        sys.stdout.write('{0:>9}: minimise {1:6.3f}s  asICU {2:6.3f}s\n'.format(name, m, a))
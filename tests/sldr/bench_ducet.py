@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+'''
+Measure the start up time and memory of loading the DUCET, comparing the
+compiled table, both when it is first compiled and when it is memory mapped
+by later processes, against parsing allkeys.txt into a dict as
+palaso.sldr.collation and palaso.sldr.ducet each used to.  Each load is
+made in a fresh process, against a copy of allkeys.txt so that any compiled
+table beside the real one is not used.  The maximum resident set size is
+reported above that of a process which only imports the modules.
+'''
+import json, os, re, resource, shutil, subprocess, sys, tempfile, time
+from optparse import OptionParser
+
+try:
+    unichr
+except NameError:
+    unichr = chr
+
+
+def legacy(path):
+    result = {}
+    keyre = re.compile(r'([0-9A-F]{4})', re.I)
+    valre = re.compile(r'\[[.*]([0-9A-F]{4})\.([0-9A-F]{4})\.([0-9A-F]{4})\]', re.I)
+    with open(path, 'r') as f :
+        for contentLine in f.readlines():
+            parts = contentLine.split(';')
+            if len(parts) != 2:
+                continue
+            key = u"".join(unichr(int(x, 16)) for x in keyre.findall(parts[0]))
+            vals = valre.findall(parts[1])
+            result[key] = tuple(tuple(int(x, 16) for x in v) for v in vals)
+    return result
+
+
+def child(mode, path):
+    from palaso.sldr import ducet
+    start = time.time()
+    if mode == 'legacy':
+        d = legacy(path)
+    elif mode != 'none':
+        d = ducet.loadDucet(path)
+    t = time.time() - start
+    res = dict(time=t, rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+    if mode != 'none':
+        # Touch every entry, as a sort over a large alphabet might.
+        start = time.time()
+        res['entries'] = sum(len(d[k]) for k in list(d.keys()))
+        res['lookup'] = time.time() - start
+    sys.stdout.write(json.dumps(res))
+
+
+def run(mode, path):
+    out = subprocess.check_output([sys.executable, __file__, '--child', mode, path])
+    return json.loads(out.decode('ascii'))
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options] [allkeys.txt]\n' + __doc__)
+    parser.add_option('--child',help='Load the DUCET in this process by the given method')
+    parser.add_option('-r','--repeat',type='int',default=3,help='Best of this many loads [%default]')
+    (opts, args) = parser.parse_args()
+    if not args:
+        args = [os.path.join(os.path.dirname(__file__), '..', '..', 'lib', 'palaso', 'sldr', 'allkeys.txt')]
+    if opts.child:
+        child(opts.child, args[0])
+        sys.exit(0)
+
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, 'allkeys.txt')
+        shutil.copy(args[0], path)
+        base = run('none', path)
+        results = [('legacy', min((run('legacy', path) for _ in range(opts.repeat)),
+                                  key=lambda r: r['time'])),
+                   ('compile', run('compiled', path)),
+                   ('mapped', min((run('compiled', path) for _ in range(opts.repeat)),
+                                  key=lambda r: r['time']))]
+        assert len(set(r['entries'] for _, r in results)) == 1, 'tables differ'
+        for name, r in results:
+            sys.stdout.write('{0:>8}: load {1:7.3f}s  +{2:7.1f} MB  lookups {3:6.3f}s\n'.format(
+                name, r['time'], (r['rss'] - base['rss']) / 1024., r['lookup']))
+    finally:
+        shutil.rmtree(tmp)
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Measure finding and analyzing exemplar clusters in a synthetic corpus of
+Devanagari words, with nuktas, matras, viramas and other signs, mixed with
+Latin words carrying stacked combining diacritics, each diacritic used on
+its own few bases.  Exemplars.process with its cached character properties
+is compared against the ICU lookups for every character previously made,
+and against process_corpus over a pool of workers.  Exemplars.analyze with
+its index of marks by their bases and rounds of passes over only the split
+clusters is compared against comparing the bases of every pair of marks on
+every pass over every cluster.  The results must be identical.
+'''
+import io, os, random, shutil, sys, tempfile, time
+from optparse import OptionParser
+
+from icu import Script
+from palaso.sldr.ldml_exemplars import Exemplars, Exemplar
+
+consonants = [chr(c) if sys.version_info[0] > 2 else unichr(c) for c in range(0x915, 0x93A)]
+matras = [u'ा', u'ि', u'ी', u'ु', u'ू', u'ृ', u'े', u'ै',
+          u'ो', u'ौ']
+signs = [u'ँ', u'ं', u'ः']
+letters = u'abcdefghijklmnopqrstuvwxyz'
+# Combining diacritics, U+0300 to U+036F, less the CGJ, each with a few
+#  bases of its own and so sharing them with some others, and the
+#  supplementary combining diacritics from U+1DC0.
+diacritics = [(chr(c) if sys.version_info[0] > 2 else unichr(c))
+              for c in list(range(0x300, 0x370)) + list(range(0x1DC0, 0x1DFA)) if c != 0x34F]
+_rng = random.Random(0)
+bases = dict((d, _rng.sample(letters[:8], _rng.randint(1, 3))) for d in diacritics)
+
+
+class LegacyExemplars(Exemplars):
+    '''Exemplars with process as it was, calling ICU for every character.'''
+
+    def process(self, text):
+        i = 0
+        text = self.ucd.normalize('NFD', text)
+        for char in text:
+            script = Script.getScript(char)
+            script_code = Script.getScriptCode(script)
+            self.scripts[script_code] += 1
+            self.codes_for_scripts[script_code] = script
+        while i < len(text):
+            for multigraph_length in range(self.max_multigraph_length, 0, -1):
+                multigraph = text[i:i + multigraph_length]
+                if (multigraph in self._main or
+                   multigraph in self._auxiliary or
+                   multigraph in self._index or
+                   multigraph in self._punctuation):
+                    exemplar = Exemplar(multigraph)
+                    self.clusters[exemplar] += 1
+                    i += multigraph_length
+                    break
+            if not i < len(text):
+                break
+            char = text[i]
+            if self.ucd.ispunct(char):
+                exemplar = Exemplar(char)
+                self.clusters[exemplar] += 1
+                i += 1
+                continue
+            if not self.allowable(char):
+                i += 1
+                continue
+            base = char
+            length = base_length = 1
+            while i + length < len(text):
+                trailer = text[i + length]
+                if self.ucd.is_zwj(trailer):
+                    length += 1
+                    continue
+                if self.ucd.is_zwnj(trailer):
+                    length += 1
+                    break
+                if self.ucd.ismark(trailer):
+                    length += 1
+                    if self.ucd.is_always_combine(trailer):
+                        base_length += 1
+                        base = text[i:i + base_length]
+                    continue
+                else:
+                    break
+            trailers = text[i + base_length:i + length]
+            exemplar = Exemplar(base, trailers)
+            self.clusters[exemplar] += 1
+            i += length
+
+    def analyze(self):
+        self.ignore_phantoms()
+        self.find_punctuation()
+        self.save_graphemes()
+        self.find_numbers()
+        self.count_marks()
+        while self.need_splitting:
+            self.need_splitting = False
+            self.find_indic_matras_and_viramas()
+            self.find_marks_on_same_bases()
+            self.find_productive_marks()
+            self.find_second_marks()
+        self.parcel_marks()
+        self.parcel_ignorable()
+        self.parcel_frequency()
+        self.make_index()
+
+    def find_marks_on_same_bases(self):
+        for exemplar in list(self.clusters.keys()):
+            count = self.clusters[exemplar]
+            for trailer_index in range(len(exemplar.trailers)):
+                trailer = exemplar.trailers[trailer_index]
+                if trailer in self.bases_for_marks:
+                    current_mark = trailer
+                    current_bases = self.bases_for_marks[current_mark]
+                    for other_mark in self.bases_for_marks.keys():
+                        if current_mark != other_mark:
+                            other_bases = self.bases_for_marks[other_mark]
+                            difference = current_bases.symmetric_difference(other_bases)
+                            if len(difference) == 0:
+                                self.split_exemplar(exemplar, trailer_index, count)
+
+
+def devanagari(rng):
+    res = []
+    for _ in range(rng.randint(1, 4)):
+        res.append(rng.choice(consonants))
+        if rng.random() < 0.1:
+            res.append(u'़')
+        r = rng.random()
+        if r < 0.2:
+            res.append(u'्')
+        elif r < 0.8:
+            res.append(rng.choice(matras))
+        if rng.random() < 0.15:
+            res.append(rng.choice(signs))
+    return u''.join(res)
+
+
+def latin(rng):
+    res = []
+    for _ in range(rng.randint(2, 8)):
+        if rng.random() < 0.3:
+            d = rng.choice(diacritics)
+            res.append(rng.choice(bases[d]) + d)
+        else:
+            res.append(rng.choice(letters))
+    return u''.join(res)
+
+
+def corpus(path, lines, seed=1):
+    '''Write lines of synthetic text to path.'''
+    rng = random.Random(seed)
+    with io.open(path, 'w', encoding='utf-8') as f:
+        for _ in range(lines):
+            words = [devanagari(rng) if rng.random() < 0.8 else latin(rng)
+                     for _ in range(rng.randint(5, 15))]
+            f.write(u' '.join(words) + rng.choice([u'।', u'.', u',', u'']) + u'\n')
+
+
+def results(e):
+    return (list(e.clusters.items()), e.main, e.auxiliary, e.index, e.punctuation,
+            e.digits, e.graphemes, e.frequency, e.script)
+
+
+def analyzed(e):
+    start = time.time()
+    e.analyze()
+    return time.time() - start
+
+
+def processed(cls, path, workers=None):
+    e = cls()
+    start = time.time()
+    if workers is None:
+        with io.open(path, encoding='utf-8') as f:
+            e.process(f.read())
+    else:
+        e.process_corpus([path], workers=workers, chunksize=1 << 18)
+    return e, time.time() - start
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options]\n' + __doc__)
+    parser.add_option('-l','--lines',type='int',default=20000,help='Lines of text [%default]')
+    parser.add_option('-w','--workers',type='int',default=None,help='Worker processes [number of CPUs]')
+    (opts, args) = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, 'corpus.txt')
+        corpus(path, opts.lines)
+        sys.stdout.write('{0} lines, {1:.1f} MB\n'.format(opts.lines, os.path.getsize(path) / float(1 << 20)))
+        old, to = processed(LegacyExemplars, path)
+        new, tn = processed(Exemplars, path)
+        par, tp = processed(Exemplars, path, opts.workers)
+        for e in (new, par):
+            assert list(e.clusters.items()) == list(old.clusters.items()), 'clusters differ'
+            assert list(e.scripts.items()) == list(old.scripts.items()), 'scripts differ'
+        sys.stdout.write('{0} clusters\n'.format(len(old.clusters)))
+        ao, an = analyzed(old), analyzed(new)
+        sys.stdout.write('{0} marks on {1} sets of bases\n'.format(len(new.bases_for_marks), len(new.marks_for_bases)))
+        assert results(new) == results(old), 'analysis differs'
+        for name, t in (('legacy', to), ('cached', tn), ('process_corpus', tp)):
+            sys.stdout.write('{0:>15}: {1:7.2f}s\n'.format(name, t))
+        for name, t in (('legacy', ao), ('indexed', an)):
+            sys.stdout.write('{0:>15}: {1:7.2f}s analyze\n'.format(name, t))
+    finally:
+        shutil.rmtree(tmp)
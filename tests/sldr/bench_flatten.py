@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+'''
+Measure flattening every locale under the given directories, such as a
+local SLDR checkout, comparing flatten_all, in this process and across a
+pool of workers, against calling flattenlocale for each locale, which
+parses every file in its fallback chain afresh.  With no directories a
+synthetic SLDR tree is generated and used.
+'''
+import os, shutil, sys, tempfile, time
+from optparse import OptionParser
+
+from palaso.sldr.ldml import LocaleStore, flattenlocale, flatten_all
+import ldml_corpus
+
+
+def serialised(l):
+    if l is None: return None
+    res = []
+    l.serialize_xml(res.append)
+    return u''.join(res)
+
+
+def legacy(dirs, names):
+    return dict((n, serialised(flattenlocale(n, dirs))) for n in names)
+
+
+def timed(f, *args):
+    start = time.time()
+    res = f(*args)
+    return res, time.time() - start
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options] [sldr-dir ...]\n' + __doc__)
+    parser.add_option('-l','--languages',type='int',default=300,help='Languages in a synthetic tree [%default]')
+    parser.add_option('-w','--workers',type='int',default=None,help='Worker processes [number of CPUs]')
+    (opts, args) = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    try:
+        if not args:
+            args = [os.path.join(tmp, 'sldr')]
+            ldml_corpus.tree(args[0], opts.languages)
+        names = LocaleStore(args).locales()
+        sys.stdout.write('{0} locales\n'.format(len(names)))
+
+        old, to = timed(legacy, args, names)
+        new, tn = timed(lambda: dict(flatten_all(args, workers=0)))
+        assert new == old, 'flattened locales differ'
+        par, tp = timed(lambda: dict(flatten_all(args, workers=opts.workers)))
+        assert par == old, 'flattened locales differ'
+        for name, t in (('flattenlocale', to), ('flatten_all', tn), ('workers', tp)):
+            sys.stdout.write('{0:>14}: {1:7.2f}s\n'.format(name, t))
+    finally:
+        shutil.rmtree(tmp)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+'''
+Measure replaying long random keystroke sequences through
+Keyboard.process_string, comparing the transforms compiled into a flat DFA
+and matched by index into the input, against walking the trie of Rule a
+character at a time over a slice of the input from each position, as was
+previously done.  The keyboard is kbdtest.xml, or that given, run both as
+it is and with partial transforms hidden and failed ones omitted.  The
+output after every keystroke must be identical.
+'''
+import os, random, sys, time
+from optparse import OptionParser
+
+from palaso.sldr.ldml_keyboard import Keyboard, Rules
+
+
+class LegacyRules(Rules):
+    '''Rules matched by walking the trie, with the fixes to negative sets
+       and context only rules made alongside the DFA.'''
+
+    def match(self, s, ind=0, partial=False, fail=False, extent=False):
+        if extent:      # taken to depend on all the input, so never reused
+            return self.match(s, ind, partial, fail) + (len(s) + 1,)
+        start = ind
+        last = None
+        lastind = start
+        curr = self.rules
+        if fail and s[ind] in curr:
+            lastind = start + 1
+        while ind < len(s):
+            if s[ind] in curr:
+                curr = curr[s[ind]]
+            elif curr.default is not None:
+                curr = curr.default
+            else:
+                return (last, lastind - start)
+            ind += 1
+            if curr.rule or len(curr.contexts):
+                newlast = curr.context_match(s, start, ind)
+                if newlast is not None:
+                    lastind = ind
+                    last = newlast
+        if partial and len(curr):
+            return (None, ind - start)
+        else:
+            return (last, lastind - start)
+
+
+class LegacyKeyboard(Keyboard):
+    '''Keyboard matching transforms against a slice from each position.'''
+
+    def _addrules(self, element, transform):
+        if transform not in self.transforms:
+            self.transforms[transform] = LegacyRules(transform)
+        super(LegacyKeyboard, self)._addrules(element, transform)
+
+    def _process_simple(self, context, ruleset='simple', handleSettings=True):
+        if ruleset not in self.transforms:
+            self._process_empty(context, ruleset)
+            return True
+        trans = self.transforms[ruleset]
+        if handleSettings:
+            partial = self.settings.get('transformPartial', "") == "hide"
+            fail = self.settings.get('transformFailure', "") == 'omit'
+            fallback = self.settings.get('fallback', "") == 'omit'
+        else:
+            partial = False
+            fail = False
+            fallback = False
+
+        context.reset_output(ruleset)
+        curr = context.offset(ruleset)
+        instr = context.input(ruleset)
+        while curr < len(instr):
+            r = trans.match(instr[curr:], partial=partial, fail=fail)
+            if r[0] is not None:
+                if getattr(r[0], 'error', 0): return False
+                context.results(ruleset, r[1], getattr(r[0], 'to', ""))
+                curr += r[1]
+            elif r[1] == 0 and not fallback:     # abject failure
+                context.results(ruleset, 1, instr[curr:curr+1])
+                curr += 1
+            else:               # partial match waiting for more input
+                break
+        return True
+
+    def _get_charcodes(self, instr, curr, trans):
+        codes, extent = super(LegacyKeyboard, self)._get_charcodes(instr[curr:], 0, trans)
+        return codes, curr + extent
+
+
+def keystrokes(kbd, length, seed=1):
+    '''Return a string of length random keystrokes, as process_string takes.'''
+    rng = random.Random(seed)
+    keys = sorted(kbd.keyboards[kbd.modifiers[""]].keys())
+    shifted = sorted(kbd.keyboards[kbd.modifiers["shift"]].keys()) if "shift" in kbd.modifiers else []
+    res = []
+    for _ in range(length):
+        if shifted and rng.random() < 0.15:
+            res.append(u"[shift {0}]".format(rng.choice(shifted)))
+        else:
+            res.append(u"[{0}]".format(rng.choice(keys)))
+    return u"".join(res)
+
+
+def replay(kbd, strings):
+    start = time.time()
+    res = [[(c.error, c.outputs[-1]) for c in kbd.process_string(s)] for s in strings]
+    return res, time.time() - start
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options] [keyboard.xml]\n' + __doc__)
+    parser.add_option('-n','--number',type='int',default=3,help='Keystroke sequences [%default]')
+    parser.add_option('-l','--length',type='int',default=2000,help='Keystrokes in each sequence [%default]')
+    (opts, args) = parser.parse_args()
+    if not args:
+        args = [os.path.join(os.path.dirname(__file__), 'kbdtest.xml')]
+
+    for settings in ({}, {'transformPartial': 'hide', 'transformFailure': 'omit'}):
+        old = LegacyKeyboard(args[0])
+        new = Keyboard(args[0])
+        old.settings.update(settings)
+        new.settings.update(settings)
+        strings = [keystrokes(new, opts.length, seed) for seed in range(opts.number)]
+        ro, to = replay(old, strings)
+        rn, tn = replay(new, strings)
+        assert ro == rn, 'outputs differ'
+        n = opts.number * opts.length
+        sys.stdout.write('{0}: {1} keystrokes\n'.format(" ".join("{0}={1}".format(*x) for x in settings.items()) or 'defaults', n))
+        for name, t in (('legacy', to), ('dfa', tn)):
+            sys.stdout.write('{0:>8}: {1:7.2f}s {2:9.0f} keystrokes/s\n'.format(name, t, n / t))
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+'''
+Measure typing 100k random keystrokes, in sequences of a thousand, through
+Keyboard.process_string, with each layer only reprocessing the input it has
+not yet made stable and the reorder layer reusing the CharCodes, sort keys
+and sorted runs it kept at the last keystroke wherever its input is
+unchanged, against the previous processing, where a layer without
+transforms never made its output stable, so that the layers after it
+reprocessed their whole input on every keystroke, and the reorder layer
+matched, keyed and sorted all of its unstable input afresh on every
+keystroke.  The keyboard is kbdmymr.xml, which reorders Myanmar typed in
+visual order, and kbdtest.xml, or those given.  The output after every
+keystroke of the first few sequences must be identical.
+'''
+import os, sys, time
+from optparse import OptionParser
+
+from palaso.sldr.ldml_keyboard import Keyboard, CharCode, SortKey
+from bench_keyboard import keystrokes
+
+
+class LegacyKeyboard(Keyboard):
+    '''Keyboard with layers without transforms and reordering as they were.'''
+
+    def _process_empty(self, context, ruleset):
+        context.reset_output(ruleset)
+        output = context.input(ruleset)[context.offset(ruleset):]
+        context.results(ruleset, len(output), output)
+
+    def _get_charcodes(self, instr, curr, trans):
+        r = trans.match(instr, curr)
+        if r[0] is not None:
+            orders = [int(x) for x in self._padlist(getattr(r[0], 'order', "0"), r[1])]
+            bases = [bool(x) for x in self._padlist(getattr(r[0], 'tertiary_base', "false"), r[1])]
+            tertiaries = [int(x) for x in self._padlist(getattr(r[0], 'tertiary', "0"), r[1])]
+            prebases = [bool(x) for x in self._padlist(getattr(r[0], 'prebase', "false"), r[1])]
+            return [CharCode(orders[i], bases[i], tertiaries[i], prebases[i]) for i in range(r[1])]
+        else:
+            return [CharCode(0, 0, 0, False)]
+
+
+    def _process_reorder(self, context, ruleset='reorder'):
+        if ruleset not in self.transforms:
+            self._process_empty(context, ruleset)
+            return
+        trans = self.transforms[ruleset]
+        instr = context.input(ruleset)
+        context.reset_output(ruleset)
+
+        # scan for start of sortable run. Normally empty
+        startrun = context.offset(ruleset)
+        curr = startrun
+        while curr < len(instr):
+            codes = self._get_charcodes(instr, curr, trans)
+            for c in codes:
+                if c.prebase or c.primary == 0:
+                    break
+                curr += 1
+            else:
+                continue        # if didn't break inner loop, don't break outer loop
+            break               # if we broke in the inner loop, break the outer loop
+        if curr > startrun:     # just copy the odd characters across
+            context.results(ruleset, curr - startrun, instr[startrun:curr])
+
+        startrun = curr
+        keys = [None] * (len(instr) - startrun)
+        isinit = True           # inside the start of a run (.{prebase}* .{order==0 && tertiary==0})
+        currprimary = 0
+        currbaseindex = curr
+        while curr < context.len(ruleset):
+            codes = self._get_charcodes(instr, curr, trans)
+            for i, c in enumerate(codes):               # calculate sort key for each character in turn
+                if c.tertiary and curr + i > startrun:      # can't start with tertiary, treat as primary 0
+                    key = SortKey(currprimary, currbaseindex, c.tertiary, curr + i)
+                else:
+                    key = SortKey(c.primary, curr + i, 0, curr + i)
+                    if c.primary == 0 or c.tertiary_base:   # primary 0 is always a tertiary base
+                        currprimary = c.primary
+                        currbaseindex = curr + i
+
+                if ((key.primary != 0 or key.tertiary != 0) and not c.prebase) \
+                        or (c.prebase and curr + i > startrun \
+                            and keys[curr+i-startrun-1].primary == 0):  # prebase can't have tertiary
+                    isinit = False      # After the prefix, so any following prefix char starts a new run
+
+                # identify a run boundary
+                if not isinit and ((key.primary == 0 and key.tertiary == 0) or c.prebase):
+                    # output sorted run and reset for new run
+                    context.results(ruleset, curr + i - startrun,
+                                    self._sort(startrun, curr + i, instr, keys))
+                    startrun = curr + i
+                    keys = [None] * (len(instr) - startrun)
+                    isinit = True
+                keys[curr+i-startrun] = key
+            curr += len(codes)
+        if curr > startrun:
+            # output but don't store any residue. Reprocess it next time.
+            context.outputs[context.index(ruleset)] += self._sort(startrun, curr, instr, keys)
+
+def typed(kbd, strings):
+    start = time.time()
+    res = [[(c.error, c.outputs[-1]) for c in kbd.process_string(s)] for s in strings]
+    return res, time.time() - start
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options] [keyboard.xml ...]\n' + __doc__)
+    parser.add_option('-n','--number',type='int',default=100000,help='Keystrokes in all [%default]')
+    parser.add_option('-l','--length',type='int',default=1000,help='Keystrokes in each sequence [%default]')
+    parser.add_option('-c','--check',type='int',default=5,help='Sequences to compare [%default]')
+    (opts, args) = parser.parse_args()
+    if not args:
+        args = [os.path.join(os.path.dirname(__file__), f) for f in ('kbdmymr.xml', 'kbdtest.xml')]
+
+    for fname in args:
+        new = Keyboard(fname)
+        old = LegacyKeyboard(fname)
+        strings = [keystrokes(new, opts.length, seed) for seed in range(opts.number // opts.length)]
+        checked = strings[:opts.check]
+        ro, to = typed(old, checked)
+        rn, tn = typed(new, checked)
+        assert ro == rn, 'outputs differ'
+        _, ta = typed(new, strings)
+        n = len(checked) * opts.length
+        sys.stdout.write('{0}:\n'.format(os.path.basename(fname)))
+        for name, k, t in (('legacy', n, to), ('incremental', n, tn), ('incremental', len(strings) * opts.length, ta)):
+            sys.stdout.write('{0:>12}: {1:7d} keystrokes {2:7.2f}s {3:8.0f} keystrokes/s\n'.format(name, k, t, k / t))
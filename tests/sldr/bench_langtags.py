@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+'''
+Measure the start up time and memory of loading the langtags database,
+comparing the compiled database, both when it is first compiled and when it
+is memory mapped by later processes, against reading alltags.txt into a dict
+of LangTag as LangTags used to.  Each load is made in a fresh process,
+against a copy of alltags.txt so that any compiled database beside the real
+one is not used.  The maximum resident set size is reported above that of a
+process which only imports the module, then a handful of tags are looked up,
+as a command line tool might, and then every tag.
+'''
+import json, os, resource, shutil, subprocess, sys, tempfile, time
+from optparse import OptionParser
+
+few = ['en', 'en-GB', 'fr-Latn-FR', 'zh-TW', 'sr-Cyrl', 'hi', 'ar-EG', 'x-bogus']
+
+
+def legacy(path):
+    from palaso.langtags import LangTag
+    res = {}
+    with open(path) as fh:
+        for l in fh.readlines():
+            tags = [x[1:] if x.startswith("*") else x for x in l.strip().split() if x != "="]
+            t = tags.pop()
+            ltag = LangTag(tag=t)
+            res[t] = ltag
+            for t in tags:
+                lt = LangTag(tag=t)
+                if ltag.lang == lt.lang:
+                    if lt.script is None and lt.region is None:
+                        lt.hideboth = True
+                    ltag.merge_equivalent(lt)
+                res[t] = ltag
+    return res
+
+
+def child(mode, path):
+    from palaso.langtags import LangTags
+    start = time.time()
+    if mode == 'legacy':
+        lts = legacy(path)
+    elif mode != 'none':
+        lts = LangTags(alltags=path)
+    t = time.time() - start
+    res = dict(time=t, rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+    if mode != 'none':
+        start = time.time()
+        res['few'] = [repr(lts[k]) for k in few if k in lts]
+        res['fewtime'] = time.time() - start
+        start = time.time()
+        res['all'] = sum(len(repr(lts[k])) for k in list(lts.keys()))
+        res['alltime'] = time.time() - start
+    sys.stdout.write(json.dumps(res))
+
+
+def run(mode, path):
+    out = subprocess.check_output([sys.executable, __file__, '--child', mode, path])
+    return json.loads(out.decode('ascii'))
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options] [alltags.txt]\n' + __doc__)
+    parser.add_option('--child',help='Load the database in this process by the given method')
+    parser.add_option('-r','--repeat',type='int',default=3,help='Best of this many loads [%default]')
+    (opts, args) = parser.parse_args()
+    if not args:
+        args = [os.path.join(os.path.dirname(__file__), '..', '..', 'lib', 'palaso', 'sldr', 'alltags.txt')]
+    if opts.child:
+        child(opts.child, args[0])
+        sys.exit(0)
+
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, 'alltags.txt')
+        shutil.copy(args[0], path)
+        base = run('none', path)
+        results = [('legacy', min((run('legacy', path) for _ in range(opts.repeat)),
+                                  key=lambda r: r['time'])),
+                   ('compile', run('compiled', path)),
+                   ('mapped', min((run('compiled', path) for _ in range(opts.repeat)),
+                                  key=lambda r: r['time']))]
+        assert len(set((json.dumps(r['few']), r['all']) for _, r in results)) == 1, 'tags differ'
+        for name, r in results:
+            sys.stdout.write('{0:>8}: load {1:7.3f}s  +{2:7.1f} MB  {3} tags {4:7.4f}s  all {5:6.3f}s\n'.format(
+                name, r['time'], (r['rss'] - base['rss']) / 1024., len(few), r['fewtime'], r['alltime']))
+    finally:
+        shutil.rmtree(tmp)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+'''
+Measure loading every LDML file under the given directories, such as a
+local SLDR checkout, without a cache and then through an LdmlCache that
+starts cold and is then warm.  With no directories a synthetic SLDR tree is
+generated and used.  The warm loads are checked to serialise identically to
+the uncached ones.
+'''
+import os, shutil, sys, tempfile, time
+from optparse import OptionParser
+
+from palaso.sldr.ldml import Ldml, LdmlCache
+import ldml_corpus
+
+
+def ldml_files(dirs):
+    return sorted(os.path.join(dp, f) for d in dirs for dp, _, fs in os.walk(d)
+                  for f in fs if f.endswith('.xml'))
+
+
+def load(files, cache=None):
+    # Trees are dropped as they are made so that the cycle collector is not
+    #  left walking every tree loaded so far.
+    for f in files:
+        Ldml(f, cache=cache)
+
+
+def serialised(l):
+    res = []
+    l.serialize_xml(res.append)
+    return u''.join(res)
+
+
+def timed(f, *args):
+    start = time.time()
+    f(*args)
+    return time.time() - start
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options] [sldr-dir ...]\n' + __doc__)
+    parser.add_option('-l','--languages',type='int',default=300,help='Languages in a synthetic tree [%default]')
+    parser.add_option('-r','--repeat',type='int',default=3,help='Best of this many warm and uncached runs [%default]')
+    (opts, args) = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    try:
+        if not args:
+            args = [os.path.join(tmp, 'sldr')]
+            ldml_corpus.tree(args[0], opts.languages)
+        files = ldml_files(args)
+        size = sum(os.path.getsize(f) for f in files)
+        sys.stdout.write('{0} files, {1:.1f} MB\n'.format(len(files), size/float(1<<20)))
+
+        cache = LdmlCache(os.path.join(tmp, 'cache'))
+        tc = timed(load, files, cache)
+        tw = min(timed(load, files, cache) for _ in range(opts.repeat))
+        tp = min(timed(load, files) for _ in range(opts.repeat))
+        assert cache.hits == opts.repeat * len(files), 'warm loads missed the cache'
+        assert all(serialised(Ldml(f)) == serialised(Ldml(f, cache=cache)) for f in files), \
+            'cached trees differ'
+        for name, t in (('uncached', tp), ('cold', tc), ('warm', tw)):
+            sys.stdout.write('{0:>9}: {1:7.2f}s {2:7.2f} ms/file\n'.format(
+                                name, t, 1000 * t / len(files)))
+    finally:
+        shutil.rmtree(tmp)
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+'''
+Measure flattening (overlay), unflattening (difference) and three-way
+merging of large locales, and adding nodes one at a time to a wide node
+(addnode), comparing Ldml's hash indexed child lookup against the linear
+scans of the children previously used for each child.  The locales come
+from a synthetic SLDR tree with wide display name lists.  Each merge is of
+one flattened locale, edited, with another against the unedited original.
+Each time is the best of a number of runs, with garbage collection paused.
+'''
+import gc, random, shutil, sys, tempfile, time
+from optparse import OptionParser
+
+from palaso.sldr.ldml import Ldml, LocaleStore
+import ldml_corpus
+
+
+class LegacyLdml(Ldml):
+    '''Ldml with overlay, difference and merge as they were, less the draft
+       handling that loading without drafts makes unreachable.'''
+
+    def overlay(self, other, usedrafts=False, this=None):
+        if this == None: this = self.root
+        other = getattr(other, 'root', other)
+        for o in other:
+            self._overlay_child(o, this, usedrafts)
+
+    def _overlay_child(self, o, this, usedrafts, index=None):
+        addme = True
+        for t in filter(lambda x: x.attrHash == o.attrHash, this):
+            addme = False
+            if o.contentHash != t.contentHash:
+                if o.tag not in self.blocks:
+                    self.overlay(o, usedrafts=usedrafts, this=t)
+            break  # only do one alignment
+        if addme and (o.tag != "alias" or not len(this)):  # alias in effect turns it into blocking
+            this.append(o)
+
+    def difference(self, other, this=None):
+        if this == None: this = self.root
+        other = getattr(other, 'root', other)
+        if not len(other) and not len(this):
+            return (other.contentHash == this.contentHash)
+        for o in other:
+            for t in filter(lambda x: x.attrHash == o.attrHash, this):
+                if o.contentHash == t.contentHash or (o.tag not in self.blocks and self.difference(o, this=t)):
+                    this.remove(t)
+                break
+        return not len(this) and (not this.text or this.text == other.text)
+
+    def addnode(self, parent, tag, attrib={}, alt=None, **attribs):
+        attrib = dict((k,v) for k,v in attrib.items() if v)
+        attrib.update(attribs)
+        tag = self._reverselocalns(tag)
+        e = parent.makeelement(tag, attrib)
+        e.parent = parent
+        e.document = parent.document
+        if self.useDrafts:
+            alt = self.alt(alt)
+            if 'draft' not in e.attrib and self.use_draft is not None:
+                e.set('draft', self.use_draft)
+            self._calc_hashes(e, self.useDrafts)
+            equivs = [x for x in parent if x.attrHash == e.attrHash]
+            if len(equivs):
+                if 'alt' not in e.attrib:
+                    e.set('alt', alt)
+                return self._add_alt_leaf(equivs[0], e, default=e.get('draft', None), leaf=True, alt=alt)
+        parent.append(e)
+        return e
+
+    def merge(self, other, base, this=None, default=None, copycomments=None):
+        res = False
+        if this == None: this = self.root
+        if other is not None and hasattr(other, 'root'): other = other.root
+        if base is not None and hasattr(base, 'root'): base = base.root
+        self._align(this, other, base)
+        for t in list(this):
+            if t.mergeBase is None:
+                continue
+            if t.mergeOther is not None and t.mergeOther.contentHash != t.contentHash:
+                if t.mergeBase.contentHash == t.contentHash:
+                    this.remove(t)
+                    this.append(t.mergeOther)
+                    res = True
+                elif t.mergeBase.contentHash != t.mergeOther.contentHash:
+                    res |= self.merge(t.mergeOther, t.mergeBase, t)
+            elif t.mergeOther is None and t.mergeBase.contentHash == t.contentHash:
+                this.remove(t)
+                res = True
+        if base is not None and this.text == base.text:
+            if other is not None:
+                res = res or (this.text != other.text)
+                this.text = other.text
+                this.contentHash = other.contentHash
+            elif this.text is not None:
+                res = True
+                this.text = None
+                this.contentHash = None
+        elif base is not None and other is not None and other.text != base.text:
+            self.clash_text(this.text, other.text, (base.text if base is not None else None),
+                                        this, other, base)
+        oattrs = set(other.keys() if other is not None else [])
+        for k in list(this.keys()):
+            if k in oattrs:
+                if k in base.attrib and base.get(k) == this.get(k) and this.get(k) != other.get(k):
+                    res = True
+                    this.set(k, other.get(k))
+                elif this.get(k) != other.get(k):
+                    self.clash_attrib(k, this.get(k), other.get(k), base.get(k), this, other, base)
+                    res = True
+                oattrs.remove(k)
+            elif base is not None and k in base.attrib:
+                this.attrib.pop(k)
+                res = True
+        for k in oattrs:
+            if base is None or k not in base.attrib or base.get(k) != other.get(k):
+                this.set(k, other.get(k))
+                res = True
+        return res
+
+
+def chain(name):
+    res = []
+    while '_' in name:
+        name = name.rsplit('_', 1)[0]
+        res.append(name)
+    return res + ['root']
+
+
+def timed(f, *args):
+    gc.collect()
+    gc.disable()
+    try:
+        start = time.time()
+        res = f(*args)
+        return res, time.time() - start
+    finally:
+        gc.enable()
+
+
+def flatten(cls, store, name):
+    l = cls(store.path(name), usedrafts=False)
+    fallbacks = [cls(store.path(f), usedrafts=False) for f in chain(name)]
+    def overlay():
+        for o in fallbacks:
+            l.overlay(o)
+    return l, timed(overlay)[1]
+
+
+def widen(cls, size):
+    l = cls(None)
+    l.uid = None
+    parent = l.addnode(l.addnode(l.root, 'localeDisplayNames'), 'languages')
+    for i in range(size):
+        l.addnode(parent, 'language', type='l{0}'.format(i))
+    for i in range(0, size, 10):     # and some alternates
+        l.addnode(parent, 'language', type='l{0}'.format(i))
+    return l
+
+
+def edited(l, seed):
+    rng = random.Random(seed)
+    for e in l.root.iter():
+        if e.text and rng.random() < 0.05:
+            e.text += u'x'
+    l.normalise()
+    return l
+
+
+def serialised(l):
+    res = []
+    l.serialize_xml(res.append)
+    return u''.join(res)
+
+
+def run(cls, store, names, width):
+    times = [0, 0, 0, 0]
+    out = []
+    for a, b in zip(names, names[1:]):
+        base, t = flatten(cls, store, a)
+        times[0] += t
+        this = edited(flatten(cls, store, a)[0], 1)
+        other = flatten(cls, store, b)[0]
+        times[1] += timed(this.merge, other, base)[1]
+        root = cls(store.path('root'), usedrafts=False)
+        times[2] += timed(base.difference, root)[1]
+        out += [serialised(this), serialised(base)]
+    wide, times[3] = timed(widen, cls, width)
+    out.append(serialised(wide))
+    return out, times
+
+
+def best(cls, store, names, width, repeats):
+    out, times = run(cls, store, names, width)
+    for _ in range(repeats - 1):
+        times = [min(t) for t in zip(times, run(cls, store, names, width)[1])]
+    return out, times
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options]\n' + __doc__)
+    parser.add_option('-l','--locales',type='int',default=5,help='Number of locale pairs [%default]')
+    parser.add_option('-s','--size',type='int',default=2,help='Synthetic locale size [%default]')
+    parser.add_option('-w','--width',type='int',default=4000,help='Nodes added to a wide node [%default]')
+    parser.add_option('-r','--repeats',type='int',default=3,help='Runs to take the best of [%default]')
+    (opts, args) = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    try:
+        names = ldml_corpus.tree(tmp, opts.locales + 1, size=opts.size)
+        store = LocaleStore([tmp])
+        names = [n for n in names if n.count('_') == 1][:opts.locales + 1]
+        sizes = [sum(1 for _ in flatten(Ldml, store, n)[0].root.iter()) for n in names]
+        sys.stdout.write('{0} merges of flattened locales of {1} elements on average\n'.format(
+                            len(names) - 1, sum(sizes) // len(sizes)))
+
+        old, to = best(LegacyLdml, store, names, opts.width, opts.repeats)
+        new, tn = best(Ldml, store, names, opts.width, opts.repeats)
+        assert old == new, 'results differ'
+        for name, t in (('legacy', to), ('indexed', tn)):
+            sys.stdout.write('{0:>8}: overlay {1:6.2f}s  merge {2:6.2f}s  difference {3:6.2f}s'
+                             '  addnode {4:6.2f}s\n'.format(name, *t))
+    finally:
+        shutil.rmtree(tmp)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+'''
+Measure serialising flattened locales, root and all, comparing the buffered
+writer, both collecting a string and saving straight to a file, against the
+element by element writes and per element namespace copies of the writer
+previously used.  The locales come from a synthetic SLDR tree and are
+serialised with and without drafts; the outputs must be identical.
+'''
+import os, re, shutil, sys, tempfile, time
+from optparse import OptionParser
+
+from palaso.sldr.ldml import Ldml, LocaleStore, _elementprotect, _attribprotect
+import ldml_corpus
+
+
+class LegacyLdml(Ldml):
+    '''Ldml with serialize_xml as it was, for ETWriter and Ldml together.'''
+
+    def _protect(self, txt, base=_attribprotect):
+        return re.sub(u'['+u"".join(base.keys())+u"]", lambda m: base[m.group(0)], txt)
+
+    def serialize_xml(self, write, base=None, indent='', topns=True, namespaces={}):
+        if self.uid is not None:
+            self.ensure_path('identity/special/sil:identity[@uid="{}"]'.format(self.uid))
+        if self.useDrafts:
+            n = base if base is not None else self.root
+            draft = n.get('draft', '')
+            if draft and (len(n) or draft == self.default_draft):
+                del n.attrib['draft']
+            offset = 0
+            alt = n.get('alt', '')
+            for (i, c) in enumerate(list(n)):
+                if not hasattr(c, 'alternates'): continue
+                for a in sorted(c.alternates.keys()):
+                    c.alternates[a].set('alt', (alt+"-"+a if alt else a))
+                    offset += 1
+                    n.insert(i + offset, c.alternates[a])
+                    c.alternates[a].tempnode = True
+        self._write(write, base, indent, topns, namespaces)
+        if self.useDrafts:
+            n = base if base is not None else self.root
+            for c in list(n):
+                if hasattr(c, 'tempnode') and c.tempnode:
+                    n.remove(c)
+
+    def _write(self, write, base, indent, topns, namespaces):
+        if base is None:
+            base = self.root
+            write('<?xml version="1.0" encoding="utf-8"?>\n')
+        (tag, q, ns) = self._localisens(base.tag)
+        localattribs = {}
+        if ns and ns not in namespaces:
+            namespaces[ns] = q
+            localattribs['xmlns:'+q] = ns
+        if topns:
+            if base == self.root:
+                for n,q in self.namespaces.items():
+                    localattribs['xmlns:'+q] = n
+                    namespaces[n] = q
+        else:
+            for c in base:
+                (lt, lq, lns) = self._localisens(c.tag)
+                if lns and lns not in namespaces:
+                    namespaces[lns] = q
+                    localattribs['xmlns:'+lq] = lns
+        self._nsprotectattribs(getattr(base, 'attrib', None), localattribs, namespaces)
+        for c in getattr(base, 'comments', []):
+            write(u'{}<!--{}-->\n'.format(indent, c))
+        write(u'{}<{}'.format(indent, tag))
+        if len(localattribs):
+            for k in self._sortedattrs(base, localattribs):
+                write(u' {}="{}"'.format(self._localisens(k)[0], self._protect(localattribs[k])))
+        if len(base):
+            write('>\n')
+            for b in base:
+                self.serialize_xml(write, base=b, indent=indent + self.indent, topns=topns, namespaces=namespaces.copy())
+            write('{}</{}>\n'.format(indent, tag))
+        elif base.text:
+            if tag not in self.takesCData:
+                t = self._protect(base.text.replace('\n', '\n' + indent), base=_elementprotect)
+            else:
+                t = "<![CDATA[\n\t" + indent + base.text.replace('\n', '\n\t' + indent) + "\n" + indent + "]]>"
+            write(u'>{}</{}>\n'.format(t, tag))
+        else:
+            write('/>\n')
+        for c in getattr(base, 'commentsafter', []):
+            write(u'{}<!--{}-->\n'.format(indent, c))
+
+
+def chain(name):
+    res = []
+    while '_' in name:
+        name = name.rsplit('_', 1)[0]
+        res.append(name)
+    return res + ['root']
+
+
+def flatten(cls, store, name, usedrafts):
+    l = cls(store.path(name), usedrafts=usedrafts)
+    for f in chain(name):
+        l.overlay(cls(store.path(f), usedrafts=usedrafts), usedrafts=usedrafts)
+    return l
+
+
+def collected(l, topns):
+    res = []
+    l.serialize_xml(res.append, topns=topns, namespaces={})
+    return u''.join(res).encode('utf-8')
+
+
+def saved(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def timed(repeat, f, *args):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        res = f(*args)
+        t = time.time() - start
+        best = t if best is None else min(best, t)
+    return res, best
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options]\n' + __doc__)
+    parser.add_option('-l','--locales',type='int',default=10,help='Number of flattened locales [%default]')
+    parser.add_option('-s','--size',type='int',default=4,help='Synthetic locale size [%default]')
+    parser.add_option('-r','--repeat',type='int',default=3,help='Best of this many runs [%default]')
+    (opts, args) = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    try:
+        names = ldml_corpus.tree(os.path.join(tmp, 'sldr'), opts.locales, size=opts.size)
+        store = LocaleStore([os.path.join(tmp, 'sldr')])
+        names = [n for n in names if n.count('_') == 1][:opts.locales]
+        path = os.path.join(tmp, 'out.xml')
+        for usedrafts in (False, True):
+            for topns in (True, False):
+                times = [0, 0, 0]
+                size = 0
+                for n in names:
+                    old = flatten(LegacyLdml, store, n, usedrafts)
+                    new = flatten(Ldml, store, n, usedrafts)
+                    ro, to = timed(opts.repeat, collected, old, topns)
+                    rn, tn = timed(opts.repeat, collected, new, topns)
+                    _, ts = timed(opts.repeat, new.save, path, topns)
+                    assert ro == rn == saved(path), 'serialised {0} differs'.format(n)
+                    size += len(ro)
+                    for i, t in enumerate((to, tn, ts)):
+                        times[i] += t
+                mb = size / float(1 << 20)
+                sys.stdout.write('drafts={0!s:<5} topns={1!s:<5} {2:5.1f} MB: '.format(usedrafts, topns, mb)
+                                 + '  '.join('{0} {1:6.1f} MB/s'.format(name, mb / t) for name, t in
+                                             zip(('legacy', 'buffered', 'save'), times)) + '\n')
+    finally:
+        shutil.rmtree(tmp)
@@ -0,0 +1,98 @@
+#!/usr/bin/python
+
+import unittest, sys, os, shutil, tempfile
+
+try:
+    from palaso.sldr.collation import Collation, CollElement, SortKeys, ducetSortKey
+    from palaso.sldr.ducet import DucetTable, compileDucet, parseDucet
+except ImportError:
+    sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'lib')))
+    from palaso.sldr.collation import Collation, CollElement, SortKeys, ducetSortKey
+    from palaso.sldr.ducet import DucetTable, compileDucet, parseDucet
+
+
+class SortKeyTests(unittest.TestCase):
+
+    allkeys = u'''# allkeys test data
+@version 9.0.0
+
+0061  ; [.1C47.0020.0002] # LATIN SMALL LETTER A
+0062  ; [.1C60.0020.0002] # LATIN SMALL LETTER B
+0063  ; [.1C7A.0020.0002] # LATIN SMALL LETTER C
+0063 0068 ; [.1C7A.0020.0002][.1D18.0020.0002] # <LATIN SMALL LETTER C, LATIN SMALL LETTER H>
+0300  ; [.0000.0025.0002] # COMBINING GRAVE ACCENT
+00AD  ; # SOFT HYPHEN, ignored entirely
+'''
+
+    def setUp(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, 'allkeys.txt')
+            with open(path, 'w') as f:
+                f.write(self.allkeys)
+            self.dict = parseDucet(path)
+        finally:
+            shutil.rmtree(tmp)
+        self.table = DucetTable(compileDucet(self.dict))
+
+    def tailored(self, ducet, **keys):
+        res = Collation(ducet)
+        for k, v in keys.items():
+            res[k] = CollElement(k, 1)
+            res[k].key = v
+        return res
+
+    def both(self):
+        '''Sort key makers over the compiled table and over the dict'''
+        return (SortKeys(self.table), SortKeys(self.dict))
+
+    def test_ducet(self):
+        for keys in self.both():
+            self.assertEqual(keys(u'ab'), [[0x1C47, 0x1C60], [0x20, 0x20], [2, 2]])
+            # the longest DUCET match wins
+            self.assertEqual(keys(u'cha'), [[0x1C7A, 0x1D18, 0x1C47], [0x20] * 3, [2] * 3])
+            self.assertEqual(keys(u'a\u0300'), [[0x1C47, 0], [0x20, 0x25], [2, 2]])
+
+    def test_empty(self):
+        for keys in self.both():
+            self.assertEqual(keys(u'a\u00adb'), keys(u'ab'))
+            self.assertEqual(keys(u'\u00ad'), [[], [], []])
+
+    def test_missing(self):
+        # A character with no DUCET entry ends the key, as it always has
+        for keys in self.both():
+            self.assertEqual(keys(u'axb'), keys(u'a'))
+            self.assertEqual(keys(u'x'), [[], [], []])
+            self.assertEqual(ducetSortKey(self.dict, u'bxa'), keys(u'b'))
+
+    def test_tailored(self):
+        ab = [[0x1C48], [0x20], [2]]
+        c = [[0x1C49], [0x20], [2]]
+        for keys in self.both():
+            coll = self.tailored(keys.ducet, ab=ab, c=c)
+            # longer than the DUCET match
+            self.assertEqual(keys(u'abc', coll)[0], [0x1C48, 0x1C49])
+            # as long as the DUCET match, so it wins
+            self.assertEqual(keys(u'ca', coll), [[0x1C49, 0x1C47], [0x20, 0x20], [2, 2]])
+            # shorter than the DUCET match, which wins
+            self.assertEqual(keys(u'ch', coll), keys(u'ch'))
+            # tailored elements reach past characters missing from the DUCET
+            coll = self.tailored(keys.ducet, xb=ab)
+            self.assertEqual(keys(u'axb', coll)[0], [0x1C47, 0x1C48])
+
+    def test_cache(self):
+        for keys in self.both():
+            first = keys(u'cha')
+            self.assertTrue(u'cha' in keys.cache)
+            self.assertEqual(keys(u'cha'), first)
+            self.assertEqual(first, SortKeys(keys.ducet)._key(u'cha', None))
+            # tailored keys are not cached
+            coll = self.tailored(keys.ducet, c=[[1], [1], [1]])
+            self.assertEqual(keys(u'ca', coll)[0], [1, 0x1C47])
+            self.assertFalse(u'ca' in keys.cache)
+            self.assertEqual(keys(u'ca')[0], [0x1C7A, 0x1C47])
+        self.assertEqual(self.both()[0](u'cha'), self.both()[1](u'cha'))
+
+
+if __name__ == '__main__':
+    unittest.main()
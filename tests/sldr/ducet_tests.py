@@ -0,0 +1,59 @@
+#!/usr/bin/python
+
+import unittest, sys, os, shutil, tempfile
+
+try:
+    from palaso.sldr.ducet import DucetTable, compileDucet, loadDucet, parseDucet
+except ImportError:
+    sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'lib')))
+    from palaso.sldr.ducet import DucetTable, compileDucet, loadDucet, parseDucet
+
+
+class DucetTests(unittest.TestCase):
+
+    allkeys = u'''# allkeys test data
+@version 9.0.0
+
+0061  ; [.1C47.0020.0002] # LATIN SMALL LETTER A
+0062  ; [.1C60.0020.0002] # LATIN SMALL LETTER B
+0063  ; [.1C7A.0020.0002] # LATIN SMALL LETTER C
+0063 0068 ; [.1C7A.0020.0002][.1D18.0020.0002] # <LATIN SMALL LETTER C, LATIN SMALL LETTER H>
+006C 00B7 006C ; [.1D77.0020.0002][.0000.0111.0002] # l middle dot l
+0300  ; [.0000.0025.0002] # COMBINING GRAVE ACCENT
+'''
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'allkeys.txt')
+        with open(self.path, 'w') as f:
+            f.write(self.allkeys)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_table(self):
+        ducet = parseDucet(self.path)
+        table = DucetTable(compileDucet(ducet))
+        self.assertEqual(dict(table.items()), ducet)
+        self.assertEqual(len(table), 6)
+        self.assertEqual(table[u'ch'], ((0x1C7A, 0x20, 2), (0x1D18, 0x20, 2)))
+        self.assertFalse(u'l\u00b7' in table)
+        self.assertRaises(KeyError, lambda: table[u'l'])
+
+    def test_longest(self):
+        table = DucetTable(compileDucet(parseDucet(self.path)))
+        self.assertEqual(table.longest(u'chab')[0], 2)
+        self.assertEqual(table.longest(u'chab', 2)[0], 1)
+        self.assertEqual(table.longest(u'l\u00b7x'), (0, 0))
+        n, node = table.longest(u'l\u00b7l')
+        self.assertEqual(table.elements(node), ((0x1D77, 0x20, 2), (0, 0x111, 2)))
+
+    def test_load(self):
+        table = loadDucet(self.path)
+        self.assertTrue(loadDucet(self.path) is table)
+        self.assertTrue(os.path.exists(os.path.join(self.tmp, 'allkeys.ducet')))
+        self.assertEqual(dict(table.items()), parseDucet(self.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
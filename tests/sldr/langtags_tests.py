@@ -0,0 +1,86 @@
+#!/usr/bin/python
+
+import unittest, sys, os, shutil, tempfile
+
+try:
+    from palaso import langtags
+except ImportError:
+    sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'lib')))
+    from palaso import langtags
+from palaso.langtags import LangTag, LangTags, LangTagsTable, Singleton, compileLangTags, loadLangTags
+
+
+class LangTagsTests(unittest.TestCase):
+
+    alltags = '''*aa = *aa-ET = aa-Latn = aa-Latn-ET
+*aa-DJ = aa-Latn-DJ
+*en = *en-US = en-Latn = en-Latn-US
+sr-Latn = sr-Latn-RS
+'''
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'alltags.txt')
+        with open(self.path, 'w') as f:
+            f.write(self.alltags)
+        self.instances = dict(Singleton._instances)
+        Singleton._instances.pop(LangTags, None)
+
+    def tearDown(self):
+        Singleton._instances.clear()
+        Singleton._instances.update(self.instances)
+        langtags._tables.clear()
+        shutil.rmtree(self.tmp)
+
+    def test_table(self):
+        en = LangTag('en-Latn-US')
+        en.hidescript = True
+        en.desc = ['English']
+        x = LangTag('x-qaa-u-ca-gregory-islamic-fonipa')
+        tags = {'en': en, 'en-US': en, 'en-Latn-US': en, 'x-qaa': x}
+        table = LangTagsTable(compileLangTags(tags))
+        self.assertEqual(len(table), 4)
+        self.assertEqual(sorted(table.keys()), sorted(tags.keys()))
+        self.assertTrue(table['en'] is table['en-Latn-US'])
+        self.assertEqual(repr(table['en']), 'en-Latn-US')
+        self.assertEqual(str(table['en']), 'en-US')
+        self.assertEqual(table['en'].desc, ['English'])
+        self.assertEqual(table['x-qaa'].extensions, x.extensions)
+        self.assertFalse('en-GB' in table)
+        self.assertRaises(KeyError, lambda: table['en-GB'])
+
+    def test_load(self):
+        lts = LangTags(alltags=self.path)
+        self.assertTrue(os.path.exists(os.path.join(self.tmp, 'alltags.ltdb')))
+        self.assertTrue(lts['aa'] is lts['aa-Latn-ET'])
+        self.assertEqual(repr(lts['sr-Latn']), 'sr-Latn-RS')
+        self.assertTrue(loadLangTags([self.path], None) is lts._table)
+        self.assertEqual(len(lts), 12)
+
+    def test_add(self):
+        lts = LangTags(alltags=self.path)
+        lts.add(LangTag('en-Latn-GB'))
+        self.assertTrue('en-Latn-GB' in lts)
+        self.assertFalse('en-GB' in lts)
+        self.assertEqual(len(lts), 13)
+        self.assertEqual(len(set(lts.values())), 5)
+        self.assertEqual(sorted(lts.keys())[:2], ['aa', 'aa-DJ'])
+
+    def test_canonicalise(self):
+        with open(self.path, 'a') as f:
+            f.write('sgn-MY-MM = sgn-MY-Zxxx-MM\n')
+        lts = LangTags(alltags=self.path)
+        lts.cachesize = 2
+        tags = ['en', 'en_Latn', 'EN-latn-us', 'aa-DJ', 'aa-Latn-ER', 'en-GB-fonipa', 'en']
+        expected = ['en-US', 'en-US', 'en-US', 'aa-DJ', 'aa-ER', 'en-GB-fonipa', 'en-US']
+        # A tag in the database that LangTag parses differently, here with MM
+        #  as a variant, is analysed as parsed rather than looked up as it is.
+        self.assertEqual(lts.canonicalise('sgn_MY_MM'), str(LangTag('sgn-MY-MM').analyse(lts)))
+        self.assertEqual(lts.canonicalise('sgn-MY-MM'), 'sgn-MY-mm')
+        self.assertEqual(list(lts.canonicalise_many(tags)), expected)
+        self.assertEqual(list(lts._canonical.keys()), ['en-GB-fonipa', 'en'])
+        self.assertEqual(list(lts.canonicalise_many(tags * 3, workers=1, chunksize=4)), expected * 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
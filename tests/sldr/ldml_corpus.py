@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+'''
+Synthetic SLDR tree generator used by the sldr benchmarks.  Locales follow
+the SLDR layout (a directory per initial letter holding lang.xml,
+lang_Scrp.xml and lang_Scrp_RG.xml) with a large r/root.xml at the top of
+the fallback chains.  The content is structurally realistic (identity,
+display names, characters, delimiters, calendars, numbers, collations,
+comments, drafts and proposed alternates) but the values are pseudo-random
+so trees of any size can be produced reproducibly without shipping real
+locale data.
+'''
+import io, os, random
+
+_letters = u'abcdefghijklmnopqrstuvwxyz'
+_scripts = ['Latn', 'Cyrl', 'Deva', 'Arab', 'Thai', 'Ethi']
+_drafts = ['unconfirmed', 'provisional', 'contributed', 'generated']
+
+
+def _word(rng, n=None):
+    return u''.join(rng.choice(_letters) for _ in range(n or rng.randint(2, 9)))
+
+
+def _draft(rng, p=0.3):
+    return u' draft="{0}"'.format(rng.choice(_drafts)) if rng.random() < p else u''
+
+
+def _element(rng, tag, text, attrs=u'', alts=0.1):
+    res = [u'<{0}{1}{2}>{3}</{0}>'.format(tag, attrs, _draft(rng), text)]
+    if rng.random() < alts:
+        res.append(u'<{0}{1} alt="proposed-{2}" draft="unconfirmed">{3}</{0}>'.format(
+                tag, attrs, rng.randint(1, 999), _word(rng)))
+    return res
+
+
+def locale(name, rng, size=1):
+    '''Return the text of an LDML file for locale name.  size scales the
+       number of display name, calendar, number and collation elements.'''
+    parts = name.split('_')
+    out = [u'<?xml version="1.0" encoding="utf-8"?>',
+           u'<!-- Synthetic locale data -->',
+           u'<ldml xmlns:sil="urn://www.sil.org/ldml/0.1">',
+           u'<identity>',
+           u'<!-- name.en({0})="{1}" -->'.format(parts[0], _word(rng).title()),
+           u'<language type="{0}"/>'.format(parts[0])]
+    if len(parts) > 1:
+        out.append(u'<script type="{0}"/>'.format(parts[1]))
+    if len(parts) > 2:
+        out.append(u'<territory type="{0}"/>'.format(parts[2]))
+    out += [u'<special><sil:identity uid="{0}" draft="{1}"/></special>'.format(
+                rng.randint(1, 99999), rng.choice(_drafts)),
+            u'</identity>']
+    if len(parts) > 2 and rng.random() < 0.7:
+        return u'\n'.join(out + [u'</ldml>', u''])
+    out.append(u'<localeDisplayNames>')
+    for kind, count in ((u'language', 150), (u'script', 40), (u'territory', 80)):
+        out.append(u'<{0}s>'.format(kind))
+        for t in sorted(set(_word(rng, 3) for _ in range(count * size)), key=lambda _: rng.random()):
+            out += _element(rng, kind, _word(rng).title(), u' type="{0}"'.format(t), 0.02)
+        out.append(u'</{0}s>'.format(kind))
+    out.append(u'</localeDisplayNames>')
+    out.append(u'<characters>')
+    for t in (u'', u' type="auxiliary"', u' type="index"', u' type="punctuation"'):
+        out += _element(rng, u'exemplarCharacters',
+                        u'[' + u' '.join(sorted(rng.sample(_letters, 12))) + u']', t, 0.3)
+    out += [u'<ellipsis type="final">{0}…</ellipsis>',
+            u'<ellipsis type="initial">…{0}</ellipsis>',
+            u'</characters>',
+            u'<delimiters>',
+            u'<quotationStart>“</quotationStart>',
+            u'<quotationEnd>”</quotationEnd>',
+            u'<alternateQuotationStart>‘</alternateQuotationStart>',
+            u'<alternateQuotationEnd>’</alternateQuotationEnd>',
+            u'<special><sil:matched-pairs>',
+            u'<sil:matched-pair open="(" close=")"/>',
+            u'<sil:matched-pair open="[" close="]"/>',
+            u'</sil:matched-pairs></special>',
+            u'</delimiters>',
+            u'<dates><calendars>']
+    for cal in [u'gregorian', u'generic', u'islamic', u'buddhist'][:max(1, size)]:
+        out.append(u'<calendar type="{0}">'.format(cal))
+        for kind, count in ((u'month', 12), (u'day', 7), (u'quarter', 4)):
+            out.append(u'<{0}s>'.format(kind))
+            for ctx in (u'format', u'stand-alone'):
+                out.append(u'<{0}Context type="{1}">'.format(kind, ctx))
+                for width in (u'abbreviated', u'narrow', u'wide'):
+                    out.append(u'<{0}Width type="{1}">'.format(kind, width))
+                    # Shuffle the items so normalisation has sorting to do.
+                    for i in rng.sample(range(1, count+1), count):
+                        out += _element(rng, kind, _word(rng), u' type="{0}"'.format(i))
+                    out.append(u'</{0}Width>'.format(kind))
+                out.append(u'</{0}Context>'.format(kind))
+            out.append(u'</{0}s>'.format(kind))
+        out.append(u'<dateFormats>')
+        for w in (u'full', u'long', u'medium', u'short'):
+            out.append(u'<dateFormatLength type="{0}"><dateFormat><pattern>{1}</pattern>'
+                       u'</dateFormat></dateFormatLength>'.format(w, u'EEEE, d MMMM y'))
+        out += [u'</dateFormats>', u'</calendar>']
+    out += [u'</calendars></dates>',
+            u'<numbers>',
+            u'<defaultNumberingSystem>latn</defaultNumberingSystem>']
+    for ns in [u'latn', u'arab', u'deva', u'thai'][:max(1, size)]:
+        out += [u'<symbols numberSystem="{0}">'.format(ns),
+                u'<decimal>.</decimal>', u'<group>,</group>',
+                u'<percentSign>%</percentSign>', u'</symbols>']
+    out += [u'</numbers>',
+            u'<collations>',
+            u'<collation type="standard">',
+            u'<cr><![CDATA[']
+    for _ in range(20 * size):
+        out.append(u'&{0} < {1} <<< {2}'.format(_word(rng, 1), _word(rng, 2), _word(rng, 2).upper()))
+    out += [u']]></cr>', u'</collation>', u'</collations>', u'</ldml>', u'']
+    return u'\n'.join(out)
+
+
+def locales(languages=100, seed=1):
+    '''Return a list of locale names, each language with a script and some
+       with regions.'''
+    rng = random.Random(seed)
+    names = set()
+    while len(names) < languages:
+        names.add(_word(rng, 3))
+    res = []
+    for l in sorted(names):
+        s = rng.choice(_scripts)
+        res += [l, u'{0}_{1}'.format(l, s)]
+        for r in range(rng.randint(0, 2)):
+            res.append(u'{0}_{1}_{2}'.format(l, s, _word(rng, 2).upper()))
+    return res
+
+
+def tree(path, languages=100, seed=1, size=1):
+    '''Write a synthetic SLDR tree under path and return its locale names,
+       root first.'''
+    rng = random.Random(seed)
+    names = [u'root'] + locales(languages, seed)
+    for n in names:
+        d = os.path.join(path, n[0])
+        if not os.path.exists(d):
+            os.makedirs(d)
+        with io.open(os.path.join(d, n + u'.xml'), 'w', encoding='utf-8') as f:
+            f.write(locale(n, rng, size * 4 if n == u'root' else size))
+    return names
@@ -29,8 +29,11 @@ from __future__ import print_function
 from builtins import range
 from builtins import chr
 
+import io
 import os
+import shutil
 import sys
+import tempfile
 import unittest
 
 try:
@@ -635,6 +638,65 @@ class ExemplarsTests(unittest.TestCase):
         self.assertEqual(u'-', self.exemplars.punctuation)
         self.assertEqual(u'0 1 2 4 6', self.exemplars.digits)
 
+    def test_marks_on_same_bases(self):
+        """Splitting only the clusters made by splits finds what a full pass would.
+
+        Two marks share the bases a, b and o, two more occur only on o,
+        and the cluster with three marks is split again in later rounds.
+        """
+        class FullPass(Exemplars):
+            def splittable(self):
+                return list(self.clusters.keys())
+
+            def find_marks_on_same_bases(self):
+                for exemplar in list(self.clusters.keys()):
+                    count = self.clusters[exemplar]
+                    for trailer_index in range(len(exemplar.trailers)):
+                        current_mark = exemplar.trailers[trailer_index]
+                        if current_mark not in self.bases_for_marks:
+                            continue
+                        for other_mark, other_bases in self.bases_for_marks.items():
+                            if (current_mark != other_mark and
+                                    other_bases == self.bases_for_marks[current_mark]):
+                                self.split_exemplar(exemplar, trailer_index, count)
+
+        text = u'a\u0301 b\u0301 a\u0300 b\u0300 o\u0300 o\u0323\u0331\u0301 nhcitgu'
+        full = FullPass()
+        full.unittest = True
+        for exemplars in (self.exemplars, full):
+            exemplars.process(text)
+            exemplars.analyze()
+        self.assertEqual({frozenset(u'abo'): [u'\u0300', u'\u0301'], frozenset(u'o'): [u'\u0323', u'\u0331']},
+                         dict((k, sorted(v)) for k, v in self.exemplars.marks_for_bases.items()))
+        self.assertEqual(full.always_separate_marks, self.exemplars.always_separate_marks)
+        self.assertEqual(list(full.clusters.items()), list(self.exemplars.clusters.items()))
+        self.assertEqual(full.main, self.exemplars.main)
+        self.assertEqual(u'a b c g h i n o t u \u0300 \u0301 \u0323 \u0331', self.exemplars.main)
+
+    def test_process_corpus(self):
+        """Processing files across workers counts as processing their text."""
+        text = (u'\u0915\u093c\u093f \u0916\u094d\u200d\u0937 abc\u0301\u0323.\r\n' * 50 +
+                u'[{cab.1}] \u0627\u0628\u0629 \u061c14-6-2011\n') * 20
+        self.exemplars.main = u'ch'
+        self.exemplars.process(text.replace(u'\r\n', u'\n'))
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, 'corpus.txt')
+            with io.open(path, 'wb') as f:
+                f.write(text.encode('utf-8'))
+            for workers in (0, 2):
+                exemplars = Exemplars()
+                exemplars.unittest = True
+                exemplars.main = u'ch'
+                exemplars.process_corpus([path, path], workers=workers, chunksize=1000)
+                self.assertEqual(list(exemplars.clusters.items()),
+                                 [(k, 2 * v) for k, v in self.exemplars.clusters.items()])
+                self.assertEqual(list(exemplars.scripts.items()),
+                                 [(k, 2 * v) for k, v in self.exemplars.scripts.items()])
+                self.assertEqual(set(exemplars.codes_for_scripts), set(self.exemplars.codes_for_scripts))
+        finally:
+            shutil.rmtree(tmp)
+
 
 if __name__ == '__main__':
     unittest.main()
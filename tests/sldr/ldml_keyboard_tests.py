@@ -0,0 +1,112 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import unittest, sys, os
+from xml.etree import ElementTree as et
+
+try:
+    from palaso.sldr.ldml_keyboard import Keyboard, Rules, read_tests, run_corpus
+except ImportError:
+    sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'lib')))
+    from palaso.sldr.ldml_keyboard import Keyboard, Rules, read_tests, run_corpus
+
+
+class KeyboardTests(unittest.TestCase):
+
+    def setUp(self):
+        self.kbd = Keyboard(os.path.join(os.path.dirname(__file__), 'kbdtest.xml'))
+
+    def typed(self, keys, kbd=None):
+        return [c.outputs[-1] for c in (kbd or self.kbd).process_string(keys)]
+
+    def rules(self, *transforms):
+        res = Rules('simple')
+        for t in transforms:
+            res.append(et.Element('transform', t))
+        return res
+
+    def test_deadkeys(self):
+        self.assertEqual(self.typed('[E00][C01][shift E06][D03][shift E06][shift E06]'),
+                         [u'`', u'à', u'à^', u'àê', u'àê^', u'àê^'])
+
+    def test_final(self):
+        self.assertEqual(self.typed('[B06][C05][B06][C05]'), [u'n', u'ŋ', u'ŋn', u'ŋg'])
+        self.assertEqual(self.typed('[C10][C10][C10][C10]')[-1], u'ː')
+
+    def test_negative(self):
+        self.assertEqual(self.typed('[D01][C02][D01][D03]'), [u'q', u'kʷ', u'kʷq', u'kʷqe'])
+
+    def test_after(self):
+        self.assertEqual(self.typed('[B02][D03][C02][B02][C02]'), [u'x', u'χe', u'χes', u'χesx', u'χesxs'])
+
+    def test_stable(self):
+        res = list(self.kbd.process_string('[D07][D07][C01][C02][B06][C05][E01]'))
+        self.assertEqual(res[-1].outputs[-1], u'uuasŋ1')
+        # Layers without transforms pass on what is stable, so the final
+        #  layer need not reprocess it.
+        self.assertEqual(res[-1].stables[2], u'uuasŋ')
+        self.assertTrue(res[-1].offsets[3] >= 4)
+
+    def test_reorder(self):
+        kbd = Keyboard(os.path.join(os.path.dirname(__file__), 'kbdmymr.xml'))
+        self.assertEqual(self.typed('[C01][D07][C03][A03][C01]', kbd),
+                         [u'\u25cc\u1031', u'\u1000\u1031', u'\u1000\u1031\u102d',
+                          u'\u1000\u1031\u102d ', u'\u1000\u1031\u102d \u25cc\u1031'])
+        # Each position is matched, and counted, once in a keystroke
+        reorder = kbd.transforms['reorder']
+        reorder.count()
+        self.typed('[C01]', kbd)
+        self.assertEqual(sum(reorder.hits), 1)
+        # and reuses what the last keystroke matched where its input is
+        #  unchanged, so each of \u102D, \u103B and \u1031 is matched once
+        reorder.count()
+        self.assertEqual(self.typed('[D07][C03][C02][C01][B01]', kbd)[-1],
+                         u'\u1000\u103b\u102d\u1016\u1031')
+        self.assertEqual(sum(reorder.hits), 3)
+
+    def test_match(self):
+        rules = self.rules({'from': 'ab', 'to': 'X'}, {'from': 'ab', 'to': 'Y', 'before': 'c'},
+                           {'from': 'b', 'to': 'Z', 'after': '[de]'}, {'from': 'a[^b]', 'to': 'W'})
+        self.assertEqual(rules.match(u'ab')[0].to, 'X')
+        self.assertEqual(rules.match(u'cab', 1)[0].to, 'Y')
+        self.assertEqual(rules.match(u'cab', 1)[1], 2)
+        self.assertEqual(rules.match(u'abd', 1)[0].to, 'Z')
+        self.assertEqual(rules.match(u'abf', 1), (None, 0))
+        self.assertEqual(rules.match(u'ac')[0].to, 'W')
+        self.assertEqual(rules.match(u'a'), (None, 0))
+        self.assertEqual(rules.match(u'a', partial=True), (None, 1))
+        # what the match depends on, up to the after context that might follow
+        self.assertEqual(rules.match(u'abf', 1, extent=True), (None, 0, 4))
+        self.assertEqual(rules.match(u'ab', extent=True)[1:], (2, 3))
+        self.assertEqual(rules.match(u'a', extent=True), (None, 0, 2))
+
+        rules.count()
+        rules.match(u'cab', 1)
+        rules.match(u'ab')
+        rules.match(u'ab')
+        rules.match(u'a', partial=True)
+        self.assertEqual(rules.hits, [2, 1, 0, 0])
+
+    def test_corpus(self):
+        path = os.path.join(os.path.dirname(__file__), 'kbdtest.xml')
+        tests = read_tests(os.path.join(os.path.dirname(__file__), 'kbdtest.tests'))
+        self.assertEqual(tests[0], (u'[E00][C01]', u'\u00e0'))
+        self.assertEqual(tests[-1], (u'[D07][D07][C01]', None))
+        tests.append((u'[C01]', u'b'))
+        res = list(run_corpus([(path, tests)], workers=0))
+        self.assertEqual(len(res), 1)
+        self.assertEqual((res[0]['keyboard'], res[0]['tests'], res[0]['keystrokes']), (path, 6, 17))
+        self.assertEqual(res[0]['failures'], [dict(keys=u'[C01]', expected=u'b', output=u'a')])
+        hits = dict((r['from'], r['hits']) for r in res[0]['rules']['simple'])
+        self.assertTrue(hits['`a'] > 0 and hits['ng'] > 0 and hits['q[^aeiou]'] > 0)
+        self.assertEqual(hits['``'], 0)
+        self.assertTrue(self.kbd.transforms['simple'].hits is None)
+        par = list(run_corpus([(path, tests), (path, tests[:2])], workers=1, chunksize=2))
+        for r in (res[0], par[0]):
+            del r['time'], r['load']
+        self.assertEqual(par[0], res[0])
+        self.assertEqual(par[1]['tests'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
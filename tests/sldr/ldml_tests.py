@@ -1,16 +1,17 @@
 #!/usr/bin/python
 
-import unittest, sys, os
+import unittest, sys, os, io, shutil, tempfile
 try:
     from StringIO import StringIO
 except ImportError:
     from io import StringIO
 
 try:
-    from sldr.ldml import Ldml, draftratings
+    from palaso.sldr.ldml import Ldml, LdmlCache, LocaleStore, draftratings, flattenlocale, flatten_all, _chains
 except ImportError:
-    sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'lib', 'palaso')))
-    from sldr.ldml import Ldml, draftratings, etwrite
+    sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'lib')))
+    from palaso.sldr.ldml import Ldml, LdmlCache, LocaleStore, draftratings, etwrite, flattenlocale, flatten_all, _chains
+import ldml_corpus
 
 
 class LDMLTests(unittest.TestCase):
@@ -77,5 +78,145 @@ class LDMLTests(unittest.TestCase):
         self.ldml.serialize_xml(res.write)
         self.assertEqual(res.getvalue().strip(), self.tf)
 
+    def test_save(self):
+        res = io.BytesIO()
+        self.ldml.save(res)
+        self.assertEqual(res.getvalue().decode('utf-8').strip(), self.tf)
+
+    def test_cache(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            cache = LdmlCache(tmp)
+            cold = Ldml(StringIO(self.tf), cache=cache)
+            warm = Ldml(StringIO(self.tf), cache=cache)
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+            self.assertEqual(warm.root.contentHash, self.ldml.root.contentHash)
+            self.assertEqual(warm.uid, 'test1')
+            for l in (cold, warm):
+                res = StringIO()
+                l.serialize_xml(res.write)
+                self.assertEqual(res.getvalue().strip(), self.tf)
+        finally:
+            shutil.rmtree(tmp)
+
+    def parsed(self, content, usedrafts=False):
+        return Ldml(StringIO(u'<ldml xmlns:sil="urn://www.sil.org/ldml/0.1">' + content + u'</ldml>'),
+                    usedrafts=usedrafts)
+
+    def test_difference_alternates(self):
+        chars = u'<characters><exemplarCharacters>[a]</exemplarCharacters>' \
+                u'<exemplarCharacters alt="proposed-x" draft="unconfirmed">{}</exemplarCharacters></characters>'
+        l = self.parsed(chars.format(u'[b]'), usedrafts=True)
+        l.difference(self.parsed(chars.format(u'[b]'), usedrafts=True))
+        self.assertEqual(len(l.root), 0)
+        l = self.parsed(chars.format(u'[b]'), usedrafts=True)
+        l.difference(self.parsed(chars.format(u'[c]'), usedrafts=True))
+        self.assertEqual(list(l.root.find('characters/exemplarCharacters').alternates), [u'proposed-x'])
+
+    def test_merge_attributes(self):
+        chars = u'<characters><exemplarCharacters type="index"{}>{}</exemplarCharacters></characters>'
+        this = self.parsed(chars.format(u' draft="contributed"', u'[a b]'))
+        base = self.parsed(chars.format(u' draft="contributed"', u'[a]'))
+        this.merge(self.parsed(chars.format(u'', u'[a]')), base)
+        e = this.root.find('characters/exemplarCharacters')
+        self.assertEqual((e.attrib, e.text), ({'type': 'index'}, u'[a b]'))
+
+    def test_merge_parent(self):
+        names = u'<localeDisplayNames><languages>{}</languages></localeDisplayNames>'
+        this = self.parsed(names.format(u'<language type="de">German</language><language type="en">English</language>'))
+        base = self.parsed(names.format(u'<language type="en">English</language>'))
+        other = self.parsed(names.format(u'<language type="en">English</language><language type="fr">French</language>'))
+        this.merge(other, base)
+        languages = this.root.find('localeDisplayNames/languages')
+        self.assertEqual(sorted((c.get('type'), c.text) for c in languages),
+                         [('de', u'German'), ('en', u'English'), ('fr', u'French')])
+        self.assertTrue(languages.find('language[@type="fr"]').parent is languages)
+
+    def test_overlay_external_resources(self):
+        res = u'<special><sil:external-resources>{}</sil:external-resources></special>'
+        parent = self.parsed(res.format(u'<sil:font name="B" types="ui"/><sil:kbd id="k"/>'))
+        l = self.parsed(res.format(u'<sil:font name="A" types="default"/>'))
+        l.overlay(parent)
+        self.assertEqual([c.get('name', c.get('id')) for c in l.root.find('special')[0]], ['B', 'k', 'A'])
+        l = self.parsed(u'<characters/>')
+        l.overlay(parent)
+        self.assertEqual(len(l.root.find('special')[0]), 2)
+
+    def test_first_match(self):
+        """overlay and difference align a child with the first of several with its key"""
+        fields = u''.join(u'<field type="f{0}"><displayName>F{0}</displayName></field>'.format(i) for i in range(50))
+        l = self.parsed(u'<dates><fields>' + fields + u'<field type="day"><displayName>Day</displayName></field>'
+                      u'<field type="day"><displayName>Jour</displayName></field></fields></dates>')
+        l.overlay(self.parsed(u'<dates><fields><field type="day"><relative type="0">today</relative></field>'
+                            u'</fields></dates>'))
+        days = l.root.findall('dates/fields/field[@type="day"]')
+        self.assertEqual([[c.text for c in d] for d in days], [[u'Day', u'today'], [u'Jour']])
+        l.difference(self.parsed(u'<dates><fields><field type="day"><displayName>Jour</displayName></field>'
+                               u'</fields></dates>'))
+        self.assertEqual(len(l.root.findall('dates/fields/field[@type="day"]')), 2)
+        l.difference(self.parsed(u'<dates><fields><field type="day"><displayName>Day</displayName>'
+                               u'<relative type="0">today</relative></field></fields></dates>'))
+        days = l.root.findall('dates/fields/field[@type="day"]')
+        self.assertEqual([[c.text for c in d] for d in days], [[u'Jour']])
+        self.assertEqual(len(l.root.find('dates/fields')), 51)
+
+    def test_addnode_index(self):
+        """addnode finds an existing child by key as the children and their hashes change"""
+        l = Ldml(None)
+        l.uid = None
+        langs = l.addnode(l.addnode(l.root, 'localeDisplayNames'), 'languages')
+        a, b, c = (l.addnode(langs, 'language', type=t) for t in 'abc')
+        self.assertTrue(l.addnode(langs, 'language', type='a') is not a)
+        self.assertEqual(list(a.alternates.values())[0].get('type'), 'a')
+        langs.remove(b)
+        self.assertTrue(l.addnode(langs, 'language', type='b') in list(langs))
+        c.set('type', 'd')
+        l._calc_hashes(c, True)
+        self.assertTrue(l.addnode(langs, 'language', type='c') in list(langs))
+        l.addnode(langs, 'language', type='d')
+        self.assertTrue(hasattr(c, 'alternates'))
+        self.assertEqual([x.get('type') for x in langs], ['a', 'd', 'b', 'c'])
+
+    def test_flatten_all(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            names = ldml_corpus.tree(tmp, 3)
+            store = LocaleStore([tmp])
+            self.assertEqual(store.locales(), sorted(names))
+            flat = dict(flatten_all([tmp], workers=0))
+            self.assertEqual(sorted(flat), sorted(names))
+            for n in names:
+                res = StringIO()
+                flattenlocale(n, [tmp]).serialize_xml(res.write)
+                self.assertEqual(flat[n], res.getvalue())
+            for n in names[-2:] + names[-1:]:
+                store.flatten(n)
+            self.assertTrue(store._memo.hits > 0)    # root is loaded once
+            self.assertTrue(store._flat.hits > 0)    # and its flattened chain reused
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_flatten_parent_locales(self):
+        # zh_Hant falls back to root, zh_Hant_TW to zh_Hant, zh and root
+        tmp = tempfile.mkdtemp()
+        try:
+            names = [u'root', u'zh', u'zh_Hant', u'zh_Hant_TW', u'zh_Hant_HK', u'zh_Hans']
+            rng = ldml_corpus.random.Random(1)
+            for n in names:
+                with io.open(os.path.join(tmp, n + u'.xml'), 'w', encoding='utf-8') as f:
+                    f.write(ldml_corpus.locale(n, rng))
+            store = LocaleStore([tmp])
+            self.assertEqual(store.fallback_chain(u'zh_Hant'), (u'root',))
+            self.assertEqual(store.fallback_chain(u'zh_Hant_TW'), (u'zh_Hant', u'zh', u'root'))
+            self.assertEqual(_chains(names, store),
+                    [[u'zh', u'zh_Hans', u'zh_Hant_HK', u'zh_Hant_TW'], [u'root'], [u'zh_Hant']])
+            flat = dict(flatten_all([tmp], workers=0))
+            for n in names:
+                res = StringIO()
+                flattenlocale(n, [tmp]).serialize_xml(res.write)
+                self.assertEqual(flat[n], res.getvalue())
+        finally:
+            shutil.rmtree(tmp)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+'''
+Measure TECkit conversion of many short segments, as made by converting
+each text node of a USFM document, and of one large input, comparing
+Converter.convert_many and convert_stream against converting each piece
+through the fixed 320 byte buffer and string concatenation previously used
+by Converter.convert.  The mapping is compiled from a source in data/.
+'''
+import io, os.path, random, sys, time
+from optparse import OptionParser
+
+from palaso.teckit import _engine, compiler
+from palaso.teckit.engine import Converter, FullBuffer, EmptyBuffer, Option
+
+
+def resource(name):
+    return os.path.join(os.path.dirname(__file__), 'data', name)
+
+
+def legacy_convert(conv, data):
+    '''The old Converter.convert loop for a complete byte string input.'''
+    buf = _engine.create_string_buffer(80*4)
+    options = Option.UseReplacementCharSilently | Option.InputIsComplete
+    res = u''
+    while data:
+        try:
+            cons,outs,lhc = _engine.convertBufferOpt(conv._converter,
+                                                     data, len(data),
+                                                     buf, len(buf), options)
+        except (FullBuffer, EmptyBuffer) as e:
+            cons,outs,lhc = e.args
+        res += conv._coerce_to_target(buf[:outs])
+        data = data[cons:]
+    return res + conv.flush()
+
+
+def segments(count, seed=None):
+    '''Return count text node like byte strings drawn from a small vocabulary.'''
+    rnd = random.Random(seed)
+    vocab = [''.join(rnd.choice('abcdefghiklmnoprstuwxyz')
+                     for _ in range(rnd.randint(1,9))) for _ in range(2000)]
+    return [' '.join(rnd.choice(vocab) for _ in range(rnd.randint(1,15))) + rnd.choice('.,; ')
+            for _ in range(count)]
+
+
+def timed(f, *args):
+    start = time.time()
+    res = f(*args)
+    return res, time.time() - start
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options]\n' + __doc__)
+    parser.add_option('-m','--mapping',default='SILGreek2004-04-27.map',help='Mapping source in data/ [%default]')
+    parser.add_option('-n','--segments',type='int',default=50000,help='Number of segments [%default]')
+    (opts, args) = parser.parse_args()
+
+    with open(resource(opts.mapping), 'rb') as f:
+        mapping = compiler.compile(f.read())
+    conv = Converter(mapping)
+    segs = segments(opts.segments, seed=1)
+    whole = ''.join(segs)
+    sys.stdout.write('{0} segments, {1} bytes\n'.format(len(segs), len(whole)))
+
+    old, to = timed(lambda: [legacy_convert(conv, s) for s in segs])
+    new, tn = timed(lambda: list(conv.convert_many(segs)))
+    assert old == new, 'convert_many results differ'
+    sys.stdout.write('  segments legacy: {0:7.3f}s\n'.format(to))
+    sys.stdout.write('    convert_many: {0:7.3f}s\n'.format(tn))
+
+    old, to = timed(legacy_convert, conv, whole)
+    new, tn = timed(lambda: u''.join(conv.convert_stream(io.BytesIO(whole))))
+    assert old == new, 'convert_stream results differ'
+    sys.stdout.write('     whole legacy: {0:7.3f}s\n'.format(to))
+    sys.stdout.write('   convert_stream: {0:7.3f}s\n'.format(tn))